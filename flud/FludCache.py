@@ -0,0 +1,99 @@
+"""
+FludCache.py (c) 2003-2006 Alen Peacock.  This program is distributed under
+the terms of the GNU General Public License (the GPL), version 3.
+
+A bounded cache with per-entry expiry.  Entries are kept in a doubly linked
+list in least- to most-recently used order, so that gets, puts, and evictions
+are all O(1).
+"""
+
+import time
+
+class TTLCache:
+    """
+    Maps keys to values for at most 'ttl' seconds each.  Holds at most
+    'maxsize' entries; when full, the least recently used entry is evicted.
+
+    >>> c = TTLCache(2, 60)
+    >>> c.put('a', 1)
+    >>> c.put('b', 2)
+    >>> c.get('a')
+    1
+    >>> c.put('c', 3)     # evicts 'b', which was used least recently
+    >>> c.get('b'), c.get('c'), len(c)
+    (None, 3, 2)
+    >>> c.put('d', 4, ttl=-1)
+    >>> c.get('d'), c.has_key('a')
+    (None, True)
+    >>> c.remove('a')
+    >>> c.get('a'), c.hits, c.misses
+    (None, 2, 3)
+    """
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = {}  # key -> [prev, next, key, value, expires]
+        self.head = [None, None, None, None, None]  # sentinel
+        self.head[0] = self.head[1] = self.head
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
+
+    def _append(self, entry):
+        last = self.head[0]
+        entry[0] = last
+        entry[1] = self.head
+        last[1] = entry
+        self.head[0] = entry
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[4] < time.time():
+            self.remove(key)
+            self.misses += 1
+            return default
+        self._unlink(entry)
+        self._append(entry)
+        self.hits += 1
+        return entry[3]
+
+    def has_key(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry[4] >= time.time()
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self.remove(key)
+        if ttl < 0:
+            return
+        if len(self.entries) >= self.maxsize:
+            self.remove(self.head[1][2])
+        entry = [None, None, key, value, time.time()+ttl]
+        self._append(entry)
+        self.entries[key] = entry
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._unlink(entry)
+
+    def clear(self):
+        self.entries = {}
+        self.head[0] = self.head[1] = self.head
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
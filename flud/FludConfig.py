@@ -11,6 +11,8 @@ import ConfigParser
 import flud.FludCrypto as FludCrypto
 from flud.FludCrypto import FludRSA
 from flud.FludkRouting import kRouting
+from flud.FludkStore import kStore
+from flud.FludContacts import ContactCache
 from flud.fencode import fencode, fdecode
 
 logger = logging.getLogger('flud')
@@ -173,7 +175,7 @@ class FludConfig:
         logger.debug('groupIDr = %s' % self.groupIDr)
         logger.debug('groupIDu = %s' % self.groupIDu)
         
-        self.port, self.clientport = self._getServerConf()
+        self.port, self.clientport, self.udp = self._getServerConf()
         if serverport != None:
             self.port = serverport
             self.clientport = serverport + CLIENTPORTOFFSET
@@ -181,6 +183,7 @@ class FludConfig:
             self.configParser.set("server","clientport",self.clientport)
         logger.debug('port = %s' % self.port)
         logger.debug('clientport = %s' % self.clientport)
+        logger.debug('udp = %s' % self.udp)
         logger.debug('trustdeltas = %s' 
                 % [v for v in dir(TrustDeltas) if v[0] != '_'])
 
@@ -198,6 +201,8 @@ class FludConfig:
             os.mkdir(self.kstoredir)
             os.chmod(self.kstoredir, 0700)
         logger.debug('kstoredir = %s' % self.kstoredir)
+        self.kstore = kStore(self.kstoredir)
+        self.contacts = ContactCache(self.fludhome)
 
         self.clientdir = self._getClientConf()
         if not os.path.isdir(self.clientdir):
@@ -309,7 +314,8 @@ class FludConfig:
 
     def _getServerConf(self):
         """
-        Returns server configuration: port number
+        Returns server configuration: port number, local client port number,
+        and whether to use the UDP transport for DHT requests
         """
         if not self.configParser.has_section("server"):
             self.configParser.add_section("server")
@@ -327,10 +333,17 @@ class FludConfig:
             logger.debug("no clientport specified, using default")
             clientport = port+CLIENTPORTOFFSET 
         
+        try:
+            udp = int(self.configParser.get("server","udp"))
+        except:
+            logger.debug("no udp specified, using default")
+            udp = 1
+        
         self.configParser.set("server","port",port)
         self.configParser.set("server","clientport",clientport)
+        self.configParser.set("server","udp",udp)
 
-        return port, clientport
+        return port, clientport, udp
 
     def _getDirConf(self, configParser, section, default):
         """
@@ -477,17 +490,10 @@ class FludConfig:
             # XXX: disabled nodes saving
             #for k in self.nodes:
             #   self.configParser.set('nodes', k, self.nodes[k])
-            n = self.routing.insertNode((host, int(port), long(nodeID, 16), 
+            # if the bucket is full, the node lands in the replacement cache
+            # (the caller, updateNode, gets the bucket's head probed)
+            self.routing.insertNode((host, int(port), long(nodeID, 16), 
                 Ku.exportPublicKey()['n']))
-            if n != None:
-                logger.warn("need to ping %s for LRU in routing table!" 
-                        % str(n))
-                # XXX: instead of pinging, put it in a replacement cache table
-                #      and when one of the nodes needs replaced (future query)
-                #      replace it with one of these. Sec 4.1
-                self.routing.replacementCache.insertNode(
-                        (host, int(port), long(nodeID, 16),
-                            Ku.exportPublicKey()['n']))
             self.reputations[long(nodeID,16)] = TrustDeltas.INITIAL_SCORE
             # XXX: no management of reputations size: need to manage as a cache
     
@@ -0,0 +1,139 @@
+"""
+FludContacts.py (c) 2003-2006 Alen Peacock.  This program is distributed
+under the terms of the GNU General Public License (the GPL), version 3.
+
+Where other nodes were last seen, kept across restarts.  Turning a node ID
+into an address otherwise takes an iterative kFindNode, and retrieving a file
+needs one for each node holding one of its blocks -- nodes that this node has
+mostly stored to or heard from before, and that rarely move.  The contacts are
+kept in a file in FLUDHOME (rewritten, by sync(), only when they've changed),
+at most MAXCONTACTS of them, and each for CONTACT_TTL seconds after it was
+last seen.
+
+>>> import tempfile, shutil
+>>> d = tempfile.mkdtemp()
+>>> c = ContactCache(d, maxcontacts=2)
+>>> c.put(('1.2.3.4', 80, 1L, 7L))
+>>> c.put(('1.2.3.5', 80, 2L, 8L))
+>>> c.put(('1.2.3.4', 81, 1L, 7L))     # moved
+>>> c.get(1L), c.get(3L)
+(('1.2.3.4', 81, 1L, 7L), None)
+>>> c.put(('1.2.3.6', 80, 3L, 9L))     # 2 was seen least recently
+>>> c.get(2L), len(c)
+(None, 2)
+>>> c.sync()
+>>> c = ContactCache(d)
+>>> c.get(3L)
+('1.2.3.6', 80, 3L, 9L)
+>>> c.remove(3L); c.get(3L), len(c)
+(None, 1)
+>>> shutil.rmtree(d)
+"""
+
+import os, time, logging
+
+from flud.fencode import fencode, fdecode
+
+logger = logging.getLogger("flud.contacts")
+
+CONTACTSFILE = "contacts"
+MAXCONTACTS = 8192           # contacts to keep
+CONTACT_TTL = 30*24*60*60    # forget contacts not seen in this long (secs)
+DAY = 24*60*60
+
+class ContactCache:
+    """
+    Maps node IDs (longs) to the (host, port, nodeID, Ku n) node tuple they
+    were last seen at.
+    """
+    def __init__(self, dir, maxcontacts=MAXCONTACTS, ttl=CONTACT_TTL):
+        self.fname = os.path.join(dir, CONTACTSFILE)
+        self.maxcontacts = maxcontacts
+        self.ttl = ttl
+        self.contacts = {}  # nodeID -> [node tuple, last seen]
+        self.dirty = False
+        self._load()
+
+    def __len__(self):
+        return len(self.contacts)
+
+    def _load(self):
+        if not os.path.exists(self.fname):
+            return
+        try:
+            f = open(self.fname, 'rb')
+            contacts = fdecode(f.read())
+            f.close()
+        except Exception, inst:
+            logger.warn("couldn't read contacts from %s: %s"
+                    % (self.fname, inst))
+            return
+        oldest = time.time()-self.ttl
+        for nodeID, (node, seen) in contacts.items():
+            if seen >= oldest:
+                self.contacts[nodeID] = [tuple(node), seen]
+        logger.info("loaded %d contacts" % len(self.contacts))
+
+    def put(self, node):
+        """
+        Notes that node (a (host, port, nodeID, Ku n) tuple) was just seen.
+        """
+        node = tuple(node)
+        entry = self.contacts.get(node[2])
+        now = time.time()
+        if entry:
+            if entry[0] != node or int(now/DAY) != int(entry[1]/DAY):
+                # (last-seen times are only written out once a day)
+                entry[0] = node
+                self.dirty = True
+            entry[1] = now
+            return
+        if len(self.contacts) >= self.maxcontacts:
+            self._prune()
+        self.contacts[node[2]] = [node, now]
+        self.dirty = True
+
+    def _prune(self):
+        byseen = [(e[1], nodeID) for nodeID, e in self.contacts.items()]
+        byseen.sort()
+        for seen, nodeID in byseen[:max(len(byseen)/8, 1)]:
+            del self.contacts[nodeID]
+
+    def get(self, nodeID):
+        """
+        Returns where nodeID was last seen, or None.
+        """
+        entry = self.contacts.get(nodeID)
+        if entry:
+            return entry[0]
+        return None
+
+    def remove(self, nodeID):
+        if self.contacts.pop(nodeID, None):
+            self.dirty = True
+
+    def sync(self):
+        """
+        Writes the contacts out, if they've changed.
+        """
+        if not self.dirty:
+            return
+        oldest = time.time()-self.ttl
+        contacts = {}
+        for nodeID, (node, seen) in self.contacts.items():
+            if seen >= oldest:
+                contacts[nodeID] = (node, int(seen))
+        tmpname = self.fname+".tmp"
+        f = open(tmpname, 'wb')
+        f.write(fencode(contacts))
+        f.close()
+        os.chmod(tmpname, 0600)
+        os.rename(tmpname, self.fname)
+        self.dirty = False
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -11,17 +11,24 @@ import operator
 import struct
 import time
 import Crypto.Random as Random
-from Crypto.Hash import SHA256
+from Crypto.Hash import SHA256, HMAC
 from Crypto.PublicKey import RSA, pubkey
 from Crypto.Util.randpool import RandomPool
 from Crypto.Random import atfork
 
+from flud.FludCache import TTLCache
+
+KEYCACHESIZE = 4096       # imported public keys to keep
+KEYCACHE_TTL = 24*3600    # (keys don't change, this just ages out old peers)
+
 class FludRSA(RSA._RSAobj):
     """
     Subclasses the Crypto.PublicKey.RSAobj object to add access to the
     privatekey as well as methods for exporting and importing an RSA obj.
     """
     rand = RandomPool()
+    # imported public keys, by (e, n), shared by everyone who imports them
+    keycache = TTLCache(KEYCACHESIZE, KEYCACHE_TTL)
 
     def __init__(self, rsa):
         self.__setstate__(rsa.__getstate__())
@@ -44,16 +51,22 @@ class FludRSA(RSA._RSAobj):
     
     def id(self):
         """
-        returns the hashstring of the public key
+        returns the hashstring of the public key (computed once per key)
         """
-        #return hashstring(str(self.exportPublicKey()))
-        return hashstring(str(self.exportPublicKey()['n']))
+        try:
+            return self._id
+        except AttributeError:
+            #return hashstring(str(self.exportPublicKey()))
+            self._id = hashstring(str(self.exportPublicKey()['n']))
+            return self._id
 
     def importPublicKey(key):
         """
         Can take, as key, a dict describing the public key ('e' and 'n'), a
         string describing n, or a long describing n (in the latter two cases, e
-        is assumed to be 65537L).
+        is assumed to be 65537L).  Public keys are cached, so importing the
+        same key again returns the same (shared, and so not to be modified)
+        object, with its id() already computed.
         """
         if isinstance(key, str):
             key = long(key, 16)
@@ -62,10 +75,18 @@ class FludRSA(RSA._RSAobj):
             key = {'e': 65537L, 'n': key}
 
         if isinstance(key, dict):
+            public = len(key) == 2 and key.has_key('e') and key.has_key('n')
+            if public:
+                cached = FludRSA.keycache.get((key['e'], key['n']))
+                if cached:
+                    return cached
             state = key
             pkey = RSA.construct((0L,0L))
             pkey.__setstate__(state)
-            return FludRSA(pkey)
+            result = FludRSA(pkey)
+            if public:
+                FludRSA.keycache.put((key['e'], key['n']), result)
+            return result
         else:
             raise TypeError("type %s not supported by importPublicKey():"\
                     " try dict with keys of 'e' and 'n', string representing"\
@@ -84,6 +105,13 @@ class FludRSA(RSA._RSAobj):
     generate = staticmethod(generate)
 
 
+def keyCacheStats():
+    """
+    Returns the size and hit/miss counts of the public key cache.
+    """
+    c = FludRSA.keycache
+    return {'size': len(c), 'hits': c.hits, 'misses': c.misses}
+
 def generateKeys(len=2048):
     fludkey = FludRSA.generate(len)
     return fludkey.publickey(), fludkey.privatekey()
@@ -93,6 +121,12 @@ def hashstring(string):
     sha256.update(string)
     return sha256.hexdigest()
 
+def hmacstring(key, string):
+    """
+    returns the hex HMAC-SHA256 of string under key
+    """
+    return HMAC.new(key, string, SHA256).hexdigest()
+
 def hashfile(filename):
     sha256 = SHA256.new()
     f = open(filename, "r")
@@ -36,3 +36,38 @@ class ErrDeferredList(defer.DeferredList):
         else:
             #print "DEBUG: returning %s" % result
             return result
+
+
+class QuorumDeferredList(defer.Deferred):
+    """
+    QuorumDeferredList fires as soon as 'quorum' of the Deferreds in list have
+    succeeded, with the list of their results, without waiting on the rest
+    (which carry on in the background; their results and errors are
+    consumed).  If so many fail that the quorum can no longer be reached, it
+    errback()s with all of the failures seen, as ErrDeferredList does.
+    """
+    def __init__(self, list, quorum):
+        defer.Deferred.__init__(self)
+        self.quorum = quorum
+        self.results = []
+        self.failures = []
+        self.remaining = len(list)
+        if quorum <= 0:
+            self.callback([])
+        elif quorum > len(list):
+            self.errback(failure.DefaultException(
+                "quorum of %d can't be met by %d" % (quorum, len(list))))
+        for d in list:
+            d.addCallbacks(self._succeeded, self._failed)
+
+    def _succeeded(self, result):
+        self.remaining -= 1
+        self.results.append(result)
+        if not self.called and len(self.results) >= self.quorum:
+            self.callback(self.results[:])
+
+    def _failed(self, err):
+        self.remaining -= 1
+        self.failures.append(err)
+        if not self.called and len(self.results)+self.remaining < self.quorum:
+            self.errback(failure.DefaultException(self.failures))
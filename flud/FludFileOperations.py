@@ -8,13 +8,16 @@ Implements file storage and retrieval operations using flud primitives.
 import os, stat, sys, logging, binascii, random, time
 from zlib import crc32
 from StringIO import StringIO
-from twisted.internet import defer, threads
+from twisted.internet import reactor, defer, threads
 from Crypto.Cipher import AES
 
 from flud.FludCrypto import FludRSA, hashstring, hashfile
 from flud.protocol.FludCommUtil import *
 from flud.fencode import fencode, fdecode
 from flud.FludConfig import TrustDeltas
+import flud.FludPlacement as FludPlacement
+from flud.protocol.PeerStats import peers, DEFAULTRTT
+from flud.protocol.FludClient import CONTACTERRORS
 import fludfilefec
 
 logger = logging.getLogger('flud.fileops')
@@ -24,6 +27,12 @@ code_k = 20             # data blocks
 code_n = 20             # parity blocks
 code_m = code_k+code_n  # total blocks
 
+# block retrieval
+RETRIEVE_EXTRA = 4      # blocks fetched beyond the code_k needed to decode
+HEDGE_QUANTILE = 0.9    # fetches slower than this fraction of the file's
+                        # finished fetches get a backup (of another block)
+HEDGE_MINSAMPLES = 5    # ... once this many have finished
+
 # temp filenaming defaults
 appendEncrypt = ".crypt"
 appendFsMeta = ".nmeta"
@@ -141,6 +150,7 @@ class StoreFile:
         # code_m).  XXX: X=10 is magic
         self.nodeChoices = self.config.getPreferredNodes(code_m+10)
         self.usedNodes = {}
+        self.placement = {}  # block number -> node planned for it
 
         self.deferred = self._storeFile()
 
@@ -300,6 +310,11 @@ class StoreFile:
     def _storeBlocks(self, storedMetadata):
         dlist = []
         self.blockMetadata = {'k': code_k, 'n': code_n}
+        # plan where all the blocks go up front, so that the slow nodes get
+        # as little of the file as possible
+        sizes = [os.stat(sfile)[stat.ST_SIZE] for sfile in self.sfiles]
+        self.placement = dict(enumerate(
+            FludPlacement.assign(self.nodeChoices, sizes)))
         for i in range(len(self.segHashesLocal)):
             hash = self.segHashesLocal[i]
             sfile = self.sfiles[i]
@@ -311,18 +326,25 @@ class StoreFile:
         return dl
 
     def _storeBlock(self, i, hash, sfile, mfile, retry=2):
-        if not self.nodeChoices:
-            #self.nodeChoices = self.routing.knownExternalNodes()
-            # XXX: instead of asking for code_k, ask for code_k - still needed
-            self.nodeChoices = self.config.getPreferredNodes(code_k, 
-                    self.usedNodes.keys())
-            logger.warn(self.ctx("asked for more nodes, %d nodes found", 
-                len(self.nodeChoices)))
-        if not self.nodeChoices:
-            return defer.fail(failure.DefaultException(
-                "cannot store blocks to 0 nodes"))
-        node = random.choice(self.nodeChoices)
-        self.nodeChoices.remove(node)
+        # the first try goes where the placement plan says; retries (and
+        # blocks that weren't planned) go to the best node left
+        node = self.placement.pop(i, None)
+        if not node:
+            if not self.nodeChoices:
+                #self.nodeChoices = self.routing.knownExternalNodes()
+                # XXX: instead of asking for code_k, ask for code_k - still
+                # needed
+                self.nodeChoices = self.config.getPreferredNodes(code_k, 
+                        self.usedNodes.keys())
+                logger.warn(self.ctx("asked for more nodes, %d nodes found", 
+                    len(self.nodeChoices)))
+            if not self.nodeChoices:
+                return defer.fail(failure.DefaultException(
+                    "cannot store blocks to 0 nodes"))
+            node = FludPlacement.choose(self.nodeChoices,
+                    os.stat(sfile)[stat.ST_SIZE])
+        if node in self.nodeChoices:
+            self.nodeChoices.remove(node)
         host = node[0]
         port = node[1]
         nID = node[2]
@@ -622,6 +644,13 @@ class RetrieveFile:
     to query the DHT layer for the file metadata record.  The file record
     contains the locations of the file blocks.  These are downloaded
     until the complete file can be regenerated and saved locally.
+
+    code_k+RETRIEVE_EXTRA blocks are fetched at once, and each fetch that
+    fails is replaced with a fetch of another block.  A fetch that is slow
+    (compared to the others for the same file) gets another block fetched
+    alongside it.  As soon as any code_k blocks are in, decoding starts and
+    the fetches still outstanding are cancelled, so that a slow or dead node
+    doesn't hold up the whole file.
     """
 
     def __init__(self, node, key, mkey=True):
@@ -648,6 +677,11 @@ class RetrieveFile:
         self.numBlocksRetrieved = 0
         self.blocks = {}
         self.fsmetas = {}
+        self.fetching = {}   # meta key -> (deferred, start time, hedged)
+        self.latencies = []  # seconds taken by each successful fetch
+        self.hedger = None
+        self.refilling = False
+        self.refillAgain = False
 
         self.deferred = self._retrieveFile()
         
@@ -684,102 +718,183 @@ class RetrieveFile:
             raise ValueError("unsupported coding scheme %d/%d" % (k, n))
         logger.info(self.ctx("got metadata %s" % self.meta))
         self.decoded = False
-        return self._getSomeBlocks(code_k)
+        self.fetched = defer.Deferred()
+        self.fetched.addCallback(lambda r: self._decodeData())
+        self._refill()
+        return self.fetched
+
+    def _scoreLocation(self, id, now):
+        """
+        Returns a sort key for fetching a block from node id: nodes we're
+        having trouble with (throttled, with a negative reputation, or with
+        their breaker open) last, then by how long a request to them can be
+        expected to take (from the latency we've measured, and how many of
+        our recent requests they've answered), and then best reputation first.
+        """
+        reputation = self.config.reputations.get(id,
+                TrustDeltas.INITIAL_SCORE)
+        troubled = reputation < 0 or self.config.throttled.get(id, 0) > now
+        contact = self.config.routing.getNode(id) \
+                or self.config.contacts.get(id)
+        if contact:
+            troubled = troubled or peers.tripped(contact[0], contact[1])
+            cost = peers.cost(contact[0], contact[1])
+        else:
+            cost = DEFAULTRTT
+        return (troubled, cost, -reputation)
 
     def _orderNodes(self, meta):
-        def score(k, node):
-            logger.debug(self.ctx("scoring node %s" % node))
-            v = (k, self.config.reputations[node] \
-                            if node in self.config.reputations \
-                            else TrustDeltas.INITIAL_SCORE)
-            if node in self.config.throttled \
-                    and self.config.throttled[node] > curtime:
-                v = (k, TrustDeltas.NEGATIVE_CAP)
-            return v
-
-        keys = meta.keys()
-        r = []
+        """
+        Returns meta's keys in the order their blocks should be fetched:
+        those with an untroubled location first, primary (systematic) blocks
+        before the rest (decoding code_k primary blocks is just
+        concatenation), and then by the score of their best location.
+        """
         logger.info(self.ctx("_orderNodes"))
-        curtime = int(time.time())
-        for k in keys:
-            logger.debug(self.ctx("thinkin bout key %s" % str(k)))
-            node = meta[k]
-            if isinstance(node, list):
-                # score it according to the highest scored node
-                v = (k, TrustDeltas.NEGATIVE_CAP)
-                for n in node:
-                    newv = score(k, n)
-                    if newv[1] > v[1]:
-                        v = newv
-                r.append(v)
-            else:
-                r.append(score(k, node))
-        logger.debug(self.ctx("done scoring, now sorting"))
-        r.sort(lambda x,y:cmp(x[1],y[1]))
-        return keys
+        now = int(time.time())
+        r = []
+        for k in meta.keys():
+            locations = meta[k]
+            if not isinstance(locations, list):
+                locations = [locations]
+            best = min([self._scoreLocation(id, now) for id in locations])
+            r.append((best[0], k[0] >= code_k, best[1:], k))
+        r.sort()
+        return [v[-1] for v in r]
 
     def _getSomeBlocks(self, reqs=code_k):
-        tries = 0
-        if reqs > len(self.meta):
-            reqs = len(self.meta)
-        dlist = []
+        """
+        Starts fetches of up to reqs more blocks, best placed first.
+        """
         logger.debug(self.ctx("about to order nodes"))
-        keys = self._orderNodes(self.meta)
+        keys = [k for k in self._orderNodes(self.meta)
+                if not self.fetching.has_key(k)]
         logger.debug(self.ctx("keys are now: %s" % str(keys)))
-        for i in range(reqs):
-            #c = random.choice(self.meta.keys())
-            choice = keys.pop(0)
-            logger.info(self.ctx("choice is %s" % str(choice)))
-            block = fencode(choice[1])
-            id = self.meta[choice]
-            if isinstance(id, list):
-                logger.info(self.ctx(
-                    "multiple location choices, choosing one randomly."))
-                id = random.choice(id)
-                # If the chosen one fails, try each of the others until
-                # it works or exhausts the list (thus the keys.insert bit)
-                self.meta[choice].remove(id)
-                if len(self.meta[choice]) == 0:
-                    #self.meta.pop(choice)
-                    pass
-                else:
-                    keys.insert(0,choice)
-            else:
-                #self.meta.pop(choice)
-                pass
-            logger.info(self.ctx("retrieving %s from %s" % (block, id)))
-            # look up nodes by id, then do a retrieve.
-            deferred = self.node.client.kFindNode(id) 
-            deferred.addCallback(self._retrieveBlock, block, id)
-            deferred.addErrback(self._findNodeErr, 
-                    "couldn't find node %s for block %s" % (fencode(id), block),
-                    id)
-            dlist.append(deferred)
+        for choice in keys[:reqs]:
+            # (fetches that finish right away can change meta and fetching,
+            # or finish the whole thing, under us)
+            if self.fetched.called:
+                break
+            if self.meta.has_key(choice) and not self.fetching.has_key(choice):
+                self._fetchBlock(choice)
+
+    def _fetchBlock(self, choice):
+        logger.info(self.ctx("choice is %s" % str(choice)))
+        block = fencode(choice[1])
+        id = self.meta[choice]
+        if isinstance(id, list):
+            logger.info(self.ctx(
+                "multiple location choices, choosing the best."))
+            now = int(time.time())
+            id = min([(self._scoreLocation(i, now), i) for i in id])[1]
+            # If the chosen one fails, the others are left to try
+            self.meta[choice].remove(id)
+            if len(self.meta[choice]) == 0:
+                self.meta.pop(choice)
+        else:
             self.meta.pop(choice)
-            tries = tries + 1
-            if tries >= reqs:
-                break;
-        dl = defer.DeferredList(dlist)
-        dl.addCallback(self._retrievedAll)
-        return dl
+        logger.info(self.ctx("retrieving %s from %s" % (block, id)))
+        # find the node (locally if we can), then do a retrieve.
+        deferred = self.node.client.locate(id) 
+        deferred.addCallback(self._retrieveBlock, block, id)
+        deferred.addErrback(self._findNodeErr, 
+                "couldn't find node %s for block %s" % (fencode(id), block),
+                id)
+        self.fetching[choice] = (deferred, time.time(), False)
+        deferred.addBoth(self._fetchDone, choice)
+
+    def _fetchDone(self, result, choice):
+        deferred, started, hedged = self.fetching.pop(choice)
+        if result:
+            self.latencies.append(time.time()-started)
+            # (any other locations it has aren't needed)
+            self.meta.pop(choice, None)
+        if self.fetched.called:
+            return
+        if len(self.blocks) >= code_k:
+            outstanding = [f[0] for f in self.fetching.values()]
+            logger.info(self.ctx("got %d blocks, cancelling %d outstanding"
+                    " fetches" % (len(self.blocks), len(outstanding))))
+            self._stopHedging()
+            self.fetched.callback(True)
+            for d in outstanding:
+                d.cancel()
+        else:
+            self._refill()
+
+    def _refill(self):
+        """
+        Keeps code_k+RETRIEVE_EXTRA blocks retrieved or on their way (not
+        counting slow fetches that have been hedged), or fails if there are
+        no more blocks to try.
+        """
+        if self.refilling:
+            # a fetch failed as soon as it was started; the refill that
+            # started it will make up for it
+            self.refillAgain = True
+            return
+        self.refilling = True
+        try:
+            again = True
+            while again and not self.fetched.called:
+                self.refillAgain = False
+                unhedged = len([f for f in self.fetching.values() 
+                    if not f[2]])
+                need = code_k+RETRIEVE_EXTRA-len(self.blocks)-unhedged
+                if need > 0:
+                    self._getSomeBlocks(need)
+                again = self.refillAgain
+        finally:
+            self.refilling = False
+        if self.fetched.called:
+            return
+        if not self.fetching:
+            self._stopHedging()
+            logger.info(self.ctx("couldn't decode file after retreiving"
+                    " all %d available blocks" % self.numBlocksRetrieved))
+            self.fetched.errback(RuntimeError("couldn't decode file after"
+                " retreiving all %d available blocks" 
+                % self.numBlocksRetrieved))
+            return
+        self._scheduleHedge()
+
+    def _hedgeAfter(self):
+        latencies = self.latencies[:]
+        latencies.sort()
+        return latencies[int(HEDGE_QUANTILE*(len(latencies)-1))]
+
+    def _scheduleHedge(self):
+        self._stopHedging()
+        if len(self.latencies) < HEDGE_MINSAMPLES:
+            return
+        started = [f[1] for f in self.fetching.values() if not f[2]]
+        if not started:
+            return
+        delay = max(min(started)+self._hedgeAfter()-time.time(), 0)
+        self.hedger = reactor.callLater(delay, self._hedge)
+
+    def _stopHedging(self):
+        if self.hedger and self.hedger.active():
+            self.hedger.cancel()
+        self.hedger = None
+
+    def _hedge(self):
+        self.hedger = None
+        cutoff = time.time()-self._hedgeAfter()
+        for choice, (d, started, hedged) in self.fetching.items():
+            if not hedged and started <= cutoff:
+                logger.info(self.ctx("fetch of %s is slow, fetching another"
+                        " block alongside it" % fencode(choice[1])))
+                self.fetching[choice] = (d, started, True)
+        self._refill()
 
     def _findNodeErr(self, failure, msg, id):
-        logger.info(self.ctx("%s: %s" % (message, failure.getErrorMessage())))
+        if failure.check(defer.CancelledError):
+            return
+        logger.info(self.ctx("%s: %s" % (msg, failure.getErrorMessage())))
         self.config.modifyReputation(id, TrustDeltas.FNDN_FAIL)
 
-    def _retrieveBlock(self, kdata, block, id):
-        #print type(kdata)
-        #print kdata
-        #if len(kdata['k']) > 1:
-        if kdata['k'][0][2] != id:
-            print "%s != %s" (kdata['k'][0], id)
-            raise ValueError("couldn't find node %s" % fencode(id))
-            #raise ValueError("this shouldn't really be a ValueError..."
-            #       " should be a GotMoreKnodesThanIBargainedForError: k=%s"
-            #       % kdata['k'])
-        #else:
-        #   print kdata['k']
-        node = kdata['k'][0]
+    def _retrieveBlock(self, node, block, id, relocated=False):
         host = node[0]
         port = node[1]
         id = node[2]
@@ -787,14 +902,44 @@ class RetrieveFile:
         if not self.decoded:
             d = self.node.client.sendRetrieve(block, host, port, nKu, self.mkey)
             d.addCallback(self._retrievedBlock, id, block, self.mkey)
+            if not relocated:
+                d.addErrback(self._relocate, node, block, id)
             d.addErrback(self._retrieveBlockErr, id,
                     "couldn't get block %s from %s" % (block, fencode(id)),
                     host, port, id)
             return d
     
+    def _relocate(self, err, node, block, id):
+        # the node's address came from the routing table or the contact
+        # cache, and may be out of date: if it didn't answer, ask the DHT
+        # where it is now, and try again there
+        if not err.check(*CONTACTERRORS):
+            return err
+        logger.info(self.ctx("%s:%d didn't answer for %s, looking it up"
+                % (node[0], node[1], fencode(id))))
+        d = self.node.client.locate(id, lookup=True)
+        d.addCallbacks(self._relocated, lambda e: err,
+                callbackArgs=(node, err, block, id))
+        return d
+
+    def _relocated(self, newnode, node, err, block, id):
+        if newnode[:2] == node[:2]:
+            return err
+        logger.info(self.ctx("%s has moved to %s:%d" 
+                % (fencode(id), newnode[0], newnode[1])))
+        return self._retrieveBlock(newnode, block, id, True)
+
     def _retrievedBlock(self, msg, nID, block, mkey):
         logger.debug(self.ctx("retrieved block=%s, msg=%s" % (block, msg)))
         self.config.modifyReputation(nID, TrustDeltas.GET_SUCCEED)
+        if self.fetched.called:
+            # too late to be used
+            for f in msg:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+            return False
         blockname = [f for f in msg if f[-len(block):] == block][0]
         expectedmeta = "%s.%s.meta" % (block, mkey)
         metanames = [f for f in msg if f[-len(expectedmeta):] == expectedmeta]
@@ -806,29 +951,14 @@ class RetrieveFile:
         return True
 
     def _retrieveBlockErr(self, failure, nID, message, host, port, id):
+        if failure.check(defer.CancelledError):
+            # no longer needed -- not the node's fault
+            return
         logger.info(self.ctx("%s: %s" % (message, failure.getErrorMessage())))
         self.config.modifyReputation(nID, TrustDeltas.GET_FAIL)
         # don't propogate the error -- one block doesn't cause the file
         # retrieve to fail.
 
-    def _retrievedAll(self, success):
-        logger.info(self.ctx("tried retreiving %d blocks %s" 
-            % (len(success), success)))
-        if self.numBlocksRetrieved >= code_k:
-            # XXX: need to make this try again with other blocks if decode
-            # fails
-            return self._decodeData()
-        elif len(self.meta) > 0:
-            tries = 3  # XXX: magic number. Should derive from k & m 
-            logger.info(self.ctx("requesting %d more blocks" % tries))
-            return self._getSomeBlocks(tries) 
-        else:
-            logger.info(self.ctx("couldn't decode file after retreiving"
-                    " all %d available blocks" % self.numBlocksRetrieved))
-            #return False
-            raise RuntimeError("couldn't decode file after retreiving all"
-                    " %d available blocks" % self.numBlocksRetrieved)
-
     def _decodeData(self):
         logger.debug(self.ctx("_decodeData"))
         self.fname = os.path.join(self.parentcodedir,fencode(self.sK))+".rec1"
@@ -1179,8 +1309,8 @@ if __name__ == "__main__":
         # delete any metadata that might exist for this file.
         try:
             SK = fileKey(fname)
-            os.remove(os.path.join(n.config.kstoredir,SK))
-            logger.info("test removed %s" % os.path.join(n.config.kstoredir,SK))
+            n.config.kstore.delete(SK)
+            logger.info("test removed %s from kstore" % SK)
         except:
             pass
     
@@ -58,6 +58,7 @@ class CmdClientFactory(LocalClientFactory):
                 " passphrase emailaddress"
         helpDict['node'] = "list known nodes"
         helpDict['buck'] = "print k buckets"
+        helpDict['queu'] = "show outgoing request queue stats"
         helpDict['stat'] = "show pending actions"
         helpDict['stor'] = "store a block to a given node:"\
                 " 'stor host:port,fname'"
@@ -120,6 +121,9 @@ class CmdClientFactory(LocalClientFactory):
         elif commandkey == 'buck':
             # show k-buckets
             self.callFactory(self.sendDIAGBKTS, commands, self.msgs)
+        elif commandkey == 'queu':
+            # show outgoing request queue depths and wait times
+            self.callFactory(self.sendDIAGQUEU, commands, self.msgs)
         elif commandkey == 'stat':
             # show pending actions
             print self.pending
@@ -11,11 +11,15 @@ from twisted.internet import reactor, defer
 import threading, signal, sys, time, os, random, logging
 
 from flud.FludConfig import FludConfig
+from flud.FludCrypto import keyCacheStats
+from flud.protocol.PeerStats import peers
+from flud.FludkMaintenance import LivenessProber, Republisher, \
+        BucketRefresher
 from flud.protocol.FludServer import FludServer
 from flud.protocol.FludClient import FludClient
-from flud.protocol.FludCommUtil import getCanonicalIP
+from flud.protocol.FludCommUtil import getCanonicalIP, warmCanonicalIPs, \
+        resolveCanonicalIP
 
-PINGTIME=60
 SYNCTIME=900
 
 class FludNode(object):
@@ -31,6 +35,10 @@ class FludNode(object):
         self.logger.removeHandler(self.screenhandler)
         self.config.load(serverport=port)
         self.client = FludClient(self)
+        self.prober = LivenessProber(self)
+        self.republisher = Republisher(self)
+        self.refresher = BucketRefresher(self)
+        self.datagram = None   # the DHT datagram transport, once listening
         self.DHTtstamp = time.time()+10
 
     def _initLogger(self):
@@ -40,39 +48,26 @@ class FludNode(object):
         logger.addHandler(self.screenhandler)
         self.logger = logger
 
-    def pingRandom(self, tstamp):
-        return
-        # XXX: see pg. 4, Section 2.2 (short) or 2.3 (long) of the Kademlia
-        #      paper -- once an hour, each node should check any buckets that
-        #      haven't been refreshed and pick a random id within that space
-        #      to findnode(id) on, for all buckets.
-        if tstamp < self.DHTtstamp: 
-            #r = random.randrange(2**256)
-            n = self.config.routing.knownExternalNodes()
-            if len(n) > 2:
-                n1 = random.choice(n)[2]
-                n2 = random.choice(n)[2]
-                r = (n1+n2)/2
-            else:
-                r = random.randrange(2**256)
-            def badNode(error):
-                node.logger.warn("Couldn't ping %s:%s" % 
-                        (sys.argv[1], sys.argv[2]))
-            d = self.client.kFindNode(r)
-            d.addErrback(badNode)
-        pingtime = random.randrange(PINGTIME/2, PINGTIME)
-        reactor.callLater(pingtime, self.pingRandom, time.time())
-
     def syncConfig(self):
         self.config.save()
+        self.config.kstore.sync()
+        self.config.contacts.sync()
+        self.logger.info("public key cache: %(size)d keys, %(hits)d hits,"
+                " %(misses)d misses" % keyCacheStats())
+        self.logger.info("peer stats: %(peers)d peers, %(tripped)d tripped"
+                % peers.stats())
         reactor.callLater(SYNCTIME, self.syncConfig)
 
     def start(self, twistd=False):
         """ starts the reactor in this thread """
         self.webserver = FludServer(self, self.config.port)
+        self.datagram = self.webserver.datagram
         self.logger.log(logging.INFO, "FludServer starting")
-        reactor.callLater(1, self.pingRandom, time.time())
         reactor.callLater(random.randrange(10), self.syncConfig)
+        warmCanonicalIPs(self.config)
+        self.prober.start()
+        self.republisher.start()
+        self.refresher.start()
         if not twistd: 
             reactor.run()
 
@@ -82,7 +77,12 @@ class FludNode(object):
         signal.signal(signal.SIGINT, signal.SIG_DFL)
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
         self.webserver = FludServer(self, self.config.port)
+        self.datagram = self.webserver.datagram
         self.webserver.start()
+        reactor.callFromThread(warmCanonicalIPs, self.config)
+        reactor.callFromThread(self.prober.start)
+        reactor.callFromThread(self.republisher.start)
+        reactor.callFromThread(self.refresher.start)
         # XXX: need to do save out current config every X seconds
         # XXX: need to seperate known_nodes from config, and then update this
         # every X seconds.  only update config when it changes.
@@ -106,28 +106,12 @@ class FludNode(object):
                 print "flud node connected and listening on port %d"\
                         % self.config.port
             
-            #print "found knodes %s" % knodes
-            dlist = []
-            for bucket in self.config.routing.kBuckets:
-                #if True:
-                if bucket.begin <= self.config.routing.node[2] < bucket.end:
-                    pass
-                    #print "passed on bucket %x-%s" % (bucket.begin, bucket.end)
-                else:
-                    refreshID = random.randrange(bucket.begin, bucket.end)
-                    #print "refreshing bucket %x-%x by finding %x" \
-                    #       % (bucket.begin, bucket.end, refreshID)
-                    self.logger.info("refreshing bucket %x-%x by finding %x"
-                            % (bucket.begin, bucket.end, refreshID))
-                    deferred = self.client.kFindNode(refreshID)
-                    dlist.append(deferred) 
-            dl = defer.DeferredList(dlist)
-            dl.addCallback(refreshDone)
             # XXX: do we need to ping newly discovered known nodes?  If not,
             #      we could be vulnerable to a poisoning attack (at first
             #      glance, this attack seems rather impotent...)
-            # XXX: need to call refresh about every 60 minutes.  Add a 
-            #      reactor.callLater here to do it.
+            # (after this, self.refresher keeps idle buckets refreshed)
+            dl = self.refresher.refreshAll()
+            dl.addCallback(refreshDone)
             
         def badGW(error):
             self.logger.warn(error)
@@ -135,8 +119,10 @@ class FludNode(object):
                     (sys.argv[1], sys.argv[2]))
 
         self.logger.debug("connectViaGateway %s%d" % (host, port))
-        deferred = self.client.sendkFindNode(host, port, 
-                self.config.routing.node[2])
+        # (so that the gateway goes by its address from the start)
+        deferred = resolveCanonicalIP(host)
+        deferred.addCallback(lambda IP: self.client.sendkFindNode(IP, port,
+                self.config.routing.node[2]))
         deferred.addCallback(refresh)
         deferred.addErrback(badGW)
 
@@ -0,0 +1,104 @@
+"""
+FludPlacement.py (c) 2003-2006 Alen Peacock.  This program is distributed
+under the terms of the GNU General Public License (the GPL), version 3.
+
+Chooses the nodes that a file's blocks are stored to.  A file's blocks are all
+stored at once, so the file is stored when the slowest of them is.  Each block
+goes to the node that would have it (on top of whatever blocks it has already
+been given) stored soonest, going by the round trip times and throughput
+PeerStats has measured.  Nodes that have advertised less free space than a
+block needs, and nodes whose breaker is open, are passed over.  No node gets
+more than its even share of the blocks, so that losing any one node loses as
+few of them as it can.  Among nodes that look equally fast, the one that
+comes first in the list (the one with the better reputation, for lists from
+getPreferredNodes) is preferred.
+
+>>> from flud.protocol.PeerStats import PeerStats
+>>> stats = PeerStats()
+>>> for i in range(4):
+...     stats.sample('fast', 1, 0.1)
+...     stats.sample('slow', 1, 2.0)
+>>> stats.advertised('full', 1, 1000)
+>>> nodes = [('slow', 1, 1), ('full', 1, 2), ('fast', 1, 3), ('new', 1, 4)]
+>>> [n[0] for n in assign(nodes, [4096]*3, stats)]
+['fast', 'new', 'slow']
+>>> [n[0] for n in assign(nodes, [4096]*5, stats)]
+['fast', 'fast', 'new', 'new', 'slow']
+>>> choose(nodes, 4096, stats)[0], choose([], 4096, stats)
+('fast', None)
+"""
+
+import logging
+
+from flud.protocol.PeerStats import peers
+
+logger = logging.getLogger('flud.placement')
+
+def usable(nodes, size, stats=peers):
+    """
+    Returns the nodes that might take a block of size bytes.
+    """
+    result = []
+    for n in nodes:
+        free = stats.free(n[0], n[1])
+        if not stats.tripped(n[0], n[1]) and (free is None or free >= size):
+            result.append(n)
+    return result
+
+def assign(nodes, sizes, stats=peers):
+    """
+    Returns a list with a node (from nodes, a list of node tuples) for each
+    block size in sizes, or an empty list if there are no nodes.  If none of
+    the nodes look usable, they are all used anyway.
+    """
+    candidates = usable(nodes, max(sizes or [0]), stats) or list(nodes)
+    if not candidates or not sizes:
+        return []
+    perNode = (len(sizes)+len(candidates)-1)/len(candidates)
+    busy = [0.0]*len(candidates)    # when each node's blocks will be stored
+    given = [0]*len(candidates)     # how many blocks each node has
+    room = [stats.free(n[0], n[1]) for n in candidates]
+    result = [None]*len(sizes)
+    # biggest blocks first (they're usually all the same size)
+    order = range(len(sizes))
+    order.sort(key=lambda i: -sizes[i])
+    for i in order:
+        size = sizes[i]
+        best = None
+        for j, n in enumerate(candidates):
+            if given[j] >= perNode or (room[j] is not None and room[j] < size):
+                continue
+            done = busy[j]+stats.expected(n[0], n[1], size)
+            if best is None or done < bestdone:
+                best, bestdone = j, done
+        if best is None:
+            # everyone's full (by their own account) or has their share;
+            # spread the rest as evenly as we can
+            best = given.index(min(given))
+            bestdone = busy[best]+stats.expected(candidates[best][0],
+                    candidates[best][1], size)
+        busy[best] = bestdone
+        given[best] += 1
+        if room[best] is not None:
+            room[best] -= size
+        result[i] = candidates[best]
+    logger.debug("placed %d blocks on %d nodes, expect done in %.1fs"
+            % (len(sizes), len([g for g in given if g]), max(busy)))
+    return result
+
+def choose(nodes, size, stats=peers):
+    """
+    Returns the node (from nodes) that should get a single block of size
+    bytes, or None if there are no nodes.
+    """
+    result = assign(nodes, [size], stats)
+    if result:
+        return result[0]
+    return None
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,358 @@
+"""
+FludkMaintenance.py (c) 2003-2006 Alen Peacock.  This program is distributed
+under the terms of the GNU General Public License (the GPL), version 3.
+
+Background upkeep of the DHT layer: its routing table, and the values this
+node holds.
+"""
+
+import logging, random, time
+from collections import deque
+from twisted.internet import reactor, defer
+
+from flud.fencode import fdecode
+import flud.FludkRouting as FludkRouting
+from flud.protocol.ClientDHTPrimitives import SENDkSTOREMULTI
+from flud.protocol.ServerDHTPrimitives import VALUE_TTL
+from flud.protocol.FludCommUtil import lastSeen, NODEUPDATE_TO
+
+logger = logging.getLogger("flud.k.maint")
+
+MAXPROBES = 3        # max number of liveness pings outstanding at once
+PROBEINTERVAL = 300  # seconds between sweeps of the bucket heads
+MAXQUEUEDPROBES = 256
+
+REFRESHINTERVAL = 3600   # refresh buckets with no lookups in this long (secs)
+REFRESHCHECK = 300        # seconds between looks for stale buckets
+MAXREFRESHES = 2          # max number of refresh lookups at once
+
+REPUBLISHINTERVAL = 3600  # republish values not stored in this long (secs)
+REPUBLISHSWEEP = 600      # seconds between looks for values to republish
+MAXREPUBLISH = 256        # max values to republish per sweep
+REPUBLISHRATE = 16*1024   # bytes/sec allowed for republishing
+MAXBATCHBYTES = 256*1024  # max size of one batch of values to one node
+
+class LivenessProber:
+    """
+    Pings the least recently seen contact (the head) of full kBuckets, and
+    evicts those that don't answer, promoting the freshest contact from the
+    routing table's replacement cache in their place (section 2.2 and 4.1 of
+    the kademlia paper).  Probes are queued and run at most MAXPROBES at a
+    time, so inserts into the routing table never wait on them.
+
+    A probe is started by probe(head), typically with the node returned by
+    kRouting.updateNode() when a bucket is full.  Every PROBEINTERVAL seconds,
+    start() also queues the head of each full bucket that has replacements
+    waiting for it.
+    """
+    def __init__(self, node, maxprobes=MAXPROBES, interval=PROBEINTERVAL):
+        self.node = node
+        self.routing = node.config.routing
+        self.maxprobes = maxprobes
+        self.interval = interval
+        self.queued = deque()
+        self.pending = {}   # nodeID -> node, for queued and outstanding probes
+        self.outstanding = 0
+        self.evicted = 0
+        self.sweeper = None
+
+    def start(self):
+        if not self.sweeper:
+            self.sweeper = reactor.callLater(
+                    random.randrange(self.interval/2, self.interval),
+                    self.sweep)
+
+    def stop(self):
+        if self.sweeper and self.sweeper.active():
+            self.sweeper.cancel()
+        self.sweeper = None
+
+    def sweep(self):
+        self.sweeper = None
+        cached = self.routing.replacementCache.nodes()
+        for bucket in self.routing.kBuckets:
+            if len(bucket.contents) < bucket.k:
+                continue
+            for n in cached:
+                if bucket.begin <= n[2] < bucket.end:
+                    self.probe(bucket.contents[0])
+                    break
+        self.start()
+
+    def probe(self, head):
+        """
+        Queues a liveness check of head, a routing table node tuple.
+        """
+        if head[2] == self.routing.node[2] or self.pending.has_key(head[2]):
+            return
+        seen = lastSeen("%064x" % head[2])
+        if seen and time.time()-seen < NODEUPDATE_TO:
+            # it's been heard from since its bucket position was last
+            # updated (updateNode is debounced), so it's alive: just move it
+            # to the tail of its bucket
+            self.routing.updateNode(head)
+            return
+        if len(self.queued) >= MAXQUEUEDPROBES:
+            logger.debug("probe queue full, not probing %x" % head[2])
+            return
+        self.pending[head[2]] = head
+        self.queued.append(head)
+        self._startProbes()
+
+    def _startProbes(self):
+        while self.queued and self.outstanding < self.maxprobes:
+            head = self.queued.popleft()
+            self.outstanding += 1
+            logger.debug("probing %s:%d (%x)" % (head[0], head[1], head[2]))
+            # a successful GETID also calls updateNode, which moves head to the
+            # tail of its bucket
+            d = self.node.client.sendGetID(head[0], head[1])
+            d.addCallback(self._alive, head)
+            d.addErrback(self._dead, head)
+            d.addBoth(self._probeDone, head)
+
+    def _alive(self, nKu, head):
+        if long(nKu.id(), 16) != head[2]:
+            # someone else answers at head's address now
+            self._dead(None, head)
+
+    def _dead(self, err, head):
+        replacer = self.routing.evictNode(head)
+        self.evicted += 1
+        if replacer:
+            logger.info("evicted unresponsive %x, replaced with %x"
+                    % (head[2], replacer[2]))
+        else:
+            logger.info("evicted unresponsive %x" % head[2])
+
+    def _probeDone(self, result, head):
+        self.outstanding -= 1
+        del self.pending[head[2]]
+        self._startProbes()
+
+
+class BucketRefresher:
+    """
+    Refreshes idle kBuckets (section 2.3 of the kademlia paper): a bucket
+    that hasn't had a lookup for an ID in its range in REFRESHINTERVAL
+    seconds gets one, for a random ID in its range.  Stale buckets are looked
+    for every REFRESHCHECK seconds (with jitter, so nodes that joined
+    together don't refresh together), and at most MAXREFRESHES refresh
+    lookups run at once.
+    """
+    def __init__(self, node, interval=REFRESHINTERVAL, 
+            maxrefreshes=MAXREFRESHES):
+        self.node = node
+        self.routing = node.config.routing
+        self.interval = interval
+        self.maxrefreshes = maxrefreshes
+        self.queued = deque()   # (begin, end) of buckets waiting for refresh
+        self.outstanding = 0
+        self.refreshed = 0
+        self.stale = 0
+        self.checker = None
+
+    def start(self):
+        if not self.checker:
+            self.checker = reactor.callLater(
+                    random.uniform(REFRESHCHECK/2, REFRESHCHECK), self.check)
+
+    def stop(self):
+        if self.checker and self.checker.active():
+            self.checker.cancel()
+        self.checker = None
+
+    def check(self):
+        self.checker = None
+        stale = self.routing.staleBuckets(self.interval)
+        self.stale = len(stale)
+        logger.info("%d of %d buckets stale" 
+                % (self.stale, len(self.routing.kBuckets)))
+        if not self.queued and not self.outstanding:
+            for bucket in stale:
+                self.queued.append((bucket.begin, bucket.end))
+            self._startRefreshes()
+        self.start()
+
+    def refreshAll(self, skipOwn=True):
+        """
+        Refreshes every bucket now (e.g., just after joining), except by
+        default the one holding our own ID.  Returns a DeferredList that fires
+        when all the refreshes are done.
+        """
+        me = self.routing.node[2]
+        dlist = []
+        for bucket in self.routing.kBuckets:
+            if skipOwn and bucket.begin <= me < bucket.end:
+                continue
+            dlist.append(self._refresh(bucket.begin, bucket.end))
+        return defer.DeferredList(dlist)
+
+    def stats(self):
+        return {'buckets': len(self.routing.kBuckets), 'stale': self.stale,
+                'queued': len(self.queued), 'refreshing': self.outstanding,
+                'refreshed': self.refreshed}
+
+    def _startRefreshes(self):
+        while self.queued and self.outstanding < self.maxrefreshes:
+            begin, end = self.queued.popleft()
+            self.outstanding += 1
+            d = self._refresh(begin, end)
+            d.addBoth(self._refreshDone)
+
+    def _refresh(self, begin, end):
+        refreshID = random.randrange(begin, end)
+        logger.info("refreshing bucket %x-%x by finding %x" 
+                % (begin, end, refreshID))
+        d = self.node.client.kFindNode(refreshID)
+        d.addCallback(self._refreshed)
+        d.addErrback(lambda err: logger.info("refresh of %x-%x failed: %s"
+            % (begin, end, err.getErrorMessage())))
+        return d
+
+    def _refreshed(self, result):
+        self.refreshed += 1
+        return result
+
+    def _refreshDone(self, result):
+        self.outstanding -= 1
+        self._startRefreshes()
+
+
+class Republisher:
+    """
+    Keeps the values this node holds for the DHT at the k nodes currently
+    closest to their keys (section 2.5 of the kademlia paper).  Every
+    REPUBLISHSWEEP seconds, values that no one has stored here for
+    REPUBLISHINTERVAL are looked up, and sent (batched by destination, at
+    most REPUBLISHRATE bytes/sec, at bulk priority) to the k closest nodes.
+    Any other holder that gets them then skips its own republish of them for
+    the next interval.
+
+    Values expire VALUE_TTL after they were last stored.  Republishing a
+    value refreshes our own copy only while we are still one of the k
+    closest nodes to its key, so values that have moved away age out.
+    """
+    def __init__(self, node, interval=REPUBLISHINTERVAL, rate=REPUBLISHRATE):
+        self.node = node
+        self.kstore = node.config.kstore
+        self.interval = interval
+        self.rate = rate
+        self.batches = deque()   # (host, port, {key: val}, size)
+        self.sending = False
+        self.sweeping = False
+        self.sweeper = None
+        self.republished = 0
+
+    def start(self):
+        if not self.sweeper:
+            self.sweeper = reactor.callLater(
+                    random.randrange(REPUBLISHSWEEP/2, REPUBLISHSWEEP),
+                    self.sweep)
+
+    def stop(self):
+        if self.sweeper and self.sweeper.active():
+            self.sweeper.cancel()
+        self.sweeper = None
+
+    def due(self):
+        """
+        Returns the keys that are due for republishing.
+        """
+        now = time.time()
+        result = []
+        for key in self.kstore.keys():
+            stored = self.kstore.lastStored(key)
+            if stored and now-stored >= self.interval:
+                result.append(key)
+                if len(result) >= MAXREPUBLISH:
+                    break
+        return result
+
+    def sweep(self):
+        self.sweeper = None
+        self.kstore.expire()
+        if self.sweeping or self.sending:
+            # the last sweep is still going
+            self.start()
+            return
+        keys = self.due()
+        if not keys:
+            self.start()
+            return
+        logger.info("republishing %d values" % len(keys))
+        self.sweeping = True
+        dlist = []
+        for key in keys:
+            d = self.node.client.kFindNode(fdecode(key))
+            d.addCallback(lambda r, key: (key, r['k']), key)
+            dlist.append(d)
+        dl = defer.DeferredList(dlist, consumeErrors=True)
+        dl.addCallback(self._plan)
+        dl.addErrback(lambda err: logger.warn("republish failed: %s" % err))
+        dl.addBoth(self._swept)
+
+    def _swept(self, result):
+        self.sweeping = False
+        self.start()
+
+    def _plan(self, results):
+        """
+        Groups the found values by the nodes they go to, and queues them up.
+        """
+        me = self.node.config.routing.node[2]
+        dests = {}
+        for success, result in results:
+            if not success:
+                continue
+            key, closest = result
+            val = self.kstore.get(key)
+            if val == None:
+                continue
+            ids = [n[2] for n in closest]
+            if me in ids or len(ids) < FludkRouting.k:
+                # we're still a rightful holder: keep our own copy alive
+                self.kstore.put(key, val, VALUE_TTL)
+            else:
+                logger.debug("no longer among closest for %s, letting it"
+                        " expire" % key)
+                # (but it's been passed on, so it isn't due again)
+                self.kstore.touch(key)
+            if fdecode(key) != me and not isinstance(fdecode(val), dict):
+                # master CAS records are only taken from their owner
+                continue
+            for n in closest:
+                if n[2] != me:
+                    dests.setdefault((n[0], n[1]), []).append((key, val))
+        for (host, port), vals in dests.items():
+            batch = {}
+            size = 0
+            for key, val in vals:
+                if size+len(key)+len(val) > MAXBATCHBYTES and batch:
+                    self.batches.append((host, port, batch, size))
+                    batch = {}
+                    size = 0
+                batch[fdecode(key)] = fdecode(val)
+                size += len(key)+len(val)
+            self.batches.append((host, port, batch, size))
+        self._sendNext()
+
+    def _sendNext(self, result=None):
+        if not self.batches:
+            self.sending = False
+            return
+        self.sending = True
+        host, port, batch, size = self.batches.popleft()
+        d = SENDkSTOREMULTI(self.node, host, port, batch).deferred
+        d.addCallback(self._sent, host, port, batch)
+        d.addErrback(lambda err: logger.info("couldn't republish to %s:%d"
+            " -- %s" % (host, port, err.getErrorMessage())))
+        # pace the batches so republishing stays within its bandwidth share
+        d.addCallback(lambda r: reactor.callLater(float(size)/self.rate,
+            self._sendNext))
+
+    def _sent(self, failed, host, port, batch):
+        self.republished += len(batch)-len(failed)
+        if failed:
+            logger.info("%s:%d refused %d republished values"
+                    % (host, port, len(failed)))
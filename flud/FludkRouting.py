@@ -12,7 +12,7 @@ more information.
 """
 
 from bisect import *
-import logging
+import logging, time
 
 #k = 5          # This is the max depth of a kBucket
 k = 12          # This is the max depth of a kBucket.  k is generally used as
@@ -25,44 +25,105 @@ logger = logging.getLogger("flud.k")
 
 class NodeCache:
     """
-    An LRU cache for nodes
+    An LRU cache for nodes, holding the contacts we have seen but had no room
+    for in the kBuckets (the 'replacement cache' of section 4.1 of the
+    kademlia paper).  Nodes are kept in a doubly linked list from least to
+    most recently seen, so inserts, lookups, and removals are all O(1).
+
+    >>> c = NodeCache(2)
+    >>> c.insertNode(('1.2.3.4', 34, 1))
+    >>> c.insertNode(('2.2.3.4', 34, 2))
+    >>> c.insertNode(('1.2.3.4', 34, 1))  # seen again, now most recent
+    >>> c.insertNode(('3.2.3.4', 34, 3))
+    2
+    >>> c.nodes()
+    [('1.2.3.4', 34, 1), ('3.2.3.4', 34, 3)]
+    >>> c.getNode(1), c.getNode(2)
+    (('1.2.3.4', 34, 1), None)
+    >>> c.popNode(0, 2)
+    ('1.2.3.4', 34, 1)
+    >>> c.removeNode(('3.2.3.4', 34, 3))
+    >>> c.nodes(), len(c)
+    ([], 0)
     """
     def __init__(self, size):
         self.size = size
-        self.cache = {}
-        self.cacheOrder = []
+        self.cache = {}  # nodeID -> [prev, next, node]
+        self.head = [None, None, None]  # sentinel
+        self.head[0] = self.head[1] = self.head
+
+    def __len__(self):
+        return len(self.cache)
+
+    def _unlink(self, entry):
+        entry[0][1] = entry[1]
+        entry[1][0] = entry[0]
 
     def insertNode(self, node):
         """
-        adds a node to the cache.  if this displaces a node, the displaced node
-        is returned
+        adds a node to the cache (or, if it is already there, updates its
+        contact info and marks it most recently seen).  if this displaces a
+        node, the displaced node's ID is returned
         """
-        if node[2] not in self.cache:
-            self.cache[node[2]] = node
-            self.cacheOrder.append(node[2])
-            if len(self.cacheOrder) > self.size:
-                popped = self.cacheOrder.pop(0)
-                self.cache.pop(popped)
-                return popped
+        entry = self.cache.get(node[2])
+        if entry is not None:
+            self._unlink(entry)
+            entry[2] = node
+        else:
+            entry = [None, None, node]
+            self.cache[node[2]] = entry
+        last = self.head[0]
+        entry[0] = last
+        entry[1] = self.head
+        last[1] = entry
+        self.head[0] = entry
+        if len(self.cache) > self.size:
+            oldest = self.head[1]
+            self._unlink(oldest)
+            del self.cache[oldest[2][2]]
+            return oldest[2][2]
 
     def getNode(self, nodeID):
         """
         returns a node from the cache, or None
         """
-        if nodeID in self.cache:
-            return self.cache[node]
+        entry = self.cache.get(nodeID)
+        if entry is not None:
+            return entry[2]
         return None
     
     def removeNode(self, node):
         """
         removes a node from the cache
         """
-        if node[2] in self.cache:
-            self.cache.pop(node[2])
-            self.cacheOrder.pop(node[2])
+        entry = self.cache.pop(node[2], None)
+        if entry is not None:
+            self._unlink(entry)
+
+    def popNode(self, begin, end):
+        """
+        removes and returns the most recently seen node with an ID in
+        [begin, end), or None if there isn't one.
+        """
+        entry = self.head[0]
+        while entry is not self.head:
+            if begin <= entry[2][2] < end:
+                self._unlink(entry)
+                del self.cache[entry[2][2]]
+                return entry[2]
+            entry = entry[0]
+        return None
 
     def nodes(self):
-        return [self.cache[i] for i in self.cache]
+        """
+        returns the cached nodes, least recently seen first
+        """
+        result = []
+        entry = self.head[1]
+        while entry is not self.head:
+            result.append(entry[2])
+            entry = entry[1]
+        return result
 
 def kCompare(a, b, target):
     """
@@ -83,11 +144,16 @@ def kCompare(a, b, target):
     return int((x - y) / abs(x - y))
 
 
-class kRouting:
+class kRouting(object):
     """
     Contains the kBuckets for this node.  Provides methods for inserting,
     updating, and removing nodes.  Most importantly, performs kademlia-style
     routing by returning the node[s] closest to a particular id.
+
+    The buckets are the leaves of a binary trie on ID prefixes: each bucket
+    covers the IDs sharing its path from the root, so locating the bucket for
+    an ID follows at most one branch per bit.  Only the leaf covering our own
+    ID is ever split, so the trie stays about log2(n/k) deep.
     
     >>> table = kRouting(('1.2.3.4', 34, 123456), 20, 5)
     >>> table.insertNode(('2.2.3.4', 34,  23456))
@@ -96,7 +162,7 @@ class kRouting:
     >>> table.insertNode(('5.2.3.4', 34, 423456))
     >>> table.insertNode(('6.2.3.4', 34, 323456))
     >>> table.kBuckets
-    [{'0-80000': [('1.2.3.4', 34, 123456), ('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456)]}, {'80001-100000': [('4.2.3.4', 34, 723456)]}]
+    [{'0-80000': [('1.2.3.4', 34, 123456), ('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456)]}, {'80000-100000': [('4.2.3.4', 34, 723456)]}]
     >>> table.findNode(23456)
     [('2.2.3.4', 34, 23456), ('1.2.3.4', 34, 123456), ('3.2.3.4', 34, 223456), ('6.2.3.4', 34, 323456), ('5.2.3.4', 34, 423456)]
     >>> table.findNode(55555)
@@ -109,12 +175,16 @@ class kRouting:
     >>> table.insertNode(('10.2.3.4', 34, 763456))
     >>> table.insertNode(('11.2.3.4', 34, 773456))
     ('4.2.3.4', 34, 723456)
-    >>> table.replaceNode(('4.2.3.4', 34, 723456), ('11.2.3.4', 34, 773456))
+    >>> table.insertNode(('12.2.3.4', 34, 783456))
+    ('4.2.3.4', 34, 723456)
+    >>> table.evictNode(('4.2.3.4', 34, 723456))
+    ('12.2.3.4', 34, 783456)
+    >>> table.replaceNode(('12.2.3.4', 34, 783456), ('11.2.3.4', 34, 773456))
     >>> table.kBuckets
-    [{'0-80000': [('1.2.3.4', 34, 123456), ('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456)]}, {'80001-100000': [('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('9.2.3.4', 34, 753456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456)]}]
+    [{'0-80000': [('1.2.3.4', 34, 123456), ('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456)]}, {'80000-100000': [('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('9.2.3.4', 34, 753456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456)]}]
     >>> table.removeNode(('1.2.3.4', 34, 123456))
     >>> table.kBuckets
-    [{'0-80000': [('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456)]}, {'80001-100000': [('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('9.2.3.4', 34, 753456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456)]}]
+    [{'0-80000': [('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456)]}, {'80000-100000': [('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('9.2.3.4', 34, 753456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456)]}]
     >>> table.knownNodes()
     [('2.2.3.4', 34, 23456), ('3.2.3.4', 34, 223456), ('5.2.3.4', 34, 423456), ('6.2.3.4', 34, 323456), ('7.2.3.4', 34, 733456), ('8.2.3.4', 34, 743456), ('9.2.3.4', 34, 753456), ('10.2.3.4', 34, 763456), ('11.2.3.4', 34, 773456)]
     >>> table.knownExternalNodes()
@@ -126,27 +196,43 @@ class kRouting:
         needed to know when to split a bucket).
         """
         self.k = depth
+        self.bits = bits
         self.replacementCache = NodeCache(300)
-        self.kBuckets = [kBucket(0, 2**bits, depth),]
-        #self.kBuckets = [kBucket(0, 1, depth),]
-        #for i in xrange(1,bits):
-        #   self.kBuckets.append(kBucket(2**i, 2**(i+1)-1, depth))
+        self.root = kBranch(kBucket(0, 2**bits, depth))
         self.insertNode(node)
         self.node = node
+
+    def _getBuckets(self):
+        """
+        all the kBuckets, in ID order
+        """
+        buckets = []
+        stack = [self.root]
+        while stack:
+            branch = stack.pop()
+            if branch.bucket != None:
+                buckets.append(branch.bucket)
+            else:
+                stack.append(branch.children[1])
+                stack.append(branch.children[0])
+        return buckets
+    kBuckets = property(_getBuckets)
     
     def insertNode(self, node):
         """
         Inserts a node into the appropriate kBucket.  If the node already
         exists in the appropriate kBucket, it is moved to the tail of the list.
-        If the bucket is full, this method returns the oldest node, which the
-        caller should then ping.  If the oldest node is alive, the caller
-        does nothing.  Otherwise, the caller should call replaceNode.
+        If the bucket is full, node goes into the replacement cache and this
+        method returns the oldest node in the bucket, which the caller should
+        then ping.  If the oldest node is alive, the caller does nothing.
+        Otherwise, the caller should call evictNode (or replaceNode).
         @param node a (ip, port, id) triple, where id is a long.
         """
         if len(node) < 3:
             raise ValueError("node must be a triple (ip, port, id)")
         id = node[2]
-        bucket = self._findBucket(id)
+        branch = self._findBranch(id)
+        bucket = branch.bucket
         try:
             # XXX: need to transfer key/vals that belong to new node?
             bucket.updateNode(node)
@@ -155,7 +241,7 @@ class kRouting:
             if (bucket.begin <= self.node[2] < bucket.end):
                 # bucket is full /and/ the local node is in this bucket, 
                 # split and try adding it again.
-                self._splitBucket(bucket)
+                self._splitBucket(branch)
                 self.insertNode(node)
                 logger.debug("split and added %x" % node[2])
                 return
@@ -167,9 +253,8 @@ class kRouting:
                 # If the old node is not reachable, caller should call 
                 # replaceNode()
                 logger.debug("didn't add %x" % node[2])
+                self.replacementCache.insertNode(node)
                 return bucket.contents[0]
-            logger.debug("didn't add %x" % node[2])
-            return bucket.contents[0]
 
     def removeNode(self, node):
         """
@@ -177,6 +262,7 @@ class kRouting:
         """
         bucket = self._findBucket(node[2])
         bucket.delNode(node)
+        self.replacementCache.removeNode(node)
         
     def replaceNode(self, replacee, replacer):
         """
@@ -187,32 +273,44 @@ class kRouting:
         self.removeNode(replacee)
         self.insertNode(replacer)
 
+    def evictNode(self, node):
+        """
+        Expunges node (which has stopped answering) from its bucket, and
+        promotes the most recently seen contact from the replacement cache
+        that belongs in the same bucket, if any.  Returns the promoted node,
+        or None.
+        """
+        bucket = self._findBucket(node[2])
+        if bucket.findNode(node[2]) != node:
+            # already gone, or has since been seen at a new address
+            return None
+        self.removeNode(node)
+        replacer = self.replacementCache.popNode(bucket.begin, bucket.end)
+        if replacer != None:
+            self.insertNode(replacer)
+        return replacer
+
     def findNode(self, nodeID):
         """
         Returns k closest node triples with which the caller may make
         additional queries.  If nodeID is found, it will be the first result.
         @param nodeID an int
         """
+        # Every ID under the child that agrees with nodeID's next bit is
+        # closer (by XOR) to nodeID than every ID under the other child, so
+        # visiting that child first yields buckets in order of distance.
         nodes = []
-        bucket = self._findBucket(nodeID)
-        #n = bucket.findNode(nodeID)
-        #if n != None: 
-        #   nodes.append(n)
-
-        nodes += bucket.contents
-        if len(nodes) < self.k:
-            nextbucket = self._nextbucket(bucket)
-            prevbucket = self._prevbucket(bucket)
-            while len(nodes) < self.k \
-                    and (nextbucket != None or prevbucket != None):
-                if nextbucket != None:
-                    nodes += nextbucket.contents
-                if prevbucket != None: 
-                    nodes += prevbucket.contents
-                nextbucket = self._nextbucket(nextbucket)
-                prevbucket = self._prevbucket(prevbucket)
-            
-        nodes.sort(lambda a, b, n=nodeID: cmp(n ^ a[2], n ^ b[2]))
+        stack = [(self.root, self.bits-1)]
+        while stack and len(nodes) < self.k:
+            branch, bit = stack.pop()
+            if branch.bucket != None:
+                contents = branch.bucket.contents[:]
+                contents.sort(key=lambda n: nodeID ^ n[2])
+                nodes += contents
+            else:
+                preferred = (nodeID >> bit) & 1
+                stack.append((branch.children[1-preferred], bit-1))
+                stack.append((branch.children[preferred], bit-1))
         return nodes[:self.k]
 
     def getNode(self, nodeID):
@@ -232,10 +330,25 @@ class kRouting:
 
     def updateNode(self, node):
         """
-        Call to update a node, i.e., whenever the node has been recently seen
+        Call to update a node, i.e., whenever the node has been recently seen.
+        Returns the same as insertNode.
         @param node a (ip, port, id) triple, where id is an int.
         """
-        self.insertNode(node)
+        return self.insertNode(node)
+
+    def touchBucket(self, nodeID):
+        """
+        Notes that a lookup for nodeID was just made, which refreshes the
+        bucket it falls in.
+        """
+        self._findBucket(nodeID).lastLookup = time.time()
+
+    def staleBuckets(self, age):
+        """
+        Returns the buckets that haven't had a lookup in the last age seconds.
+        """
+        since = time.time()-age
+        return [b for b in self.kBuckets if b.lastLookup < since]
 
     def knownExternalNodes(self):
         result = []
@@ -254,49 +367,57 @@ class kRouting:
         result += self.replacementCache.nodes()
         return result
 
-    def _nextbucket(self, bucket):
-        if bucket == None:
-            return bucket
-        i = self.kBuckets.index(bucket)+1
-        if i >= len(self.kBuckets):
-            return None
-        return self.kBuckets[i]
-
-    def _prevbucket(self, bucket):
-        if bucket == None:
-            return bucket
-        i = self.kBuckets.index(bucket)-1
-        if i < 0:
-            return None
-        return self.kBuckets[i]
+    def _findBranch(self, i):
+        """
+        returns the leaf of the trie whose bucket would contain i.
+        @param i an int
+        """
+        if i < 0 or i >= 2**self.bits:
+            raise Exception(
+                    "tried to find an ID that is larger than ID space: %s" % i) 
+        branch = self.root
+        bit = self.bits-1
+        while branch.bucket == None:
+            branch = branch.children[(i >> bit) & 1]
+            bit -= 1
+        return branch
 
     def _findBucket(self, i):
         """
         returns the bucket which would contain i.
         @param i an int
         """
-        #print "kBuckets = %s" % str(self.kBuckets)
-        bl = bisect_left(self.kBuckets, i)
-        if bl >= len(self.kBuckets):
-            raise Exception(
-                    "tried to find an ID that is larger than ID space: %s" % i) 
-        return self.kBuckets[bisect_left(self.kBuckets, i)]
+        return self._findBranch(i).bucket
     
-    def _splitBucket(self, bucket):
+    def _splitBucket(self, branch):
         """
         This is called for the special case when the bucket is full and this 
         node is a member of the bucket.  When this occurs, the bucket should
         be split into two new buckets.
         """
-        halfpoint = (bucket.end - bucket.begin) / 2
-        newbucket = kBucket(bucket.end - halfpoint + 1, bucket.end, self.k)
-        self.kBuckets.insert(self.kBuckets.index(bucket.begin) + 1, newbucket)
-        bucket.end -= halfpoint
+        bucket = branch.bucket
+        halfpoint = bucket.begin + (bucket.end - bucket.begin) / 2
+        low = kBucket(bucket.begin, halfpoint, self.k)
+        high = kBucket(halfpoint, bucket.end, self.k)
+        # (contents stay in least- to most-recently seen order)
+        for node in bucket.contents:
+            if node[2] < halfpoint:
+                low.contents.append(node)
+            else:
+                high.contents.append(node)
+        low.lastLookup = high.lastLookup = bucket.lastLookup
+        branch.bucket = None
+        branch.children = (kBranch(low), kBranch(high))
+
 
-        for node in bucket.contents[:]:
-            if node[2] > bucket.end:
-                bucket.delNode(node)
-                newbucket.addNode(node)
+class kBranch:
+    """
+    A node in kRouting's trie: either a leaf holding a kBucket, or an interior
+    node with two children (for the next ID bit being 0 or 1).
+    """
+    def __init__(self, bucket=None):
+        self.bucket = bucket
+        self.children = None
 
 
 class kBucket:
@@ -386,6 +507,7 @@ class kBucket:
         self.begin = begin
         self.end = end
         self.contents = []
+        self.lastLookup = 0  # when we last looked up an ID in this bucket
 
     def __repr__(self):
         return "{'%x-%x': %s}" % (self.begin, self.end, self.contents)
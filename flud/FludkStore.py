@@ -0,0 +1,268 @@
+"""
+FludkStore.py (c) 2003-2006 Alen Peacock.  This program is distributed under
+the terms of the GNU General Public License (the GPL), version 3.
+
+Local storage for the key/value pairs this node holds for the DHT layer.
+Values are appended to a single log file, and an in-memory index maps each
+key to the offset of its latest record, so that stores and lookups cost one
+write or one seek+read, regardless of how many keys there are.  Records that
+have been superseded, deleted, or have expired are dropped when the log is
+compacted.
+
+Each record is a header (key length, value length, expiry time, flags, and
+a crc32 of the key and value) followed by the key and value.  A record only
+enters the index once it has been completely written, and a torn or corrupt
+record at the tail of the log (from a crash mid-write) is discarded when the
+log is next opened, so every update is all-or-nothing.
+"""
+
+import os, struct, time, logging, zlib
+
+logger = logging.getLogger("flud.kstore")
+
+LOGNAME = "kstore.log"
+HEADER = struct.Struct(">IIdBi")  # keylen, vallen, expires, flags, crc
+DELETED = 1
+COMPACTMIN = 1024*1024  # don't compact until this many bytes are garbage
+
+class kStore:
+    """
+    An append-only log of DHT values, with an in-memory index.
+
+    >>> import tempfile, shutil
+    >>> d = tempfile.mkdtemp()
+    >>> s = kStore(d)
+    >>> s.put('a', 'apple')
+    >>> s.put('b', 'banana', ttl=-1)   # already expired
+    >>> s.get('a'), s.get('b'), s.has_key('b')
+    ('apple', None, False)
+    >>> s.update('a', lambda old: old+' pie')
+    'apple pie'
+    >>> s.update('c', lambda old: old or 'cherry')
+    'cherry'
+    >>> s.delete('c')
+    >>> s.stored['a'] -= 60
+    >>> s.touch('a')
+    >>> time.time()-s.lastStored('a') < 60
+    True
+    >>> s.close()
+    >>> s = kStore(d)
+    >>> s.keys(), s.get('a')
+    (['a'], 'apple pie')
+    >>> s.compact()
+    >>> s.get('a'), s.garbage
+    ('apple pie', 0)
+    >>> s.close(); shutil.rmtree(d)
+    """
+    def __init__(self, dir, compactmin=COMPACTMIN):
+        self.dir = dir
+        self.logname = os.path.join(dir, LOGNAME)
+        self.compactmin = compactmin
+        self.index = {}    # key -> (value offset, value length, expires)
+        self.stored = {}   # key -> when it was last stored (since startup)
+        self.garbage = 0   # bytes in the log taken up by dead records
+        if not os.path.exists(self.logname):
+            open(self.logname, "wb").close()
+            os.chmod(self.logname, 0600)
+        self.log = open(self.logname, "r+b")
+        self._load()
+        self._importFiles()
+
+    def _load(self):
+        """
+        Builds the index by scanning the log, and truncates any partial
+        record left at its end.
+        """
+        offset = 0
+        now = time.time()
+        while True:
+            self.log.seek(offset)
+            header = self.log.read(HEADER.size)
+            if not header:
+                break
+            if len(header) < HEADER.size:
+                self._truncate(offset)
+                break
+            keylen, vallen, expires, flags, crc = HEADER.unpack(header)
+            data = self.log.read(keylen+vallen)
+            if len(data) < keylen+vallen or zlib.crc32(data) != crc:
+                self._truncate(offset)
+                break
+            key = data[:keylen]
+            self._retire(key)
+            if flags & DELETED:
+                self.garbage += HEADER.size+keylen
+            else:
+                self.index[key] = (offset+HEADER.size+keylen, vallen, expires)
+                self.stored[key] = now
+            offset += HEADER.size+keylen+vallen
+        self.end = offset
+
+    def _truncate(self, offset):
+        logger.warn("discarding partial record at offset %d of %s"
+                % (offset, self.logname))
+        self.log.truncate(offset)
+
+    def _importFiles(self):
+        """
+        Moves values stored as one file per key (the old kstoredir layout)
+        into the log.
+        """
+        for fname in os.listdir(self.dir):
+            path = os.path.join(self.dir, fname)
+            if fname == LOGNAME or not os.path.isfile(path):
+                continue
+            f = open(path, "rb")
+            val = f.read()
+            f.close()
+            if not self.index.has_key(fname):
+                self.put(fname, val)
+            os.remove(path)
+            logger.info("imported %s into %s" % (fname, self.logname))
+
+    def _retire(self, key):
+        # the record currently indexed for key becomes garbage
+        if self.index.has_key(key):
+            offset, vallen, expires = self.index.pop(key)
+            del self.stored[key]
+            self.garbage += HEADER.size+len(key)+vallen
+
+    def _append(self, key, val, expires, flags):
+        data = key+val
+        record = HEADER.pack(len(key), len(val), expires, flags,
+                zlib.crc32(data))+data
+        self.log.seek(self.end)
+        self.log.write(record)
+        self.log.flush()
+        offset = self.end+HEADER.size+len(key)
+        self.end += len(record)
+        return offset
+
+    def put(self, key, val, ttl=None):
+        """
+        Stores val (a string) under key (a string), to expire after ttl
+        seconds (or never, if ttl is None).
+        """
+        if ttl is None:
+            expires = 0
+        else:
+            expires = time.time()+ttl
+        offset = self._append(key, val, expires, 0)
+        self._retire(key)
+        self.index[key] = (offset, len(val), expires)
+        self.stored[key] = time.time()
+
+    def get(self, key, default=None):
+        entry = self.index.get(key)
+        if entry is None:
+            return default
+        offset, vallen, expires = entry
+        if expires and expires < time.time():
+            self.delete(key)
+            return default
+        self.log.seek(offset)
+        return self.log.read(vallen)
+
+    def lastStored(self, key):
+        """
+        Returns the time key was last stored, or None.  Keys loaded from disk
+        count as stored when the log was opened.
+        """
+        return self.stored.get(key)
+
+    def touch(self, key):
+        """
+        Counts key as just stored (for lastStored()), without changing when
+        it expires.
+        """
+        if self.index.has_key(key):
+            self.stored[key] = time.time()
+
+    def has_key(self, key):
+        entry = self.index.get(key)
+        return entry is not None and not (entry[2] and entry[2] < time.time())
+
+    def update(self, key, merge, ttl=None):
+        """
+        Replaces the value under key with merge(oldvalue) (where oldvalue is
+        None if there wasn't one), and returns the new value.  Since the new
+        value is written as a single record, readers see either the old value
+        or the merged one, never a mix.
+        """
+        val = merge(self.get(key))
+        self.put(key, val, ttl)
+        return val
+
+    def delete(self, key):
+        if self.index.has_key(key):
+            self._append(key, "", 0, DELETED)
+            self._retire(key)
+            self.garbage += HEADER.size+len(key)
+
+    def keys(self):
+        return [k for k in self.index if self.has_key(k)]
+
+    def __len__(self):
+        return len(self.index)
+
+    def expire(self):
+        """
+        Drops all expired values.
+        """
+        now = time.time()
+        for key, (offset, vallen, expires) in self.index.items():
+            if expires and expires < now:
+                self.delete(key)
+
+    def compact(self):
+        """
+        Rewrites the log with only the live records, and atomically replaces
+        the old log with it.
+        """
+        now = time.time()
+        tmpname = self.logname+".compact"
+        tmp = open(tmpname, "wb")
+        index = {}
+        end = 0
+        for key, (offset, vallen, expires) in self.index.items():
+            if expires and expires < now:
+                del self.stored[key]
+                continue
+            self.log.seek(offset)
+            val = self.log.read(vallen)
+            data = key+val
+            tmp.write(HEADER.pack(len(key), vallen, expires, 0,
+                zlib.crc32(data))+data)
+            index[key] = (end+HEADER.size+len(key), vallen, expires)
+            end += HEADER.size+len(data)
+        tmp.flush()
+        os.fsync(tmp.fileno())
+        tmp.close()
+        os.chmod(tmpname, 0600)
+        self.log.close()
+        os.rename(tmpname, self.logname)
+        self.log = open(self.logname, "r+b")
+        logger.info("compacted %s from %d to %d bytes"
+                % (self.logname, self.end, end))
+        self.index = index
+        self.end = end
+        self.garbage = 0
+
+    def sync(self):
+        """
+        Periodic upkeep: expires old values, and compacts the log once more
+        than half of it (and at least compactmin bytes) is garbage.
+        """
+        self.expire()
+        if self.garbage > self.compactmin and self.garbage*2 > self.end:
+            self.compact()
+
+    def close(self):
+        self.log.close()
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -72,8 +72,22 @@ class HTTPMultipartDownloader(client.HTTPDownloader):
         self.inSubHeader = True
         self.file = None
         self.boundary = None
+        self.partial = ""  # subheader bytes held until the header completes
+        self.skip = 0      # bytes of the CRLF trailing a part not yet seen
 
     def getSubHeader(self, data):
+        if self.skip:
+            skipped = data[:self.skip]
+            data = data[self.skip:]
+            self.skip -= len(skipped)
+        data = self.partial+data
+        self.partial = ""
+        if data.find('\r\n') == -1:
+            # haven't seen the whole boundary line yet (responses with many
+            # parts can split a subheader across reads)
+            self.partial = data
+            return
+        rawdata = data
         newboundary = data[:data.find('\r\n')]
         data = data[len(newboundary)+2:]
         if not self.boundary:
@@ -88,7 +102,10 @@ class HTTPMultipartDownloader(client.HTTPDownloader):
                 #raise ValueError, "found illegal boundary: %s, was %s" \
                 #       % (newboundary[:80], self.boundary)
         headerEnd = data.find('\r\n\r\n')
-        if headerEnd != -1:
+        if headerEnd == -1:
+            self.partial = rawdata
+            return
+        else:
             self.inSubHeader = False
             self.subHeaders = {}
             headers = data[:headerEnd].split('\r\n')
@@ -126,7 +143,8 @@ class HTTPMultipartDownloader(client.HTTPDownloader):
                     self.file.close()
                     self.file = None
                     self.inSubHeader = True
-                    self.getSubHeader(data[skipto+2:])
+                    self.skip = 2
+                    self.getSubHeader(data[skipto:])
             except IOError:
                 #raise
                 self.file = None
@@ -4,7 +4,7 @@ under the terms of the GNU General Public License (the GPL), version 3.
 
 Primitive client DHT protocol
 """
-import time, os, stat, httplib, sys, random, logging
+import time, os, stat, httplib, sys, random, logging, heapq
 from twisted.web import http, client
 from twisted.internet import reactor, threads, defer
 from twisted.python import failure
@@ -16,11 +16,17 @@ from flud.fencode import fencode, fdecode
 import flud.FludDefer as FludDefer
 
 import ConnectionQueue
+import WireCodec
 from ClientPrimitives import REQUEST
 from FludCommUtil import *
 
 logger = logging.getLogger("flud.client.dht")
 
+WRITEQUORUM = 3     # kStore succeeds once this many of the k closest have it
+READQUORUM = 2      # kFindValue returns once this many nodes agree on a value
+CACHE_TTL = 3600    # path cache lifetime at the closest node without a value
+CACHE_MINTTL = 60   # don't bother caching for less time than this
+
 # FUTURE: check flud protocol version for backwards compatibility
 # XXX: need to make sure we have appropriate timeouts for all comms.
 # FUTURE: DOS attacks.  For now, assume that network hardware can filter these 
@@ -44,49 +50,44 @@ given a key or key/value pair.  They use the second set of classes (those
 beginning with 'SEND'), which perform a single query to a given node.
 """
 
-def serviceWaiting(res, key, pending, waiting):
-    # provides a method for calling multiple callbacks on a saved query.
-    # add serviceWaiting as a callback before returning, and pass in the result,
-    # pending dict and waiting dict.  All deferreds in the waiting dict will
-    # be called with the result, the waiting dict will be emptied of those
-    # deferreds, and the pending dict will likewise be emptied.
-    if waiting.has_key(key):
-        for d in waiting[key]:
-            #print "offbacking %s" % key
-            d.callback(res)
-        waiting.pop(key)
-    pending.pop(key)
-    return res
-    
-pendingkFindNodes = {}
-waitingkFindNodes = {}
-
 class kFindNode:
     """
     Perform a kfindnode lookup.
+
+    The lookup is iterative and event-driven: up to FludkRouting.a queries are
+    outstanding at any time, and as soon as one of them is answered (or fails)
+    the closest candidate not yet queried takes its place.  Candidates wait in
+    a heap ordered by XOR distance to the key.  A candidate is only worth
+    querying while fewer than k nodes closer to the key have answered, and the
+    lookup has converged once no candidate is worth querying and nothing is
+    outstanding.  The k closest live nodes learned of are returned.
     """
     def __init__(self, node, key):
-        if pendingkFindNodes.has_key(key):
-            d = defer.Deferred()
-            if not waitingkFindNodes.has_key(key):
-                waitingkFindNodes[key] = []
-            waitingkFindNodes[key].append(d)
-            logger.debug("piggybacking on previous kfindnode for %s" % key)
-            self.deferred = d
-            return
-        
         self.node = node
         self.node.DHTtstamp = time.time()
+        self.node.config.routing.touchBucket(key)
         self.key = key
-        self.queried = {}
-        self.outstanding = []
-        self.pending = []
-        self.kclosest = []
+        self.contacts = {}     # id -> (host, port, id) of every node learned of
+        self.hops = {}         # id -> hops from us at which it was learned
+        self.shortlist = []    # heap of (distance, id), not yet queried
+        self.outstanding = {}  # id -> time the query was sent
+        self.queried = {}      # id -> (host, port), for nodes that answered
+        self.failed = {}       # id -> (host, port), for nodes that didn't
+        self.closest = []      # heap of -distance, k closest nodes answering
+        self.done = False      # set to stop making new queries
+        self.finished = False
+        self.numqueries = 0
+        self.rtt = 0.0         # total time spent waiting on answers
+        self.starttime = time.time()
         self.abbrvkey = ("%x" % key)[:8]+"..."
         self.abbrv = "(%s%s)" % (self.abbrvkey, str(self.node.DHTtstamp)[-7:])
         self.debugpath = []
 
-        self.deferred = self.startQuery(key)
+        self.deferred = defer.Deferred()
+        try:
+            self.startQuery(key)
+        except:
+            self._finish(failure.Failure())
 
     def startQuery(self, key):
         # query self first
@@ -94,156 +95,154 @@ class kFindNode:
         #logger.debug("local kclosest: %s" % kclosest)
         localhost = getCanonicalIP('localhost')
         kd = {'id': self.node.config.nodeID, 'k': kclosest}
-        d = self.updateLists(kd, key, localhost, self.node.config.port,
-                long(self.node.config.nodeID, 16))
-        d.addErrback(self.errkfindnode, key, localhost, self.node.config.port)
-        pendingkFindNodes[key] = d
-        d.addCallback(serviceWaiting, key, pendingkFindNodes, waitingkFindNodes)
-        return d
+        nodeID = long(self.node.config.nodeID, 16)
+        self.hops[nodeID] = 0
+        self.outstanding[nodeID] = time.time()
+        self.updateLists(kd, key, localhost, self.node.config.port, nodeID)
     
     def sendQuery(self, host, port, id, key):
-        self.outstanding.append((host, port, id))
         #d = self.node.client.sendkFindNode(host, port, key)
         d = SENDkFINDNODE(self.node, host, port, key).deferred
         return d
 
-    def updateLists(self, response, key, host, port, closestyet, x=0):
+    def _query(self, host, port, id, key):
+        self.debugpath.append("FN:  querying %s:%d" % (host, port))
+        self.outstanding[id] = time.time()
+        self.numqueries += 1
+        d = self.sendQuery(host, port, id, key)
+        d.addCallback(self.updateLists, key, host, port, id)
+        d.addErrback(self._queryFailed, key, host, port, id)
+
+    def updateLists(self, response, key, host, port, id):
+        if self.finished:
+            return
         logger.info("FN: received kfindnode %s response from %s:%d" 
                 % (self.abbrv, host, port))
         self.debugpath.append("FN: rec. resp from %s:%d" % (host, port))
+        sent = self.outstanding.pop(id, None)
+        if sent:
+            self.rtt += time.time()-sent
         if not isinstance(response, dict):
             # a data value is being returned from findval
-            # XXX: moved this bit into findval and call parent for the rest
-            if response == None:
-                logger.warn("got None from key=%s, %s:%d, x=%d, this usually"
-                        " means that the host replied None to a findval query" 
-                        % (key, host, port, x))
-            # if we found the fencoded value data, return it
-            return defer.succeed(response)
+            return self.gotValue(response, key, host, port, id)
         logger.debug("updateLists(%s)" % response)
+        self.queried[id] = (host, port)
+        if self.contacts.has_key(id):
+            self._answered(id, key)
+        hop = self.hops.get(id, 0)+1
         if len(response['k']) == 1 and response['k'][0][2] == key:
             # if we've found the key, don't keep making queries.
             logger.debug("FN: %s:%d found key %s" % (host, port, key))
             self.debugpath.append("FN: %s:%d found key %s" % (host, port, key))
-            if response['k'][0] not in self.kclosest:
-                self.kclosest.insert(0,response['k'][0])
-                self.kclosest = self.kclosest[:FludkRouting.k]
-            return defer.succeed(response)
-
-        #for i in response['k']:
-        #   print "   res: %s:%d" % (i[0], i[1])
-        id = long(response['id'], 16)
-        responder = (host, port, id)
-        if responder in self.outstanding:
-            self.outstanding.remove(responder)
-        self.queried[id] = (host, port)
-
-        knodes = response['k']
-        for n in knodes:
-            if not self.queried.has_key(n[2])\
-                    and not n in self.pending and not n in self.outstanding:
-                self.pending.append((n[0], n[1], n[2]))
-            if n not in self.kclosest:
-                k = FludkRouting.k
-                # XXX: remove self it in the list?
-                self.kclosest.append(n)
-                self.kclosest.sort(
-                        lambda a, b: FludkRouting.kCompare(a[2], b[2], key))
-                self.kclosest = self.kclosest[:k]
-
-        #for n in self.outstanding:
-        #   if n in self.pending:
-        #       self.pending.remove(n) # remove anyone we've sent queries to...
-        self.pending = list(set(self.pending) - set(self.outstanding))
-        for i in self.queried:
-            n = (self.queried[i][0], self.queried[i][1], i)
-            if n in self.pending:
-                self.pending.remove(n) # ...and anyone who has responded.
-        
-        self.pending.sort(lambda a, b: FludkRouting.kCompare(a[2], b[2], key))
-
-        #print "queried: %s" % str(self.queried)
-        #print "outstanding: %s" % str(self.outstanding)
-        #print "pending: %s" % str(self.pending)
-
-        return self.decideToContinue(response, key, x)
-
-    def decideToContinue(self, response, key, x):
-        ##print "x is %s" % str(x)
-        ##for i in self.kclosest:
-        ##  print "       kclosest %s" % str(i)
-        ##for i in self.queried:
-        ##  print "       queried %s" % str(self.queried[i])
-        #if len(filter(lambda x: x not in self.queried, self.kclosest)) <= 0:
-        #   print "finishing up at round %d" % x
-        #   # XXX: never gets in here...
-        #   # XXX: remove anything not in self.kclosest from self.pending
-        #   self.pending =\
-        #           filter(lambda x: x not in self.kclosest, self.pending)
-        #   #self.pending = self.pending[:FludkRouting.k]
-        #else:
-        #   return self.makeQueries(key, x)
+            self._learn(response['k'][0], key, hop)
+            self.done = True
+        else:
+            for n in response['k']:
+                self._learn(n, key, hop)
+        return self.decideToContinue(response, key)
 
+    def _learn(self, n, key, hop):
+        id = n[2]
+        if self.contacts.has_key(id):
+            return
+        self.contacts[id] = (n[0], n[1], id)
+        self.hops[id] = hop
+        if self.queried.has_key(id):
+            # (we learned of ourselves, or of a node that already answered)
+            self._answered(id, key)
+        elif not self.failed.has_key(id) and not self.outstanding.has_key(id):
+            heapq.heappush(self.shortlist, (id ^ key, id))
+
+    def _answered(self, id, key):
+        heapq.heappush(self.closest, -(id ^ key))
+        if len(self.closest) > FludkRouting.k:
+            heapq.heappop(self.closest)
+
+    def _worthQuerying(self, distance):
+        return len(self.closest) < FludkRouting.k \
+                or distance < -self.closest[0]
+
+    def gotValue(self, response, key, host, port, id):
+        # kFindValue overrides this; a plain node lookup shouldn't get data
+        logger.warn("got %s from key=%s, %s:%d in kfindnode, ignoring"
+                % (type(response), key, host, port))
+        self.failed[id] = (host, port)
+        return self.makeQueries(key)
+
+    def decideToContinue(self, response, key):
         # this is here so that kFindVal can plug-in by overriding
-        return self.makeQueries(key, x)
+        return self.makeQueries(key)
     
-    def makeQueries(self, key, x):
-        #print "doing round %d" % x
-        self.debugpath.append("FN: doing round %d" % x)
-        dlist = []
-        for n in self.pending[:(FludkRouting.a - len(self.outstanding))]:
-            #print "  querying %s:%d" % (n[0], n[1])
-            self.debugpath.append("FN:  querying %s:%d" % (n[0], n[1]))
-            d = self.sendQuery(n[0], n[1], n[2], key)
-            d.addCallback(self.updateLists, key, n[0], n[1], 
-                    self.kclosest[0][2], x+1)
-            d.addErrback(self.errkfindnode, key, n[0], n[1], 
-                    raiseException=False)
-            dlist.append(d)
-        dl = defer.DeferredList(dlist)
-        dl.addCallback(self.roundDone, key, x)
-        return dl
-
-    def roundDone(self, responses, key, x):
-        #print "done %d:" % x
-        #print "roundDone: %s" % responses
-        if len(self.pending) != 0 or len(self.outstanding) != 0: 
-            # should only get here for nodes that don't accept connections
-            # XXX: updatenode -- decrease trust
-            for i in self.pending:
-                logger.debug("FN: %s couldn't contact node %s (%s:%d)" 
-                        % (self.abbrv, fencode(i[2]), i[0], i[1]))
-                self.debugpath.append(
-                        "FN: %s couldn't contact node %s (%s:%d)" 
-                        % (self.abbrv, fencode(i[2]), i[0], i[1]))
-                for n in self.kclosest:
-                    if (n[0],n[1],n[2]) == i:
-                        self.kclosest.remove(n)
-        
-        logger.info("kFindNode %s terminated successfully after %d queries." 
-                % (self.abbrv, len(self.queried)))
-        self.debugpath.append("FN: %s terminated successfully after %d queries."
-                % (self.abbrv, len(self.queried)))
-        self.kclosest.sort(
-                lambda a, b: FludkRouting.kCompare(a[2], b[2], key))
+    def makeQueries(self, key):
+        """
+        Tops the outstanding queries back up to alpha, or finishes the lookup
+        if it has converged.
+        """
+        while not self.done and self.shortlist \
+                and len(self.outstanding) < FludkRouting.a:
+            distance, id = self.shortlist[0]
+            if not self._worthQuerying(distance):
+                # everything left is further away than the k closest that
+                # have answered
+                self.shortlist = []
+                break
+            heapq.heappop(self.shortlist)
+            if self.queried.has_key(id) or self.failed.has_key(id) \
+                    or self.outstanding.has_key(id):
+                continue
+            host, port, id = self.contacts[id]
+            self._query(host, port, id, key)
+        if not self.outstanding and not self.finished:
+            try:
+                result = self.lookupDone(key)
+            except:
+                result = failure.Failure()
+            self._finish(result)
+
+    def _queryFailed(self, err, key, host, port, id):
+        if self.finished:
+            return
+        self.outstanding.pop(id, None)
+        self.failed[id] = (host, port)
+        # should only get here for nodes that don't accept connections
+        # XXX: updatenode -- decrease trust
+        self.errkfindnode(err, key, host, port, raiseException=False)
+        self.debugpath.append("FN: %s couldn't contact node %s (%s:%d)" 
+                % (self.abbrv, fencode(id), host, port))
+        return self.makeQueries(key)
+
+    def _finish(self, result):
+        self.finished = True
+        self.latency = time.time()-self.starttime
+        self.deferred.callback(result)
+
+    def _hopCount(self, nodes):
+        """
+        Returns the hops it took to learn of the closest of nodes, and the most
+        hops taken to learn of any of them.
+        """
+        if not nodes:
+            return 0, 0
+        hops = [self.hops.get(n[2], 0) for n in nodes]
+        return hops[0], max(hops)
+
+    def lookupDone(self, key):
+        closest = [self.contacts[i] for i in self.contacts 
+                if not self.failed.has_key(i)]
+        closest = heapq.nsmallest(FludkRouting.k, closest,
+                key=lambda n: n[2] ^ key)
+        hops, maxhops = self._hopCount(closest)
+        elapsed = time.time()-self.starttime
+        logger.info("kFindNode %s converged after %d queries (%d failed) in"
+                " %.3fs, %d hops (max %d)" % (self.abbrv, self.numqueries,
+                    len(self.failed), elapsed, hops, maxhops))
+        self.debugpath.append("FN: %s terminated successfully after %d"
+                " queries." % (self.abbrv, self.numqueries))
+        if self.numqueries:
+            logger.debug("kFindNode %s mean query time %.3fs" 
+                    % (self.abbrv, self.rtt/self.numqueries))
         result = {}
-        if FludkRouting.k > len(self.kclosest):
-            k = len(self.kclosest)
-        else:
-            k = FludkRouting.k
-        result['k'] = self.kclosest[:k]
-        #print "result: %s" % result
-        #if len(result['k']) > 1:
-        #   # if the results (aggregated from multiple responses) contains the
-        #   # exact key, just return the correct answer (successful node 
-        #   # lookup done).
-        #   #print "len(result): %d" % len(result['k'])
-        #   #print "result[0][2]: %s %d" % (type(result['k'][0][2]), 
-        #   #   result['k'][0][2])
-        #   #print "         key: %s %d" % (type(key), key)
-        #   if result['k'][0][2] == key:
-        #       #print "key matched!"
-        #       result['k'] = (result['k'][0],)
+        result['k'] = closest
         return result
 
     def errkfindnode(self, failure, key, host, port, raiseException=True):
@@ -256,14 +255,17 @@ class kFindNode:
 
 class kStore(kFindNode):
     """
-    Perform a kStore operation.
+    Perform a kStore operation.  The value is sent to each of the k closest
+    nodes, and the kStore succeeds as soon as 'quorum' of them have stored
+    it; the rest of the stores finish in the background.
     """
 
-    def __init__(self, node, key, val):
+    def __init__(self, node, key, val, quorum=WRITEQUORUM):
         self.node = node
         self.node.DHTtstamp = time.time()
         self.key = key
         self.val = val
+        self.quorum = quorum
         d = kFindNode(node,key).deferred
         d.addCallback(self.store)
         d.addErrback(self._kStoreErr, None, 0)
@@ -281,7 +283,7 @@ class kStore(kFindNode):
                     self.val).deferred
             deferred.addErrback(self._kStoreErr, host, port)
             dlist.append(deferred)
-        dl = FludDefer.ErrDeferredList(dlist)
+        dl = FludDefer.QuorumDeferredList(dlist, min(self.quorum, len(dlist)))
         dl.addCallback(self._kStoreFinished)
         dl.addErrback(self._kStoreErr, None, 0)
         return dl
@@ -301,11 +303,20 @@ class kStore(kFindNode):
 
 class kFindValue(kFindNode):
     """
-    Perform a kFindValue.
+    Perform a kFindValue.  This is a kFindNode lookup that returns as soon as
+    'quorum' nodes holding the key have returned the same value.  If that
+    never happens, the lookup runs until it converges, and returns the value
+    most of the holders agreed on (or, if only path caches answered, most of
+    the caches).
     """
 
-    def __init__(self, node, key):
-        self.done = False
+    def __init__(self, node, key, quorum=READQUORUM):
+        self.quorum = quorum
+        self.values = {}        # value -> count, from authoritative copies
+        self.cachedValues = {}  # value -> count, from path caches
+        self.cacheable = {}     # values that may be cached along the path
+        self.kinds = {}         # id -> kind of answer given (Fludvalue)
+        self.holders = {}       # id -> value, for nodes that had the value
         kFindNode.__init__(self, node, key)
 
     def startQuery(self, key):
@@ -313,87 +324,128 @@ class kFindValue(kFindNode):
         # we don't just return the closest nodeID, but the value itself (if
         # present)
         localhost = getCanonicalIP('localhost')
-        d = self.sendQuery(localhost, self.node.config.port, 
-                long(self.node.config.nodeID, 16), key)
-        d.addCallback(self.updateLists, key, localhost, self.node.config.port, 
-                long(self.node.config.nodeID, 16), 0)
-        d.addErrback(self.errkfindnode, key, localhost, self.node.config.port)
-        return d
+        nodeID = long(self.node.config.nodeID, 16)
+        self.hops[nodeID] = 0
+        self._query(localhost, self.node.config.port, nodeID, key)
 
     def sendQuery(self, host, port, id, key):
         # We override sendQuery here in order to call sendkFindValue and handle
         # its response
-        self.outstanding.append((host, port, id))
-        d = SENDkFINDVALUE(self.node, host, port, key).deferred
-        d.addCallback(self._handleFindVal, host, port)
-        d.addErrback(self.errkfindnode, key, host, port)
-        return d
+        req = SENDkFINDVALUE(self.node, host, port, key)
+        req.deferred.addCallback(self._noteKind, req, id)
+        return req.deferred
 
-    def _handleFindVal(self, response, host, port):
-        if not isinstance(response, dict):
-            # stop sending out more queries.
-            self.pending = []
-            self.done = True
-            #print "%s:%d sent value: %s" % (host, port, str(response)[:50])
-
-            #f = {}
-            #f['k'] = []
-            #f['id'] = "0"
-            #f['val'] = response # pass on returned value
-            #return f
-        else:
-            pass
-            #print "%s:%d sent kData: %s" % (host, port, response)
+    def _noteKind(self, response, req, id):
+        self.kinds[id] = req.valueKind
         return response
 
-    def decideToContinue(self, response, key, x):
-        if self.done:
-            #if not response.has_key('val'):
-            #   logger.warn("response has no 'val', response is: %s" % response)
-            #return response['val']
-            return response
+    def gotValue(self, response, key, host, port, id):
+        if response == None:
+            logger.warn("got None from key=%s, %s:%d, this usually means"
+                    " that the host replied None to a findval query" 
+                    % (key, host, port))
+            self.failed[id] = (host, port)
         else:
-            return self.makeQueries(key, x)
-    
-    def roundDone(self, responses, key, x):
-        self.debugpath.append("FV: roundDone %d" % x)
-        if self.done:
-            result = {}
-            # see if everyone's responses agreed...
-            for success, resp in responses:
-                # only look at successful non-kData (dict) responses.
-                if success and resp != None and not isinstance(resp, dict):
-                    if result.has_key(resp):
-                        result[resp] += 1
-                    else:
-                        result[resp] = 1
-            if len(result) == 0:
-                # ... if no one responded, XXX: do something orther than None?
-                logger.info("couldn't get any results")
-                return None
-            elif len(result) == 1:
-                # ... if they did, return the result
-                return result.keys()[0]
+            self.queried[id] = (host, port)
+            self._answered(id, key)
+            self.holders[id] = response
+            kind = self.kinds.get(id)
+            if kind == 'cached':
+                tally = self.cachedValues
             else:
-                # ... otherwise, return the result of the majority
-                # (other options include returning all results)
-                logger.info("got conflicting results, determining best...")
-                quorumResult = None
-                bestScore = 0
-                for r in result:
-                    #logger.debug("result %s scored %d" % (r, result[r]))
-                    if result[r] > bestScore:
-                        bestScore = result[r]
-                        quorumResult = r
-                        #logger.debug("result %s is new best" % r)
-                logger.info("returning result %s", fdecode(quorumResult))
-                return quorumResult
+                tally = self.values
+                if kind == 'authoritative':
+                    self.cacheable[response] = True
+            tally[response] = tally.get(response, 0) + 1
+            #print "%s:%d sent value: %s" % (host, port, str(response)[:50])
+            # (cached copies don't count: any node on the path can cache
+            # one, so they're only used if no holder answers at all)
+            if self.values.get(response, 0) >= self.quorum:
+                # enough agreement: don't wait on the outstanding queries
+                self.done = True
+                try:
+                    result = self.lookupDone(key)
+                except:
+                    result = failure.Failure()
+                self._finish(result)
+                return
+        return self.makeQueries(key)
+
+    def lookupDone(self, key):
+        self.debugpath.append("FV: lookupDone")
+        elapsed = time.time()-self.starttime
+        # prefer what the nodes responsible for the key said over caches
+        result = self.values
+        if len(result) == 0:
+            result = self.cachedValues
+        if len(result) == 0:
+            # ... if no one responded, XXX: do something orther than None?
+            logger.info("kFindValue %s couldn't get any results after %d"
+                    " queries in %.3fs" % (self.abbrv, self.numqueries,
+                        elapsed))
+            return None
+        hops = max([self.hops.get(i, 0) for i in self.queried])
+        logger.info("kFindValue %s found value after %d queries in %.3fs,"
+                " %d hops" % (self.abbrv, self.numqueries, elapsed, hops))
+        if len(result) == 1:
+            # ... if they did, return the result
+            quorumResult = result.keys()[0]
+        else:
+            # ... otherwise, return the result of the majority
+            # (other options include returning all results)
+            logger.info("got conflicting results, determining best...")
+            quorumResult = None
+            bestScore = 0
+            for r in result:
+                #logger.debug("result %s scored %d" % (r, result[r]))
+                if result[r] > bestScore:
+                    bestScore = result[r]
+                    quorumResult = r
+                    #logger.debug("result %s is new best" % r)
+            logger.info("returning result %s", fdecode(quorumResult))
+        if self.cacheable.has_key(quorumResult):
+            self.cacheAlongPath(key, quorumResult)
+        return quorumResult
+
+    def cacheAlongPath(self, key, value):
+        """
+        Stores value in the cache of the closest node that answered without
+        it, so that later lookups for key can stop there.  As in the kademlia
+        paper, the cache lifetime halves for every answering node that is
+        closer to the key.
+        """
+        nodeID = long(self.node.config.nodeID, 16)
+        missing = [i for i in self.queried
+                if not self.holders.has_key(i) and i != nodeID]
+        if not missing:
+            return
+        target = min(missing, key=lambda i: i ^ key)
+        distance = target ^ key
+        closer = len([i for i in self.queried if i ^ key < distance])
+        ttl = CACHE_TTL >> closer
+        if ttl < CACHE_MINTTL:
+            return
+        try:
+            value = fdecode(value)
+        except:
+            return
+        if not isinstance(value, dict):
+            # (nodes only path cache metadata, not master CAS records)
+            return
+        host, port = self.queried[target]
+        logger.info("kFindValue %s caching value at %s:%d for %ds"
+                % (self.abbrv, host, port, ttl))
+        d = SENDkSTORE(self.node, host, port, key, value, cachettl=ttl).deferred
+        d.addErrback(lambda err: logger.info("couldn't cache %s at %s:%d"
+            " -- %s" % (self.abbrv, host, port, err.getErrorMessage())))
 
 
 class SENDkFINDNODE(REQUEST):
     """
     Makes one request to a node for its k-closest nodes closest to key
     """
+    priority = ConnectionQueue.DHT
+
     def __init__(self, node, host, port, key, commandName="nodes"):
         """
         """
@@ -411,17 +463,29 @@ class SENDkFINDNODE(REQUEST):
         url += '&port='+str(self.node.config.port)
         self.timeoutcount = 0
         self.deferred = defer.Deferred()
-        ConnectionQueue.enqueue((self, node, host, port, key, url))
+        queued = (self, node, host, port, key, url)
+        dgram = self._datagram()
+        if dgram:
+            d = self._sendDatagram(dgram, node, host, port, key)
+            d.addCallbacks(self.deferred.callback, self._datagramFailed,
+                    errbackArgs=(queued,))
+        else:
+            ConnectionQueue.enqueue(queued)
+
+    def _sendDatagram(self, dgram, node, host, port, key):
+        d = dgram.findNode(host, port, key)
+        d.addCallback(self._gotNodes, node, host, port)
+        return d
 
     def startRequest(self, node, host, port, key, url):
         d = self._sendRequest(node, host, port, key, url)
-        d.addBoth(ConnectionQueue.checkWaiting)
+        d.addBoth(ConnectionQueue.checkWaiting, self)
         d.addCallback(self.deferred.callback)
         d.addErrback(self.deferred.errback)
 
     def _sendRequest(self, node, host, port, key, url):
         factory = getPageFactory(url, 
-                headers=self.headers, timeout=kprimitive_to) 
+                headers=self.headers, timeout=self._timeout()) 
         factory.deferred.addCallback(self._gotResponse, factory,
                 node, host, port, key)
         factory.deferred.addErrback(self._errSendk, factory, node, 
@@ -431,7 +495,11 @@ class SENDkFINDNODE(REQUEST):
     def _gotResponse(self, response, factory, node, host, port, key):
         logger.debug("kfindnode._gotResponse()")
         self._checkStatus(factory.status, response, host, port)
-        response = eval(response)
+        response = WireCodec.parseResponse(response, 
+                WireCodec.responseType(factory))
+        return self._gotNodes(response, node, host, port)
+
+    def _gotNodes(self, response, node, host, port):
         nID = long(response['id'], 16)
         updateNode(node.client, node.config, host, port, None, nID)
         updateNodes(node.client, node.config, response['k'])
@@ -439,19 +507,19 @@ class SENDkFINDNODE(REQUEST):
 
     def _checkStatus(self, status, response, host, port):
         logger.debug("kfindnode._checkStatus()")
-        if eval(status) != http.OK:
+        if int(status) != http.OK:
             raise failure.DefaultException(self.commandName+" FAILED from "
                     +host+":"+str(port)+": received status "+status+", '"
                     +response+"'")
 
     def _errSendk(self, err, factory, node, host, port, key, url):
-        if err.check('twisted.internet.error.TimeoutError') or \
-                err.check('twisted.internet.error.ConnectionLost'):
+        if self._retriable(err):
             #print "GETID request error: %s" % err.__class__.__name__
             self.timeoutcount += 1
             if self.timeoutcount < MAXTIMEOUTS:
                 #print "trying again [#%d]...." % self.timeoutcount
-                return self._sendRequest(node, host, port, key, url) 
+                return self._retry(self._sendRequest, node, host, port, key,
+                        url)
             else:
                 #print "not trying again [#%d]" % self.timeoutcount
                 return err
@@ -465,40 +533,63 @@ class SENDkSTORE(REQUEST):
     """
     Sends a single kSTORE to the given host:port, with key=val
     """
+    priority = ConnectionQueue.DHT
 
-    def __init__(self, node, host, port, key, val):
+    def __init__(self, node, host, port, key, val, cachettl=None):
+        """
+        If cachettl is given, the node keeps val in its value cache for that
+        many seconds instead of storing it.
+        """
         logger.info("sending kSTORE to %s:%d" % (host, port))
         REQUEST.__init__(self, host, port, node)
         Ku = node.config.Ku.exportPublicKey()
         url = 'http://'+host+':'+str(port)+'/meta/'
-        url += fencode(key)+"/"+fencode(val)
+        url += fencode(key)
         url += '?nodeID='+str(node.config.nodeID)
         url += "&Ku_e="+str(Ku['e'])
         url += "&Ku_n="+str(Ku['n'])
         url += '&port='+str(node.config.port)
+        if cachettl:
+            url += '&cache=%d' % cachettl
         # XXX: instead of a single key/val, protocol will take a series of
         # vals representing the blocks of the coded file and their
         # locations (by nodeID).  The entire thing will be stored under
         # the given key.  Also may need things like signature[s] from 
         # storing node[s], etc.
-        #print "in SENDkSTORE.__init__, len(val)=%d" % len(str(val))
-        #print "in SENDkSTORE.__init__, len(enc(val))=%d" % len(fencode(val))
-        #print "in SENDkSTORE.__init__, len(url)=%d" % len(url)
+        # the value goes in the request body, which the server caps at
+        # MAXKSTORESIZE
+        self.body = fencode(val)
+        self.headers['Content-Type'] = 'application/x-flud-data'
         self.timeoutcount = 0
         self.deferred = defer.Deferred()
-        ConnectionQueue.enqueue((self, host, port, url))
+        if len(self.body) > MAXKSTORESIZE:
+            self.deferred.errback(ValueError("kSTORE value is %d bytes, more"
+                " than the %d allowed" % (len(self.body), MAXKSTORESIZE)))
+            return
+        queued = (self, host, port, url)
+        dgram = self._datagram()
+        if dgram:
+            # (values too big for a datagram fail fast, and go over http)
+            d = dgram.store(host, port, key, self.body, cachettl)
+            d.addCallback(self._kStoreFinished, host, port)
+            d.addCallbacks(self.deferred.callback, self._datagramFailed,
+                    errbackArgs=(queued,))
+        else:
+            ConnectionQueue.enqueue(queued)
 
     def startRequest(self, host, port, url):
         d = self._sendRequest(host, port, url)
-        d.addBoth(ConnectionQueue.checkWaiting)
+        d.addBoth(ConnectionQueue.checkWaiting, self)
         d.addCallback(self.deferred.callback)
         d.addErrback(self.deferred.errback)
     
     def _sendRequest(self, host, port, url):
-        factory = getPageFactory(url,\
-                headers=self.headers, method='PUT', timeout=kprimitive_to) 
-        self.deferred.addCallback(self._kStoreFinished, host, port)
-        self.deferred.addErrback(self._storeErr, host, port, url)
+        factory = getPageFactory(url, headers=self.headers, method='PUT',
+                postdata=self.body, timeout=self._timeout(len(self.body))) 
+        # (on this attempt's deferred, so that callers only ever see the
+        # finished result, and each retry handles its own errors)
+        factory.deferred.addCallback(self._kStoreFinished, host, port)
+        factory.deferred.addErrback(self._storeErr, host, port, url)
         return factory.deferred
         
     def _kStoreFinished(self, response, host, port):
@@ -506,13 +597,12 @@ class SENDkSTORE(REQUEST):
         return response
 
     def _storeErr(self, err, host, port, url):
-        if err.check('twisted.internet.error.TimeoutError') or \
-                err.check('twisted.internet.error.ConnectionLost'):
+        if self._retriable(err):
             #print "GETID request error: %s" % err.__class__.__name__
             self.timeoutcount += 1
             if self.timeoutcount < MAXTIMEOUTS:
                 #print "trying again [#%d]...." % self.timeoutcount
-                return self._sendRequest(host, port, url) 
+                return self._retry(self._sendRequest, host, port, url)
             else:
                 #print "not trying again [#%d]" % self.timeoutcount
                 return err
@@ -521,6 +611,41 @@ class SENDkSTORE(REQUEST):
         # XXX: updateNode--
         return err
 
+class SENDkSTOREMULTI(SENDkSTORE):
+    """
+    Sends a batch of key/val pairs that this node holds to another holder
+    (republishing) in a single request.  The deferred fires with a dict of
+    the keys that weren't stored, and why.
+    """
+    priority = ConnectionQueue.BULK
+
+    def __init__(self, node, host, port, vals):
+        """
+        @param vals a dict of key -> val
+        """
+        logger.info("sending kSTORE batch of %d to %s:%d" 
+                % (len(vals), host, port))
+        REQUEST.__init__(self, host, port, node)
+        Ku = node.config.Ku.exportPublicKey()
+        url = 'http://'+host+':'+str(port)+'/metas'
+        url += '?nodeID='+str(node.config.nodeID)
+        url += "&Ku_e="+str(Ku['e'])
+        url += "&Ku_n="+str(Ku['n'])
+        url += '&port='+str(node.config.port)
+        self.body = fencode(vals)
+        self.headers['Content-Type'] = 'application/x-flud-data'
+        self.timeoutcount = 0
+        self.deferred = defer.Deferred()
+        if len(self.body) > MAXKSTORESIZE:
+            self.deferred.errback(ValueError("kSTORE batch is %d bytes, more"
+                " than the %d allowed" % (len(self.body), MAXKSTORESIZE)))
+            return
+        ConnectionQueue.enqueue((self, host, port, url))
+
+    def _kStoreFinished(self, response, host, port):
+        logger.info("kSTORE batch to %s:%d finished" % (host, port))
+        return fdecode(response)
+
 class SENDkFINDVALUE(SENDkFINDNODE):
     """
     Issues a single kFINDVALUE request to host:port for the key.
@@ -529,6 +654,7 @@ class SENDkFINDVALUE(SENDkFINDNODE):
     """
 
     def __init__(self, node, host, port, key):
+        self.valueKind = None
         SENDkFINDNODE.__init__(self, node, host, port, key, "meta")
         
     def _gotResponse(self, response, factory, node, host, port, key):
@@ -542,18 +668,32 @@ class SENDkFINDVALUE(SENDkFINDNODE):
                 and factory.response_headers['content-type']\
                         == ['application/x-flud-data']:
             logger.info("received SENDkFINDVALUE data.")
+            # 'authoritative', 'pernode' (authoritative, but filtered for us),
+            # or 'cached'.  Older nodes don't say.
+            if factory.response_headers.has_key('fludvalue'):
+                self.valueKind = factory.response_headers['fludvalue'][0]
             nID = None
             if factory.response_headers.has_key('nodeid'):
                 nID = factory.response_headers['nodeid'][0]
             updateNode(node.client, node.config, host, port, None, nID)
             return response
         
-        response = eval(response)
-        nID = long(response['id'], 16)
-        updateNode(node.client, node.config, host, port, None, nID)
-
+        response = WireCodec.parseResponse(response, 
+                WireCodec.responseType(factory))
         logger.info("received SENDkFINDVALUE nodes")
         logger.debug("received SENDkFINDVALUE nodes: %s" % response)
-        updateNodes(node.client, node.config, response['k'])
-        return response
+        return self._gotNodes(response, node, host, port)
+
+    def _sendDatagram(self, dgram, node, host, port, key):
+        d = dgram.findValue(host, port, key)
+        d.addCallback(self._gotDatagram, node, host, port)
+        return d
+
+    def _gotDatagram(self, response, node, host, port):
+        if isinstance(response, dict):
+            return self._gotNodes(response, node, host, port)
+        logger.info("received SENDkFINDVALUE data.")
+        self.valueKind, value, nID = response
+        updateNode(node.client, node.config, host, port, None, nID)
+        return value
 
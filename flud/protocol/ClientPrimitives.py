@@ -6,7 +6,7 @@ Primitive client storage protocol
 """
 
 from twisted.web import http, client
-from twisted.internet import reactor, threads, defer, error
+from twisted.internet import reactor, threads, defer, error, task
 from twisted.python import failure
 import time, os, stat, httplib, sys, logging, tarfile, gzip
 from StringIO import StringIO
@@ -15,6 +15,8 @@ from flud.FludCrypto import FludRSA
 from flud.fencode import fencode, fdecode
 
 import ConnectionQueue
+import SessionAuth
+import WireCodec
 from FludCommUtil import *
 
 logger = logging.getLogger("flud.client.op")
@@ -22,12 +24,14 @@ loggerid = logging.getLogger("flud.client.op.id")
 loggerstor = logging.getLogger("flud.client.op.stor")
 loggerstoragg = logging.getLogger("flud.client.op.stor.agg")
 loggerrtrv = logging.getLogger("flud.client.op.rtrv")
+loggerrtrvagg = logging.getLogger("flud.client.op.rtrv.agg")
 loggerdele = logging.getLogger("flud.client.op.dele")
 loggervrfy = logging.getLogger("flud.client.op.vrfy")
 loggerauth = logging.getLogger("flud.client.op.auth")
 
 MINSTORSIZE = 512000  # anything smaller than this tries to get aggregated
 TARFILE_TO = 2        # timeout for checking aggregated tar files
+RETRIEVE_AGG_TO = 0.5 # how long to wait for more retrieves to the same node
 
 MAXAUTHRETRY = 4      # number of times to retry auth
 
@@ -46,8 +50,11 @@ MAXAUTHRETRY = 4      # number of times to retry auth
 class REQUEST(object):
     """
     This is a parent class for generating http requests that follow the 
-    FludProtocol.
+    FludProtocol.  'priority' is the ConnectionQueue class the request waits
+    in; subclasses (or instances) override it.
     """
+    priority = ConnectionQueue.BULK
+
     def __init__(self, host, port, node=None):
         """
         All children should inherit.  By convention, subclasses should 
@@ -61,11 +68,102 @@ class REQUEST(object):
             self.node = node
             self.config = node.config
         self.headers = {'Fludprotocol': PROTOCOL_VERSION,
-                'User-Agent': 'FludClient'}
+                'User-Agent': 'FludClient',
+                WireCodec.WIREHEADER: str(WireCodec.VERSION)}
+
+    def _timeout(self, size=0):
+        """
+        Returns the timeout for this request's next attempt, going by what
+        we've measured of its destination (size is how many bytes it moves,
+        if that's known and many).
+        """
+        return peers.timeout(self.host, self.port, size,
+                getattr(self, 'timeoutcount', 0))
+
+    def _retriable(self, err):
+        """
+        True if err means the request never got an answer, so sending it
+        again might get one.
+        """
+        return err.check(defer.TimeoutError, error.TimeoutError,
+                error.ConnectionLost) is not None
+
+    def _retry(self, send, *args):
+        """
+        Resends the request, as send(*args), once it has backed off for its
+        timeoutcount'th retry.  Returns a deferred for send's result.
+        """
+        delay = backoff(self.timeoutcount)
+        logger.debug("retrying request to %s in %.1fs [#%d]" 
+                % (self.dest, delay, self.timeoutcount))
+        self.retrying = task.deferLater(reactor, delay, send, *args)
+        return self.retrying
+
+    def _cancel(self, d):
+        """
+        Canceller for the deferreds of requests that can be given up on.  The
+        request stops wherever it is: waiting in the ConnectionQueue (where
+        startRequest should check self.cancelled), backing off before a retry,
+        or in the connection pool (self.factory).
+        """
+        self.cancelled = True
+        retrying = getattr(self, 'retrying', None)
+        factory = getattr(self, 'factory', None)
+        if retrying and not retrying.called:
+            retrying.cancel()
+        elif factory:
+            httpPool.cancel(factory)
+
+    def _finished(self, result):
+        """
+        Fires self.deferred with result (which may be a failure), unless the
+        request was cancelled, which has fired it already.
+        """
+        if self.deferred.called:
+            return
+        if isinstance(result, failure.Failure):
+            self.deferred.errback(result)
+        else:
+            self.deferred.callback(result)
+
+    def _datagram(self):
+        """
+        Returns the node's DHT datagram transport if small DHT requests to
+        this request's destination should go over it, else None.
+        """
+        dgram = getattr(getattr(self, 'node', None), 'datagram', None)
+        if dgram and dgram.reachable(self.host, self.port):
+            return dgram
+        return None
+
+    def _datagramFailed(self, err, queued):
+        """
+        Falls back to http (by queueing the request as usual) when its
+        datagram wasn't answered or didn't fit.  Refusals aren't retried.
+        """
+        if err.check(DatagramRefused):
+            logger.info("%s refused datagram: %s" 
+                    % (self.dest, err.getErrorMessage()))
+            self.deferred.errback(err)
+            return
+        logger.debug("datagram to %s failed (%s), using http" 
+                % (self.dest, err.getErrorMessage()))
+        ConnectionQueue.enqueue(queued)
+
+    def _signRequest(self, headers, nKu, method, url):
+        """
+        Attaches session credentials for nKu's node to headers (or asks for
+        a session if we don't hold one yet).
+        """
+        if url[:7] == 'http://':
+            url = url[url.find('/', 7):]
+        return SessionAuth.clientSessions.sign(headers, nKu.id(), method, url)
 
 
 class SENDGETID(REQUEST):
 
+    priority = ConnectionQueue.AUTH
+
     def __init__(self, node, host, port):
         """
         Send a request to retrive the node's ID.  This is a reciprocal
@@ -82,18 +180,27 @@ class SENDGETID(REQUEST):
         #self.nKu = {}
         self.timeoutcount = 0
         self.deferred = defer.Deferred()
-        ConnectionQueue.enqueue((self, node, host, port, url))
+        queued = (self, node, host, port, url)
+        dgram = self._datagram()
+        if dgram:
+            loggerid.info("sending GETID datagram to %s" % self.dest)
+            d = dgram.ping(host, port)
+            d.addCallback(self._gotKu, host, port)
+            d.addCallbacks(self.deferred.callback, self._datagramFailed,
+                    errbackArgs=(queued,))
+        else:
+            ConnectionQueue.enqueue(queued)
 
     def startRequest(self, node, host, port, url):
         loggerid.info("sending SENDGETID to %s" % self.dest)
         d = self._sendRequest(node, host, port, url)
-        d.addBoth(ConnectionQueue.checkWaiting)
+        d.addBoth(ConnectionQueue.checkWaiting, self)
         d.addCallback(self.deferred.callback)
         d.addErrback(self.deferred.errback)
         d.addErrback(self._errID, node, host, port, url)
 
     def _sendRequest(self, node, host, port, url):
-        factory = getPageFactory(url, timeout=primitive_to,
+        factory = getPageFactory(url, timeout=self._timeout(),
                 headers=self.headers)
         d2 = factory.deferred
         d2.addCallback(self._getID, factory, host, port)
@@ -105,28 +212,30 @@ class SENDGETID(REQUEST):
         if not hasattr(factory, 'status'):
             raise failure.DefaultException(
                     "SENDGETID FAILED: no status in factory")
-        if eval(factory.status) != http.OK:
+        if int(factory.status) != http.OK:
             raise failure.DefaultException("SENDGETID FAILED to "+self.dest+": "
                     +"server sent status "+factory.status+", '"+response+"'")
         try:
-            nKu = {}
-            nKu = eval(response)
+            nKu = WireCodec.parseResponse(response, 
+                    WireCodec.responseType(factory))
             nKu = FludRSA.importPublicKey(nKu)
-            loggerid.info("SENDGETID PASSED to %s" % self.dest)
-            updateNode(self.node.client, self.config, host, port, nKu)
-            return nKu
         except:
             raise failure.DefaultException("SENDGETID FAILED to "+self.dest+": "
                     +"received response, but it did not contain valid key")
+        return self._gotKu(nKu, host, port)
+
+    def _gotKu(self, nKu, host, port):
+        loggerid.info("SENDGETID PASSED to %s" % self.dest)
+        updateNode(self.node.client, self.config, host, port, nKu)
+        return nKu
 
     def _errID(self, err, node, host, port, url):
-        if err.check('twisted.internet.error.TimeoutError') or \
-                err.check('twisted.internet.error.ConnectionLost'):
+        if self._retriable(err):
             #print "GETID request error: %s" % err.__class__.__name__
             self.timeoutcount += 1
             if self.timeoutcount < MAXTIMEOUTS:
                 #print "trying again [#%d]...." % self.timeoutcount
-                return self._sendRequest(node, host, port, url) 
+                return self._retry(self._sendRequest, node, host, port, url)
             else:
                 #print "not trying again [#%d]" % self.timeoutcount
                 return err
@@ -158,6 +267,7 @@ class SENDSTORE(REQUEST):
                 ('Ku_n', str(Ku['n'])),
                 ('port', str(self.node.config.port)),
                 ('size', str(fsize))]
+        self.fsize = fsize
         self.timeoutcount = 0
 
         self.deferred = defer.Deferred()
@@ -170,7 +280,7 @@ class SENDSTORE(REQUEST):
             datafile, metadata, params, skipFile):
         d = self._sendRequest(headers, nKu, host, port, filekey,
                 datafile, metadata, params, skipFile)
-        d.addBoth(ConnectionQueue.checkWaiting)
+        d.addBoth(ConnectionQueue.checkWaiting, self)
         d.addCallback(self.deferred.callback)
         d.addErrback(self.deferred.errback)
 
@@ -180,6 +290,10 @@ class SENDSTORE(REQUEST):
         skipfile - set to True if you want to send everything but file data
         (used to send the unauthorized request before responding to challenge)
         """
+        if self._signRequest(self.headers, nKu, 'POST', '/file/%s' % filekey):
+            # a session authenticates this request, so there won't be a
+            # challenge to sit through first
+            skipfile = False
         if skipfile:
             files = [(None, 'filename')]
         elif metadata:
@@ -189,8 +303,16 @@ class SENDSTORE(REQUEST):
             files = [(datafile, 'filename'), (metafile, 'meta')]
         else:
             files = [(datafile, 'filename')]
+        if not peers.available(host, port):
+            return defer.fail(PeerUnavailable(
+                "%s has been failing, not trying it for now" % self.dest))
+        if skipfile:
+            self.sending = (time.time(), 0)
+        else:
+            self.sending = (time.time(), self.fsize)
         deferred = threads.deferToThread(fileUpload, host, port, 
-                '/file/%s' % filekey, files, params, headers=self.headers)
+                '/file/%s' % filekey, files, params, headers=self.headers,
+                timeout=self._timeout(self.sending[1]))
         deferred.addCallback(self._getSendStore, nKu, host, port, filekey,
                 datafile, metadata, params, self.headers)
         deferred.addErrback(self._errSendStore, 
@@ -214,30 +336,32 @@ class SENDSTORE(REQUEST):
 
     def _getSendStore2(self, response, httpconn, nKu, host, port,
             filekey, datafile, metadata, params, headers):
-        httpconn.close()
+        result = response.read()
+        uploadPool.release(host, port, httpconn, response)
+        started, size = self.sending
+        peers.sample(host, port, time.time()-started, size)
+        peers.advertised(host, port, response.getheader('fludfree'))
         if response.status == http.UNAUTHORIZED:
             loggerstor.info("SENDSTORE unauthorized, sending credentials")
             challenge = response.reason
+            SessionAuth.clientSessions.drop(nKu.id())
             d = answerChallengeDeferred(challenge, self.node.config.Kr,
                     self.node.config.groupIDu, nKu.id(), headers)
             d.addCallback(self._sendRequest, nKu, host, port, filekey,
                     datafile, metadata, params)
             d.addErrback(self._errSendStore, "Couldn't answerChallenge", 
                     headers, nKu, host, port, filekey, datafile, metadata,
-                    params, httpconn)
+                    params)
             return d
         elif response.status == http.CONFLICT:
-            result = response.read()
             # XXX: client should check key before ever sending request
             raise BadCASKeyException("%s %s" 
                     % (response.status, response.reason))
         elif response.status != http.OK:
-            result = response.read()
             raise failure.DefaultException( 
                     "received %s in SENDSTORE response: %s"
                     % (response.status, result))
         else:
-            result = response.read()
             updateNode(self.node.client, self.config, host, port, nKu)
             loggerstor.info("received SENDSTORE response from %s: %s" 
                     % (self.dest, str(result)))
@@ -245,13 +369,15 @@ class SENDSTORE(REQUEST):
 
     def _errSendStore(self, err, msg, headers, nKu, host, port,
             filekey, datafile, metadata, params, httpconn=None):
-        if err.check('socket.error'):
+        if err.check('socket.error') or err.check(httplib.BadStatusLine):
+            # (BadStatusLine: a pooled connection was closed under us)
             #print "SENDSTORE request error: %s" % err.__class__.__name__
+            peers.failed(host, port)
             self.timeoutcount += 1
             if self.timeoutcount < MAXTIMEOUTS:
                 print "trying again [#%d]...." % self.timeoutcount
-                return self._sendRequest(headers, nKu, host, port, filekey,
-                        datafile, metadata, params)
+                return self._retry(self._sendRequest, headers, nKu, host,
+                        port, filekey, datafile, metadata, params)
             else:
                 print "Maxtimeouts exceeded: %d" % self.timeoutcount
         elif err.check(BadCASKeyException):
@@ -420,6 +546,8 @@ class AggregateStore:
 
 class SENDRETRIEVE(REQUEST):
 
+    priority = ConnectionQueue.INTERACTIVE
+
     def __init__(self, nKu, node, host, port, filekey, metakey=True):
         """
         Try to download a file.
@@ -437,22 +565,30 @@ class SENDRETRIEVE(REQUEST):
         url += "&metakey="+str(metakey)
         #filename = self.node.config.clientdir+'/'+filekey
         self.timeoutcount = 0
+        self.cancelled = False
+        self.factory = None
 
-        self.deferred = defer.Deferred()
+        self.deferred = defer.Deferred(self._cancel)
         ConnectionQueue.enqueue((self, self.headers, nKu, host, port, url))
 
     def startRequest(self, headers, nKu, host, port, url):
         #print "doing RET: %s" % filename
+        if self.cancelled:
+            # given up on while it waited its turn
+            ConnectionQueue.checkWaiting(None, self)
+            return
         loggerrtrv.info("startRequest to %s:%s" % (host, str(port)))
         d = self._sendRequest(headers, nKu, host, port, url)
-        d.addBoth(ConnectionQueue.checkWaiting)
-        d.addCallback(self.deferred.callback)
-        d.addErrback(self.deferred.errback)
+        d.addBoth(ConnectionQueue.checkWaiting, self)
+        d.addBoth(self._finished)
 
     def _sendRequest(self, headers, nKu, host, port, url):
         loggerrtrv.info("_sendRequest to %s:%s" % (host, str(port)))
+        self._signRequest(headers, nKu, 'GET', url)
+        # (the pool gives it longer once it knows how big the response is)
         factory = multipartDownloadPageFactory(url, self.node.config.clientdir,
-                headers=headers, timeout=transfer_to)
+                headers=headers, timeout=self._timeout())
+        self.factory = factory
         deferred = factory.deferred
         deferred.addCallback(self._getSendRetrieve, nKu, host, port, factory)
         deferred.addErrback(self._errSendRetrieve, nKu, host, port, factory, 
@@ -461,7 +597,7 @@ class SENDRETRIEVE(REQUEST):
 
     def _getSendRetrieve(self, response, nKu, host, port, factory):
         loggerrtrv.info("_getSendRetrieve to %s:%s" % (host, str(port)))
-        if eval(factory.status) == http.OK:
+        if int(factory.status) == http.OK:
             # response is None, since it went to file (if a server error
             # occured, it may be printed in this file)
             # XXX: need to check that file hashes to key! If we don't do this,
@@ -480,22 +616,22 @@ class SENDRETRIEVE(REQUEST):
 
     def _errSendRetrieve(self, err, nKu, host, port, factory, url, headers):
         loggerrtrv.info("_errSendRetrieve from %s:%s" % (host, str(port)))
-        if err.check('twisted.internet.error.TimeoutError') or \
-                err.check('twisted.internet.error.ConnectionLost'): #or \
-                #err.check('twisted.internet.error.ConnectBindError'):
+        if self._retriable(err):
             loggerrtrv.info("_errSendRetrieve timeout/connlost from %s:%s" 
                     % (host, str(port)))
             self.timeoutcount += 1
             if self.timeoutcount < MAXTIMEOUTS:
                 #print "RETR trying again [#%d]..." % self.timeoutcount
-                return self._sendRequest(headers, nKu, host, port, url)
+                return self._retry(self._sendRequest, headers, nKu, host,
+                        port, url)
             else:
                 #print "RETR timeout exceeded: %d" % self.timeoutcount
                 pass
         elif hasattr(factory, 'status') and \
-                eval(factory.status) == http.UNAUTHORIZED:
+                int(factory.status) == http.UNAUTHORIZED:
             loggerrtrv.info("SENDRETRIEVE unauthorized, sending credentials")
             challenge = err.getErrorMessage()[4:]
+            SessionAuth.clientSessions.drop(nKu.id())
             d = answerChallengeDeferred(challenge, self.node.config.Kr,
                     self.node.config.groupIDu, nKu.id(), headers)
             d.addCallback(self._sendRequest, nKu, host, port, url)
@@ -507,18 +643,190 @@ class SENDRETRIEVE(REQUEST):
             #return self._sendRequest(nKu, host, port, url, extraheaders)
         # XXX: these remaining else clauses are really just for debugging...
         elif hasattr(factory, 'status'):
-            if eval(factory.status) == http.NOT_FOUND:
+            if int(factory.status) == http.NOT_FOUND:
                 err = NotFoundException(err)
-            elif eval(factory.status) == http.BAD_REQUEST:
+            elif int(factory.status) == http.BAD_REQUEST:
                 err = BadRequestException(err)
         elif err.check('twisted.internet.error.ConnectionRefusedError'):
             pass # fall through to return err
+        elif err.check(defer.CancelledError):
+            pass # whoever asked for it doesn't want it anymore
         else:
             print "non-timeout, non-UNAUTH RETR request error: %s" % err
         # XXX: updateNode
         loggerrtrv.info("SENDRETRIEVE failed")
         raise err
 
+class SENDRETRIEVEMULTI(SENDRETRIEVE):
+
+    def __init__(self, nKu, node, host, port, filekeys, metakey=True):
+        """
+        Try to download several files from the same node in a single
+        multipart response.  The deferred fires with the list of all files
+        written; blocks that the node doesn't have are simply absent.
+        """
+        host = getCanonicalIP(host)
+        REQUEST.__init__(self, host, port, node)
+
+        loggerrtrv.info("sending RETRIEVE request for %d blocks to %s:%s"
+                % (len(filekeys), host, str(port)))
+        Ku = self.node.config.Ku.exportPublicKey()
+        url = 'http://'+host+':'+str(port)+'/blocks?'
+        url += 'keys='+','.join(filekeys)
+        url += '&nodeID='+str(self.node.config.nodeID)
+        url += '&port='+str(self.node.config.port)
+        url += "&Ku_e="+str(Ku['e'])
+        url += "&Ku_n="+str(Ku['n'])
+        url += "&metakey="+str(metakey)
+        self.timeoutcount = 0
+        self.cancelled = False
+        self.factory = None
+
+        self.deferred = defer.Deferred(self._cancel)
+        ConnectionQueue.enqueue((self, self.headers, nKu, host, port, url))
+
+    def _errSendRetrieve(self, err, nKu, host, port, factory, url, headers):
+        if hasattr(factory, 'status') and \
+                int(factory.status) == http.NOT_FOUND and \
+                getattr(factory, 'message', '').startswith(BATCHNOTFOUND):
+            # (rather than a node that doesn't know about batches at all)
+            loggerrtrv.info("%s:%s has none of the blocks" % (host, port))
+            raise BatchNotFoundException(factory.message)
+        return SENDRETRIEVE._errSendRetrieve(self, err, nKu, host, port,
+                factory, url, headers)
+
+
+aggRetrieveMap = {}  # a map of maps, containing a list of deferreds.  The
+                     # deferred(s) waiting on block 'x' from node 'y' are
+                     # accessed as aggRetrieveMap['y']['x']
+aggRetrieveTimeoutMap = {}  # a map of timeout calls for a batch.  The timeout
+                            # for node 'y' is stored in aggRetrieveTimeoutMap['y']
+aggRetrieveSentMap = {}  # id() of the waiters map of a batch that has been sent
+                         # -> the deferred of its request
+class AggregateRetrieve:
+    """
+    Plans block fetches by node: retrieves for the same node that arrive
+    within RETRIEVE_AGG_TO of each other are sent as a single
+    SENDRETRIEVEMULTI (a directory restore will typically pull many blocks
+    from each peer).  Each caller's deferred fires with only the files that
+    belong to its block, exactly as if it had done its own SENDRETRIEVE.
+    A caller can cancel its deferred; the batch is only cancelled (or never
+    sent) once none of its callers want it.
+    """
+
+    def __init__(self, nKu, node, host, port, filekey, metakey=True):
+        host = getCanonicalIP(host)
+        batch = "%s:%d:%s" % (host, port, metakey)
+        if not aggRetrieveMap.has_key(batch):
+            loggerrtrvagg.debug("starting retrieve batch for %s" % batch)
+            aggRetrieveMap[batch] = {}
+            aggRetrieveTimeoutMap[batch] = reactor.callLater(RETRIEVE_AGG_TO,
+                    self.sendBatch, batch, nKu, node, host, port, metakey)
+        self.batch = batch
+        self.filekey = filekey
+        self.waiters = aggRetrieveMap[batch]
+        self.deferred = defer.Deferred(self._cancel)
+        try:
+            aggRetrieveMap[batch][filekey].append(self.deferred)
+        except KeyError:
+            aggRetrieveMap[batch][filekey] = [self.deferred]
+        timeoutFunc = aggRetrieveTimeoutMap[batch]
+        if len(aggRetrieveMap[batch]) >= MAXBATCHKEYS:
+            loggerrtrvagg.debug("retrieve batch for %s is full" % batch)
+            timeoutFunc.cancel()
+            self.sendBatch(batch, nKu, node, host, port, metakey)
+        elif timeoutFunc.active():
+            timeoutFunc.reset(RETRIEVE_AGG_TO)
+
+    def sendBatch(self, batch, nKu, node, host, port, metakey):
+        waiters = aggRetrieveMap.pop(batch)
+        aggRetrieveTimeoutMap.pop(batch)
+        filekeys = waiters.keys()
+        loggerrtrvagg.info("aggregation op triggered, retrieving %d blocks"
+                " from %s:%d" % (len(filekeys), host, port))
+        if len(filekeys) == 1:
+            d = SENDRETRIEVE(nKu, node, host, port, filekeys[0],
+                    metakey).deferred
+        else:
+            d = SENDRETRIEVEMULTI(nKu, node, host, port, filekeys,
+                    metakey).deferred
+            d.addErrback(self.retrieveSingly, nKu, node, host, port,
+                    filekeys, metakey)
+        aggRetrieveSentMap[id(waiters)] = d
+        d.addBoth(self._sent, waiters)
+        d.addCallback(self.callbackBlocks, waiters)
+        d.addErrback(self.errbackBlocks, waiters)
+
+    def _sent(self, result, waiters):
+        aggRetrieveSentMap.pop(id(waiters), None)
+        return result
+
+    def _cancel(self, d):
+        waiting = self.waiters.get(self.filekey, [])
+        if d in waiting:
+            waiting.remove(d)
+        if not waiting:
+            self.waiters.pop(self.filekey, None)
+        if self.waiters:
+            return
+        if aggRetrieveMap.get(self.batch) is self.waiters:
+            loggerrtrvagg.debug("retrieve batch for %s no longer wanted"
+                    % self.batch)
+            del aggRetrieveMap[self.batch]
+            timeoutFunc = aggRetrieveTimeoutMap.pop(self.batch)
+            if timeoutFunc.active():
+                timeoutFunc.cancel()
+        elif aggRetrieveSentMap.has_key(id(self.waiters)):
+            aggRetrieveSentMap[id(self.waiters)].cancel()
+
+    def retrieveSingly(self, err, nKu, node, host, port, filekeys, metakey):
+        # peers that don't know about batch retrieval answer 404 for the
+        # whole request; fall back to one SENDRETRIEVE per block
+        if err.check(BatchNotFoundException) \
+                or not err.check(NotFoundException):
+            return err
+        loggerrtrvagg.info("batch retrieve from %s:%d not found, retrieving"
+                " %d blocks singly" % (host, port, len(filekeys)))
+        dlist = []
+        for filekey in filekeys:
+            d = SENDRETRIEVE(nKu, node, host, port, filekey, metakey).deferred
+            d.addErrback(lambda err: [])
+            dlist.append(d)
+        d = defer.DeferredList(dlist)
+        d.addCallback(lambda results:
+                [f for success, files in results for f in files])
+        return d
+
+    def callbackBlocks(self, filenames, waiters):
+        claimed = {}
+        for filekey in waiters:
+            files = [f for f in filenames
+                    if os.path.basename(f) == filekey
+                    or os.path.basename(f)[:len(filekey)+1] == filekey+'.']
+            for f in files:
+                claimed[f] = True
+            if filekey in [os.path.basename(f) for f in files]:
+                for d in waiters[filekey]:
+                    d.callback(files[:])
+            else:
+                loggerrtrvagg.debug("%s missing from batch" % filekey)
+                err = failure.Failure(NotFoundException(
+                    "Not found: %s" % filekey))
+                for d in waiters[filekey]:
+                    d.errback(err)
+        for f in filenames:
+            if not claimed.has_key(f):
+                # its caller gave up on it while the batch was underway
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+
+    def errbackBlocks(self, err, waiters):
+        for filekey in waiters:
+            for d in waiters[filekey]:
+                d.errback(err)
+
 class SENDDELETE(REQUEST):
 
     def __init__(self, nKu, node, host, port, filekey, metakey):
@@ -544,13 +852,14 @@ class SENDDELETE(REQUEST):
 
     def startRequest(self, headers, nKu, host, port, url):
         d = self._sendRequest(headers, nKu, host, port, url)
-        d.addBoth(ConnectionQueue.checkWaiting)
+        d.addBoth(ConnectionQueue.checkWaiting, self)
         d.addCallback(self.deferred.callback)
         d.addErrback(self.deferred.errback)
 
     def _sendRequest(self, headers, nKu, host, port, url):
+        self._signRequest(headers, nKu, 'DELETE', url)
         factory = getPageFactory(url, method="DELETE", headers=headers,
-                timeout=primitive_to)
+                timeout=self._timeout())
         deferred = factory.deferred
         deferred.addCallback(self._getSendDelete, nKu, host, port, factory)
         deferred.addErrback(self._errSendDelete, nKu, host, port, factory, url,
@@ -558,7 +867,7 @@ class SENDDELETE(REQUEST):
         return deferred
 
     def _getSendDelete(self, response, nKu, host, port, factory):
-        if eval(factory.status) == http.OK:
+        if int(factory.status) == http.OK:
             loggerdele.info("received SENDDELETE response")
             updateNode(self.node.client, self.config, host, port, nKu)
             return response
@@ -568,21 +877,22 @@ class SENDDELETE(REQUEST):
                     +"server sent status "+factory.status+", '"+response+"'")
 
     def _errSendDelete(self, err, nKu, host, port, factory, url, headers):
-        if err.check('twisted.internet.error.TimeoutError') or \
-                err.check('twisted.internet.error.ConnectionLost'):
+        if self._retriable(err):
             #print "DELETE request error: %s" % err.__class__.__name__
             self.timeoutcount += 1
             if self.timeoutcount < MAXTIMEOUTS:
                 #print "trying again [#%d]...." % self.timeoutcount
-                return self._sendRequest(headers, nKu, host, port, url) 
+                return self._retry(self._sendRequest, headers, nKu, host,
+                        port, url)
         elif hasattr(factory, 'status') and \
-                eval(factory.status) == http.UNAUTHORIZED and \
+                int(factory.status) == http.UNAUTHORIZED and \
                 self.authRetry < MAXAUTHRETRY:
             # XXX: add this authRetry stuff to all the other op classes (so
             # that we don't DOS ourselves and another node
             self.authRetry += 1
             loggerdele.info("SENDDELETE unauthorized, sending credentials")
             challenge = err.getErrorMessage()[4:]
+            SessionAuth.clientSessions.drop(nKu.id())
             d = answerChallengeDeferred(challenge, self.node.config.Kr,
                     self.node.config.groupIDu, nKu.id(), headers)
             d.addCallback(self._sendRequest, nKu, host, port, url)
@@ -592,9 +902,9 @@ class SENDDELETE(REQUEST):
         elif hasattr(factory, 'status'):
             # XXX: updateNode
             loggerdele.info("SENDDELETE failed")
-            if eval(factory.status) == http.NOT_FOUND:
+            if int(factory.status) == http.NOT_FOUND:
                 err = NotFoundException(err)
-            elif eval(factory.status) == http.BAD_REQUEST:
+            elif int(factory.status) == http.BAD_REQUEST:
                 err = BadRequestException(err)
             raise err
         return err
@@ -634,13 +944,14 @@ class SENDVERIFY(REQUEST):
     def startRequest(self, headers, nKu, host, port, url):
         #loggervrfy.debug("*Doing* VERIFY Request %s" % port)
         d = self._sendRequest(headers, nKu, host, port, url)
-        d.addBoth(ConnectionQueue.checkWaiting)
+        d.addBoth(ConnectionQueue.checkWaiting, self)
         d.addCallback(self.deferred.callback)
         d.addErrback(self.deferred.errback)
 
     def _sendRequest(self, headers, nKu, host, port, url):
         loggervrfy.debug("in VERIFY sendReq %s" % port)
-        factory = getPageFactory(url, headers=headers, timeout=primitive_to)
+        self._signRequest(headers, nKu, 'GET', url)
+        factory = getPageFactory(url, headers=headers, timeout=self._timeout())
         deferred = factory.deferred
         deferred.addCallback(self._getSendVerify, nKu, host, port, factory)
         deferred.addErrback(self._errSendVerify, nKu, host, port, factory, url,
@@ -649,7 +960,7 @@ class SENDVERIFY(REQUEST):
 
     def _getSendVerify(self, response, nKu, host, port, factory):
         loggervrfy.debug("got vrfy response")
-        if eval(factory.status) == http.OK:
+        if int(factory.status) == http.OK:
             loggervrfy.info("received SENDVERIFY response")
             updateNode(self.node.client, self.config, host, port, nKu)
             return response
@@ -661,17 +972,18 @@ class SENDVERIFY(REQUEST):
 
     def _errSendVerify(self, err, nKu, host, port, factory, url, headers):
         loggervrfy.debug("got vrfy err")
-        if err.check('twisted.internet.error.TimeoutError') or \
-                err.check('twisted.internet.error.ConnectionLost'):
+        if self._retriable(err):
             #print "VERIFY request error: %s" % err.__class__.__name__
             self.timeoutcount += 1
             if self.timeoutcount < MAXTIMEOUTS:
                 #print "trying again [#%d]...." % self.timeoutcount
-                return self._sendRequest(headers, nKu, host, port, url) 
+                return self._retry(self._sendRequest, headers, nKu, host,
+                        port, url)
         elif hasattr(factory, 'status') and \
-                eval(factory.status) == http.UNAUTHORIZED:
+                int(factory.status) == http.UNAUTHORIZED:
             loggervrfy.info("SENDVERIFY unauthorized, sending credentials")
             challenge = err.getErrorMessage()[4:]
+            SessionAuth.clientSessions.drop(nKu.id())
             d = answerChallengeDeferred(challenge, self.node.config.Kr,
                     self.node.config.groupIDu, nKu.id(), headers)
             d.addCallback(self._sendRequest, nKu, host, port, url)
@@ -683,9 +995,9 @@ class SENDVERIFY(REQUEST):
         elif hasattr(factory, 'status'):
             # XXX: updateNode
             loggervrfy.info("SENDVERIFY failed: %s" % err.getErrorMessage())
-            if eval(factory.status) == http.NOT_FOUND:
+            if int(factory.status) == http.NOT_FOUND:
                 err = NotFoundException(err)
-            elif eval(factory.status) == http.BAD_REQUEST:
+            elif int(factory.status) == http.BAD_REQUEST:
                 err = BadRequestException(err)
         raise err
 
@@ -707,9 +1019,18 @@ def answerChallengeDeferred(challenge, Kr, groupIDu, sID, headers):
 
 def answerChallenge(challenge, Kr, groupIDu, sID, headers={}):
     loggerauth.debug("got challenge: '%s'" % challenge)
+    serverID = sID
     sID = binascii.unhexlify(sID)
     challenge = (fdecode(challenge),)
-    response = fencode(Kr.decrypt(challenge))
+    response = Kr.decrypt(challenge)
+    secret = None
+    if headers.has_key('Fludsession'):
+        # we asked for a session, so the server appended a session secret to
+        # the challenge.  Keep it (once the challenge checks out below), but
+        # don't send it back.
+        secret = response[-SessionAuth.SESSIONSECRETLENGTH:]
+        response = response[:-SessionAuth.SESSIONSECRETLENGTH]
+    response = fencode(response)
     # XXX: RSA.decrypt won't restore leading 0's.  This causes
     #      some challenges to fail when they shouldn't -- solved for now
     #      on the server side by generating non-0 leading challenges.
@@ -732,6 +1053,8 @@ def answerChallenge(challenge, Kr, groupIDu, sID, headers={}):
         # XXX: trust-- (must go by ip:port, since ID could be innocent)
         raise ImposterException("node %s is issuing invalid challenges --"
                 " claims to have id=%s" % (fencode(sID), fencode(responseID)))
+    if secret is not None:
+        SessionAuth.clientSessions.open(serverID, secret)
     response = fdecode(response)[len(sID):]
     loggerauth.debug("  challenge response: '%s'" % fencode(response))
     response = fencode(response)+":"+groupIDu
@@ -0,0 +1,121 @@
+"""
+Coalescer.py (c) 2003-2006 Alen Peacock.  This program is distributed under
+the terms of the GNU General Public License (the GPL), version 3.
+
+Shares in-flight client operations.  A request for an operation that is
+already underway (the same operation, host, port, and key) doesn't go out
+again; it waits for the one that is, and gets its own copy of the result.
+A waiter can cancel its deferred; the operation itself is only cancelled once
+no one is waiting for it.
+
+>>> from twisted.internet import defer
+>>> c = Coalescer()
+>>> started = []
+>>> def start():
+...     started.append(defer.Deferred())
+...     return started[-1]
+>>> r1, r2 = [], []
+>>> d = c.call('nodes', 'host', 80, 5, start).addCallback(r1.append)
+>>> d = c.call('nodes', 'host', 80, 5, start).addCallback(r2.append)
+>>> len(started), len(c)
+(1, 1)
+>>> started[0].callback({'k': [1, 2]})
+>>> r1, r2, r1[0] is r2[0], len(c), c.coalesced
+([{'k': [1, 2]}], [{'k': [1, 2]}], False, 0, 1)
+>>> errs = []
+>>> d = c.call('ID', 'host', 80, None, start, copier=None)
+>>> d = d.addErrback(lambda f: errs.append(f.getErrorMessage()))
+>>> started[1].errback(ValueError('refused'))
+>>> errs
+['refused']
+>>> d1 = c.call('RETRIEVE', 'host', 80, 'blk', start)
+>>> d2 = c.call('RETRIEVE', 'host', 80, 'blk', start)
+>>> d1 = d1.addErrback(lambda f: errs.append(f.type.__name__))
+>>> d1.cancel()
+>>> started[2].called, len(c)
+(False, 1)
+>>> d2 = d2.addErrback(lambda f: errs.append(f.type.__name__))
+>>> d2.cancel()
+>>> errs[1:], started[2].called, len(c)
+(['CancelledError', 'CancelledError'], True, 0)
+"""
+
+import copy, logging
+from twisted.internet import defer
+from twisted.python import failure
+
+logger = logging.getLogger("flud.client.coalesce")
+
+class Coalescer:
+    """
+    Tracks in-flight operations by (operation, host, port, key).
+    """
+    def __init__(self):
+        self.inflight = {}  # (op, host, port, key) -> [(deferred, copier)]
+        self.started = {}   # (op, host, port, key) -> operation's deferred
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.inflight)
+
+    def call(self, op, host, port, key, start, copier=copy.deepcopy):
+        """
+        Returns a deferred for the result of start(), a function that begins
+        the operation and returns a deferred.  start() is only called if no
+        identical operation is in flight.  The first waiter gets the result
+        itself, and each other one gets copier(result), so that waiters can't
+        see each other's changes to it.  If the result is immutable (or never
+        changed by its users), copier can be None, and it is shared.
+        """
+        ident = (op, host, port, key)
+        d = defer.Deferred(lambda d: self._cancel(ident, d))
+        if self.inflight.has_key(ident):
+            logger.debug("%s to %s:%s for %s is already underway"
+                    % (op, host, port, key))
+            self.coalesced += 1
+            self.inflight[ident].append((d, copier))
+            return d
+        self.inflight[ident] = [(d, copier)]
+        try:
+            started = start()
+        except:
+            started = defer.fail(failure.Failure())
+        self.started[ident] = started
+        started.addBoth(self._done, ident)
+        return d
+
+    def _cancel(self, ident, d):
+        waiters = self.inflight.get(ident)
+        if waiters is None:
+            return
+        waiters[:] = [w for w in waiters if w[0] is not d]
+        if not waiters:
+            logger.debug("%s to %s:%s for %s no longer wanted" % ident)
+            self.started[ident].cancel()
+
+    def _done(self, result, ident):
+        # (the operation is no longer in flight by the time waiters see the
+        # result, so any of them can start it again)
+        waiters = self.inflight.pop(ident)
+        del self.started[ident]
+        results = [result]
+        for d, copier in waiters[1:]:
+            if copier and not isinstance(result, failure.Failure):
+                try:
+                    results.append(copier(result))
+                except:
+                    results.append(failure.Failure())
+            else:
+                results.append(result)
+        for i, (d, copier) in enumerate(waiters):
+            if isinstance(results[i], failure.Failure):
+                d.errback(results[i])
+            else:
+                d.callback(results[i])
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -0,0 +1,668 @@
+"""
+ConnectionPool.py (c) 2003-2006 Alen Peacock.  This program is distributed
+under the terms of the GNU General Public License (the GPL), version 3.
+
+Persistent (HTTP/1.1 keep-alive) connections to other flud nodes.
+
+Requests are handed to the pool as the same twisted.web.client factory objects
+that getPageFactory and friends have always produced (HTTPClientFactory,
+HTTPDownloader, HTTPMultipartDownloader).  The pool drives them through the
+same callbacks that twisted's own HTTPPageGetter/HTTPPageDownloader use
+(gotStatus, gotHeaders, page/noPage, pageStart/pagePart/pageEnd), so callers
+see no difference except that connections to a node get reused.
+
+Connections are keyed by (host, port).  At most MAXPERHOST are open to any one
+node; once that many are busy, GETs are pipelined (up to MAXPIPELINE deep)
+behind other GETs, and anything else waits for a free connection.  Nothing is
+pipelined behind a download (a RETRIEVE, which can take minutes), and when
+every connection to a node is carrying one, the next request that isn't a
+download gets a connection of its own, one beyond MAXPERHOST.  Idle
+connections are closed after IDLE_TO seconds.
+
+Every response, timeout and failed connection is reported to PeerStats.peers
+(as is the free space that nodes advertise in their responses), which the
+pool also consults for connect timeouts, for more time once a response turns
+out to be large, and for peers whose breaker is open (their requests fail at
+once with PeerUnavailable).
+
+A request can be given up on with cancel(factory).  One still waiting for a
+connection is just dropped; one whose response is arriving costs its
+connection; one pipelined behind others has its response read and thrown
+away when it comes.
+
+UploadPool does the same job for the blocking httplib connections that
+fileUpload uses from worker threads.
+"""
+
+import logging, os, random, threading, time
+from collections import deque
+from twisted.internet import reactor, protocol, defer, error
+from twisted.protocols import basic
+from twisted.python import failure
+from twisted.web import error as weberror
+
+from PeerStats import peers, PeerUnavailable
+
+logger = logging.getLogger('flud.comm.pool')
+
+MAXPERHOST = 4    # open connections to a single node
+MAXPIPELINE = 4   # outstanding (pipelined) GETs on a single connection
+IDLE_TO = 60      # seconds an unused connection is kept open
+PIPELINED = ('GET', 'HEAD')  # only idempotent requests are pipelined
+
+def _streams(factory):
+    # downloaders write their (possibly large) response to files as it comes
+    return hasattr(factory, 'pageStart')
+
+def _detach(factory):
+    """
+    HTTPClientFactory holds its result until the connection it made closes.
+    Pooled connections outlive their requests, so let the factory go now.
+    """
+    d = getattr(factory, '_disconnectedDeferred', None)
+    if d and not d.called:
+        d.callback(None)
+
+class _Discarded:
+    """
+    Stands in for a cancelled request whose response is still to come on a
+    pipelined connection, and throws that response away.
+    """
+    discarded = True
+
+    def __init__(self, factory):
+        self.url = factory.url
+        self.method = getattr(factory, 'method', 'GET')
+        self.timeout = getattr(factory, 'timeout', 0)
+
+    def gotStatus(self, version, status, message):
+        pass
+
+    def gotHeaders(self, headers):
+        pass
+
+    def page(self, page):
+        pass
+
+    def noPage(self, reason):
+        pass
+
+class PooledPageGetter(basic.LineReceiver):
+    """
+    HTTP/1.1 client protocol that serves a queue of factories, in order, on a
+    single persistent connection.
+    """
+    delimiter = '\r\n'
+    # ('connection' because HTTPClientFactory asks for 'close' on POSTs)
+    _specialHeaders = ('host', 'user-agent', 'content-length', 'connection')
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.outstanding = deque()  # factories sent, oldest first
+        self.closing = False
+        self.idleCall = None
+        self.timeoutCall = None
+        self.factory = None
+        self.started = 0
+        self.received = 0
+
+    def connectionMade(self):
+        self.pool.connected(self)
+
+    def busy(self):
+        return len(self.outstanding)
+
+    def pipelinable(self):
+        if self.closing or len(self.outstanding) >= MAXPIPELINE:
+            return False
+        for f in self.outstanding:
+            if getattr(f, 'method', 'GET') not in PIPELINED or _streams(f):
+                return False
+        return True
+
+    def streaming(self):
+        for f in self.outstanding:
+            if _streams(f):
+                return True
+        return False
+
+    def sendRequest(self, factory):
+        if self.idleCall and self.idleCall.active():
+            self.idleCall.cancel()
+        self.idleCall = None
+        _detach(factory)
+        self.outstanding.append(factory)
+        method = getattr(factory, 'method', 'GET')
+        host = factory.host
+        if factory.port != 80:
+            host = '%s:%s' % (factory.host, factory.port)
+        lines = ['%s %s HTTP/1.1' % (method, factory.path),
+                'Host: %s' % factory.headers.get('host', host),
+                'User-Agent: %s' % factory.agent]
+        data = getattr(factory, 'postdata', None)
+        if data is not None:
+            lines.append('Content-Length: %d' % len(data))
+        for k, v in factory.headers.items():
+            if k.lower() not in self._specialHeaders:
+                lines.append('%s: %s' % (k, v))
+        lines.append('')
+        lines.append('')
+        self.transport.write('\r\n'.join(lines))
+        if data is not None:
+            self.transport.write(data)
+        if len(self.outstanding) == 1:
+            self._startResponse()
+
+    def _startResponse(self):
+        self.factory = self.outstanding[0]
+        self.status = None
+        self.headers = {}
+        self.body = []
+        self.transmitting = False
+        self.length = None
+        self.chunked = False
+        self.chunkRemaining = 0
+        self.chunkState = 'size'
+        self.buffer = ''
+        self.untilClose = False
+        self.started = time.time()
+        self.received = 0
+        self.setLineMode()
+        timeout = getattr(self.factory, 'timeout', 0)
+        if timeout:
+            self.timeoutCall = reactor.callLater(timeout, self._timedOut,
+                    self.factory)
+
+    def _stopTimeout(self):
+        if self.timeoutCall and self.timeoutCall.active():
+            self.timeoutCall.cancel()
+        self.timeoutCall = None
+
+    def _timedOut(self, factory):
+        self.timeoutCall = None
+        logger.info("request to %s:%d timed out" % self.key)
+        peers.failed(*self.key)
+        # (closing first, so that whatever noPage sets off doesn't get sent
+        # on this connection)
+        self.closing = True
+        if self.outstanding and self.outstanding[0] is factory:
+            self.outstanding.popleft()
+            self.factory = None
+            factory.noPage(failure.Failure(defer.TimeoutError(
+                "Getting %s took longer than %s seconds."
+                % (factory.url, factory.timeout))))
+        self.transport.loseConnection()
+
+    def lineReceived(self, line):
+        if self.factory is None:
+            # nothing outstanding; the server shouldn't be talking
+            self.closing = True
+            self.transport.loseConnection()
+            return
+        if self.status is None:
+            if not line:
+                return
+            try:
+                version, status, message = (line.split(None, 2)+[''])[:3]
+                int(status)
+            except ValueError:
+                self._fail(failure.Failure(ValueError(
+                    "bad status line: %s" % line[:80])))
+                return
+            self.version = version
+            self.status = status
+            self.message = message
+            self.factory.gotStatus(version, status, message)
+        elif line:
+            if line[0] in ' \t' and self.headers:
+                return # XXX: continuation lines aren't used by flud peers
+            k, v = line.split(':', 1)
+            self.headers.setdefault(k.strip().lower(), []).append(v.strip())
+        else:
+            self._headersDone()
+
+    def _headersDone(self):
+        self.factory.gotHeaders(self.headers)
+        if self.headers.has_key('fludfree'):
+            peers.advertised(self.key[0], self.key[1],
+                    self.headers['fludfree'][0])
+        connection = ','.join(self.headers.get('connection', [])).lower()
+        if self.version == 'HTTP/1.1':
+            self.keepalive = connection.find('close') < 0
+        else:
+            self.keepalive = connection.find('keep-alive') >= 0
+        status = int(self.status)
+        if hasattr(self.factory, 'pageStart'):
+            if status in (200, 206):
+                self.transmitting = True
+                self.factory.pageStart(status == 206)
+        if getattr(self.factory, 'method', 'GET') == 'HEAD' \
+                or status in (204, 304) or status < 200:
+            self._responseDone()
+            return
+        te = ','.join(self.headers.get('transfer-encoding', [])).lower()
+        if te.find('chunked') >= 0:
+            self.chunked = True
+        elif self.headers.has_key('content-length'):
+            self.length = int(self.headers['content-length'][0])
+            if self.length == 0:
+                self._responseDone()
+                return
+            self._extendTimeout(self.length)
+        else:
+            self.untilClose = True
+            self.keepalive = False
+        self.setRawMode()
+
+    def _extendTimeout(self, size):
+        # now that we know how much is coming, allow for moving it
+        if self.timeoutCall and self.timeoutCall.active():
+            timeout = peers.timeout(self.key[0], self.key[1], size)
+            if self.timeoutCall.getTime()-reactor.seconds() < timeout:
+                self.timeoutCall.reset(timeout)
+
+    def rawDataReceived(self, data):
+        if self.factory is None:
+            self.closing = True
+            self.transport.loseConnection()
+            return
+        if self.chunked:
+            self._chunkedData(data)
+        elif self.length is not None:
+            if len(data) < self.length:
+                self._bodyData(data)
+                self.length -= len(data)
+            else:
+                rest = data[self.length:]
+                self._bodyData(data[:self.length])
+                self.length = 0
+                self._responseDone(rest)
+        else:
+            self._bodyData(data)
+
+    def _chunkedData(self, data):
+        data = self.buffer+data
+        self.buffer = ''
+        while data:
+            if self.chunkState == 'size':
+                i = data.find('\r\n')
+                if i < 0:
+                    self.buffer = data
+                    return
+                self.chunkRemaining = int(data[:i].split(';')[0], 16)
+                data = data[i+2:]
+                if self.chunkRemaining == 0:
+                    self.chunkState = 'trailer'
+                else:
+                    self.chunkState = 'body'
+            elif self.chunkState == 'body':
+                piece = data[:self.chunkRemaining]
+                data = data[len(piece):]
+                self.chunkRemaining -= len(piece)
+                self._bodyData(piece)
+                if self.factory is None:
+                    return
+                if self.chunkRemaining == 0:
+                    self.chunkState = 'crlf'
+            elif self.chunkState == 'crlf':
+                if len(data) < 2:
+                    self.buffer = data
+                    return
+                data = data[2:]
+                self.chunkState = 'size'
+            else: # trailer: skip trailing headers up to the blank line
+                i = data.find('\r\n')
+                if i < 0:
+                    self.buffer = data
+                    return
+                line = data[:i]
+                data = data[i+2:]
+                if not line:
+                    self._responseDone(data)
+                    return
+
+    def _bodyData(self, data):
+        if not data:
+            return
+        self.received += len(data)
+        if self.transmitting:
+            try:
+                self.factory.pagePart(data)
+            except:
+                self._fail(failure.Failure())
+        else:
+            self.body.append(data)
+
+    def _responseDone(self, rest=''):
+        self._stopTimeout()
+        factory = self.outstanding.popleft()
+        self.factory = None
+        sent = len(getattr(factory, 'postdata', None) or '')
+        peers.sample(self.key[0], self.key[1], time.time()-self.started,
+                sent+self.received)
+        status = int(self.status)
+        body = ''.join(self.body)
+        self.body = []
+        if not self.keepalive:
+            # (before the callbacks, so nothing they send goes out on this
+            # connection)
+            self.closing = True
+        if self.transmitting:
+            factory.pageEnd()
+        elif 200 <= status < 300 and not hasattr(factory, 'pageStart'):
+            factory.page(body)
+        else:
+            factory.noPage(failure.Failure(weberror.Error(self.status,
+                self.message, body)))
+        if self.closing:
+            self.transport.loseConnection()
+            return
+        if self.factory is not None:
+            # a callback sent another request on this (idle) connection, and
+            # it's already waiting for the response
+            return
+        if self.outstanding:
+            self._startResponse()
+            if rest:
+                self.dataReceived(rest)
+        else:
+            self.setLineMode()
+            self.pool.idle(self)
+
+    def cancel(self, factory, reason):
+        if factory is self.factory:
+            # its response is on its way in; the only way to stop it is to
+            # hang up
+            if self.transmitting and getattr(factory, 'file', None):
+                factory.file.close()
+            # (downloaders leave the files they've written so far behind)
+            for fname in getattr(factory, 'filenames', []):
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+            self._fail(reason)
+        else:
+            self.outstanding[list(self.outstanding).index(factory)] = \
+                    _Discarded(factory)
+            factory.noPage(reason)
+        if not factory.deferred.called:
+            # (downloaders stop listening to noPage once they've started)
+            factory.deferred.errback(reason)
+
+    def _fail(self, reason):
+        self._stopTimeout()
+        if self.outstanding and self.outstanding[0] is self.factory:
+            self.outstanding.popleft()
+        factory = self.factory
+        self.factory = None
+        self.closing = True
+        if factory:
+            factory.noPage(reason)
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self._stopTimeout()
+        if self.idleCall and self.idleCall.active():
+            self.idleCall.cancel()
+        self.idleCall = None
+        self.closing = True
+        if self.factory is not None and self.untilClose \
+                and self.status is not None:
+            # the response was delimited by the connection closing
+            self.keepalive = False
+            self._responseDone()
+        requeue = []
+        if self.factory is not None:
+            factory = self.outstanding.popleft()
+            self.factory = None
+            if self.status is None and not getattr(factory, 'poolRetried',
+                    False) and getattr(factory, 'method', 'GET') in PIPELINED:
+                # server closed a kept-alive connection before answering;
+                # safe to try again
+                factory.poolRetried = True
+                requeue.append(factory)
+            else:
+                peers.failed(*self.key)
+                factory.noPage(failure.Failure(error.ConnectionLost(
+                    "connection to %s:%d lost" % self.key)))
+        # anything pipelined behind it never got an answer
+        requeue.extend(self.outstanding)
+        self.outstanding.clear()
+        self.pool.lost(self, requeue)
+
+class PoolClientFactory(protocol.ClientFactory):
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+
+    def buildProtocol(self, addr):
+        return PooledPageGetter(self.pool, self.key)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.pool.connectFailed(self.key, reason)
+
+class HTTPConnectionPool:
+
+    def __init__(self, maxPerHost=MAXPERHOST, idleTimeout=IDLE_TO,
+            connectTimeout=60, connectTimeoutVar=5):
+        self.maxPerHost = maxPerHost
+        self.idleTimeout = idleTimeout
+        self.connectTimeout = connectTimeout
+        self.connectTimeoutVar = connectTimeoutVar
+        self.conns = {}       # (host, port) -> list of connected protocols
+        self.connecting = {}  # (host, port) -> connection attempts in flight
+        self.waiting = {}     # (host, port) -> deque of factories not yet sent
+
+    def request(self, factory):
+        """
+        Queues factory's request for (factory.host, factory.port).
+        """
+        key = (factory.host, int(factory.port))
+        if not peers.available(*key):
+            _detach(factory)
+            factory.noPage(failure.Failure(PeerUnavailable(
+                "%s:%d has been failing, not trying it for now" % key)))
+            return factory
+        # (if the peer's breaker is open, this is the request let through to
+        # see if it's back)
+        factory.poolTrial = peers.tripped(*key)
+        self.waiting.setdefault(key, deque()).append(factory)
+        self._dispatch(key)
+        return factory
+
+    def cancel(self, factory):
+        """
+        Gives up on factory's request.  Its deferred fails with
+        CancelledError (if it hasn't fired already).
+        """
+        key = (factory.host, int(factory.port))
+        reason = failure.Failure(defer.CancelledError(
+            "request for %s cancelled" % factory.url))
+        if getattr(factory, 'poolTrial', False):
+            peers.abandoned(*key)
+        q = self.waiting.get(key)
+        if q and factory in q:
+            q.remove(factory)
+            if not q:
+                del self.waiting[key]
+            _detach(factory)
+            factory.noPage(reason)
+            return
+        for conn in self.conns.get(key, []):
+            if factory in conn.outstanding:
+                conn.cancel(factory, reason)
+                return
+
+    def _count(self, key):
+        return len(self.conns.get(key, [])) + self.connecting.get(key, 0)
+
+    def _full(self, key, factory):
+        """
+        True if factory can't have a new connection to key.
+        """
+        count = self._count(key)
+        if count < self.maxPerHost:
+            return False
+        if count > self.maxPerHost or _streams(factory):
+            return True
+        # (small requests don't wait for the downloads on every connection)
+        for c in self.conns.get(key, []):
+            if not c.streaming():
+                return True
+        return False
+
+    def _idleConnection(self, key):
+        for c in self.conns.get(key, []):
+            if not c.closing and not c.busy():
+                return c
+        return None
+
+    def _pipelineConnection(self, key):
+        candidates = [c for c in self.conns.get(key, []) if c.pipelinable()]
+        if not candidates:
+            return None
+        candidates.sort(key=lambda c: c.busy())
+        return candidates[0]
+
+    def _dispatch(self, key):
+        q = self.waiting.get(key)
+        while q:
+            conn = self._idleConnection(key)
+            if not conn and self._count(key) >= self.maxPerHost \
+                    and getattr(q[0], 'method', 'GET') in PIPELINED:
+                conn = self._pipelineConnection(key)
+            if not conn:
+                break
+            conn.sendRequest(q.popleft())
+        while q and self.connecting.get(key, 0) < len(q) \
+                and not self._full(key, q[0]):
+            self._connect(key)
+        if not q and self.waiting.has_key(key):
+            del self.waiting[key]
+
+    def _connect(self, key):
+        self.connecting[key] = self.connecting.get(key, 0) + 1
+        to = self.connectTimeout+random.randrange(2+self.connectTimeoutVar)\
+                -self.connectTimeoutVar
+        to = min(to, peers.timeout(*key))
+        reactor.connectTCP(key[0], key[1], PoolClientFactory(self, key),
+                timeout=to)
+
+    def _connectDone(self, key):
+        self.connecting[key] -= 1
+        if not self.connecting[key]:
+            del self.connecting[key]
+
+    def connected(self, conn):
+        self._connectDone(conn.key)
+        self.conns.setdefault(conn.key, []).append(conn)
+        self._dispatch(conn.key)
+        if not conn.busy():
+            self.idle(conn)
+
+    def connectFailed(self, key, reason):
+        self._connectDone(key)
+        peers.failed(*key)
+        if self.conns.get(key) or self.connecting.get(key):
+            # other connections will pick up the queue
+            return
+        q = self.waiting.pop(key, deque())
+        logger.debug("couldn't connect to %s:%d, failing %d requests"
+                % (key[0], key[1], len(q)))
+        for factory in q:
+            _detach(factory)
+            factory.noPage(reason)
+
+    def idle(self, conn):
+        self._dispatch(conn.key)
+        if not conn.busy() and not conn.closing:
+            if conn.idleCall and conn.idleCall.active():
+                conn.idleCall.cancel()
+            conn.idleCall = reactor.callLater(self.idleTimeout,
+                    self._closeIdle, conn)
+
+    def _closeIdle(self, conn):
+        conn.idleCall = None
+        if not conn.busy():
+            conn.closing = True
+            conn.transport.loseConnection()
+
+    def lost(self, conn, requeue):
+        requeue = [f for f in requeue if not getattr(f, 'discarded', False)]
+        conns = self.conns.get(conn.key, [])
+        if conn in conns:
+            conns.remove(conn)
+            if not conns:
+                del self.conns[conn.key]
+        if requeue:
+            q = self.waiting.setdefault(conn.key, deque())
+            requeue.reverse()
+            for factory in requeue:
+                q.appendleft(factory)
+        if self.waiting.has_key(conn.key):
+            self._dispatch(conn.key)
+
+    def closeAll(self):
+        for conns in self.conns.values():
+            for conn in conns:
+                conn.closing = True
+                conn.transport.loseConnection()
+
+class UploadPool:
+    """
+    Thread-safe pool of httplib.HTTPConnections for fileUpload, which runs in
+    worker threads.  Connections are checked out for the length of one
+    request/response and checked back in once the response has been read.
+    """
+    def __init__(self, maxPerHost=MAXPERHOST, idleTimeout=IDLE_TO):
+        self.maxPerHost = maxPerHost
+        self.idleTimeout = idleTimeout
+        self.idle = {}  # (host, port) -> list of (lastused, connection)
+        self.lock = threading.Lock()
+
+    def get(self, host, port, timeout=None):
+        """
+        Returns (connection, reused).  timeout, if given, limits each
+        blocking operation on the connection.
+        """
+        import httplib
+        key = (host, int(port))
+        now = time.time()
+        self.lock.acquire()
+        try:
+            conns = self.idle.get(key, [])
+            while conns:
+                lastused, conn = conns.pop()
+                if now - lastused < self.idleTimeout:
+                    conn.timeout = timeout
+                    if conn.sock:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        finally:
+            self.lock.release()
+        return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+    def release(self, host, port, conn, response):
+        """
+        Returns conn to the pool (response must already have been read).
+        """
+        if response.will_close:
+            conn.close()
+            return
+        key = (host, int(port))
+        self.lock.acquire()
+        try:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.maxPerHost:
+                conns.append((time.time(), conn))
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+httpPool = HTTPConnectionPool()
+uploadPool = UploadPool()
@@ -2,49 +2,203 @@
 ConnectionQueue, (c) 2003-2006 Alen Peacock.  This program is distributed under
 the terms of the GNU General Public License (the GPL), version 3.
 
-This module manages the connection queue.  In order to reduce the 
+This module manages the connection queue.  In order to reduce the
 probability of the reactor getting tied up servicing requests/responses
-during periods of extreme busy-ness (and thus 'starving' some ops, 
+during periods of extreme busy-ness (and thus 'starving' some ops,
 causing TimeoutErrors), we throttle the number of outstanding requests
-that we send to MAXOPS.  The rest, we put in the 'waiting' queue, and
-these are popped off when a spot becomes available.  
+that we send to MAXOPS.  The rest, we put in the 'waiting' queues, and
+these are popped off when a spot becomes available.
+
+Waiting requests are served by priority class (the request's 'priority'
+attribute: DHT lookups first, then auth/ID requests, interactive retrieves,
+and bulk backup traffic last).  Within a class, destinations are served
+round-robin, and no destination ('dest' attribute) gets more than MAXPERDEST
+of the MAXOPS slots, so one slow node can't hold up everything else.
+
+>>> class Req:
+...     def __init__(self, dest, priority):
+...         self.dest, self.priority = dest, priority
+...     def startRequest(self, name):
+...         started.append(name)
+>>> started = []
+>>> q = RequestQueue(maxops=3, maxperdest=2)
+>>> a, b, c = Req('a:1', BULK), Req('a:1', BULK), Req('a:1', BULK)
+>>> for r, n in ((a, 'a1'), (b, 'a2'), (c, 'a3')): q.enqueue((r, n))
+>>> started
+['a1', 'a2']
+>>> q.enqueue((Req('b:1', BULK), 'b1'))
+>>> q.enqueue((Req('c:1', DHT), 'c1'))
+>>> started
+['a1', 'a2', 'b1']
+>>> q.checkWaiting(a)
+>>> started
+['a1', 'a2', 'b1', 'c1']
+>>> q.stats()['waiting']
+1
+>>> q.checkWaiting(b)
+>>> started[-1]
+'a3'
+>>> q.stats()['pending'], q.stats()['waiting']
+(3, 0)
 """
 
-import logging
+import logging, time
+from collections import deque
+
+MAXOPS = 80      # maximum number of concurrent connections to maintain
+MAXPERDEST = 8   # maximum number of those going to any one destination
+
+# priority classes, most urgent first
+DHT = 0          # kademlia lookups/stores
+AUTH = 1         # ID requests, which other ops (and auth) wait on
+INTERACTIVE = 2  # retrieves, which a user is usually waiting on
+BULK = 3         # backup traffic: stores, deletes, verifies
+PRIORITIES = (DHT, AUTH, INTERACTIVE, BULK)
+PRIORITYNAMES = {DHT: 'dht', AUTH: 'auth', INTERACTIVE: 'interactive',
+        BULK: 'bulk'}
 
-MAXOPS = 80      # maximum number of concurrent connections to maintain 
-pending = 0      # number of current connections
-waiting = []     # queue of waiting connections to make.  This queue contains
-                 # tuples.  The first element of the tuple must have a 
-                 # startRequest() func that takes the rest of the tuple as
-                 # arguments.
+WAIT_EWMA = 0.1  # weight of the newest sample in the average wait times
 
 logger = logging.getLogger("flud.client.connq")
 
-def checkWaiting(resp, finishedOne=True):
+class RequestQueue:
+
+    def __init__(self, maxops=MAXOPS, maxperdest=MAXPERDEST):
+        self.maxops = maxops
+        self.maxperdest = maxperdest
+        self.pending = 0     # number of current connections
+        self.active = {}     # dest -> number of current connections to it
+        self.numwaiting = 0
+        # per priority class: dest -> deque of (enqueue time, requestTuple),
+        # and a ring of the dests that have waiting requests and free slots
+        self.queues = {}
+        self.rings = {}
+        self.inring = {}
+        self.waitavg = {}    # per class average wait (seconds)
+        self.waitmax = {}    # per class longest wait seen (seconds)
+        for p in PRIORITIES:
+            self.queues[p] = {}
+            self.rings[p] = deque()
+            self.inring[p] = {}
+            self.waitavg[p] = 0.0
+            self.waitmax[p] = 0.0
+
+    def enqueue(self, requestTuple):
+        req = requestTuple[0]
+        p = self._priority(req)
+        dest = getattr(req, 'dest', None)
+        q = self.queues[p].get(dest)
+        if q is None:
+            q = deque()
+            self.queues[p][dest] = q
+        q.append((time.time(), requestTuple))
+        self.numwaiting += 1
+        if not self.inring[p].has_key(dest):
+            self.rings[p].append(dest)
+            self.inring[p][dest] = True
+        logger.debug("trying to do %s now..." % req.__class__.__name__)
+        self._startWaiting()
+
+    def checkWaiting(self, req=None):
+        """
+        Marks req's slot as free, and starts whatever should go next.
+        """
+        self.pending -= 1
+        dest = getattr(req, 'dest', None)
+        if self.active.has_key(dest):
+            self.active[dest] -= 1
+            if self.active[dest] == self.maxperdest-1:
+                # dest was full, and may have been parked out of the rings
+                for p in PRIORITIES:
+                    if self.queues[p].has_key(dest) \
+                            and not self.inring[p].has_key(dest):
+                        self.rings[p].append(dest)
+                        self.inring[p][dest] = True
+            if not self.active[dest]:
+                del self.active[dest]
+        logger.debug("decremented pending to %s" % self.pending)
+        self._startWaiting()
+
+    def _priority(self, req):
+        p = getattr(req, 'priority', BULK)
+        if p not in PRIORITIES:
+            p = BULK
+        return p
+
+    def _next(self):
+        """
+        Pops the next (enqueue time, requestTuple, priority) to start, or
+        returns None if nothing is startable.
+        """
+        for p in PRIORITIES:
+            ring = self.rings[p]
+            while ring:
+                dest = ring.popleft()
+                if dest is not None \
+                        and self.active.get(dest, 0) >= self.maxperdest:
+                    # parked until one of dest's requests finishes
+                    del self.inring[p][dest]
+                    continue
+                q = self.queues[p][dest]
+                item = q.popleft()
+                if q:
+                    ring.append(dest)
+                else:
+                    del self.queues[p][dest]
+                    del self.inring[p][dest]
+                return item+(p,)
+        return None
+
+    def _startWaiting(self):
+        while self.numwaiting and self.pending < self.maxops:
+            item = self._next()
+            if not item:
+                break
+            queued, requestTuple, p = item
+            self.numwaiting -= 1
+            waited = time.time()-queued
+            self.waitavg[p] += WAIT_EWMA*(waited-self.waitavg[p])
+            if waited > self.waitmax[p]:
+                self.waitmax[p] = waited
+            Req = requestTuple[0]
+            args = requestTuple[1:]
+            dest = getattr(Req, 'dest', None)
+            self.pending += 1
+            if dest is not None:
+                self.active[dest] = self.active.get(dest, 0) + 1
+            logger.debug("w: %d, p: %d, restoring Request %s(%s)"
+                    % (self.numwaiting, self.pending, Req.__class__.__name__,
+                        str(args)))
+            Req.startRequest(*args)
+
+    def stats(self):
+        """
+        Returns a dict of queue metrics: number of pending and waiting
+        requests, and per priority class the queue depth, the average and
+        longest wait before starting, and the number of destinations queued.
+        """
+        result = {'pending': self.pending, 'waiting': self.numwaiting,
+                'destinations': len(self.active), 'classes': {}}
+        for p in PRIORITIES:
+            depth = 0
+            for q in self.queues[p].values():
+                depth += len(q)
+            result['classes'][PRIORITYNAMES[p]] = {'depth': depth,
+                    'avgwait': self.waitavg[p], 'maxwait': self.waitmax[p],
+                    'destinations': len(self.queues[p])}
+        return result
+
+queue = RequestQueue()
+
+def checkWaiting(resp, req=None):
     """
-    This function pops items off the waiting queue and invokes their
-    startRequest() method.  It should eventually be called by any process that
-    also calls queueWaiting() (usually as part of callback/errback chain).  The
-    'resp' object passed in will be returned (so that this function can sit
-    transparently in the errback/callback chain).
+    This function frees up req's slot and starts waiting requests (invoking
+    their startRequest() method).  It should eventually be called by any
+    process that also calls enqueue() (usually as part of callback/errback
+    chain).  The 'resp' object passed in will be returned (so that this
+    function can sit transparently in the errback/callback chain).
     """
-    numwaiting = len(waiting)
-    logger.debug("in checkWaiting, len(waiting) = %d" % numwaiting)
-    #print "resp = %s..." % fencode(long(resp,16))[:8]
-    #print "resp = %s..." % str(resp)
-    global pending
-    if finishedOne:
-        pending = pending - 1
-        logger.debug("decremented pending to %s" % pending)
-    if numwaiting > 0 and pending < MAXOPS:
-        saved = waiting.pop(0)
-        Req = saved[0]
-        args = saved[1:]
-        logger.debug("w: %d, p: %d, restoring Request %s(%s)" % (numwaiting, 
-                pending, Req.__class__.__name__, str(args)))
-        Req.startRequest(*args)
-        pending += 1
+    queue.checkWaiting(req)
     return resp
 
 def enqueue(requestTuple):
@@ -52,8 +206,17 @@ def enqueue(requestTuple):
     Adds a requestTuple to those waiting.  The first element of the tuple must
     have a startRequest() func that takes the rest of the tuple as arguments.
     This startRequest() function will be called with those arguments when it
-    comes off the queue (via checkWaiting).
+    comes off the queue (via checkWaiting).  Its 'priority' and 'dest'
+    attributes, if present, decide when that is.
     """
-    waiting.append(requestTuple)
-    logger.debug("trying to do %s now..." % requestTuple[0].__class__.__name__)
-    checkWaiting(None, finishedOne=False)
+    queue.enqueue(requestTuple)
+
+def stats():
+    return queue.stats()
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
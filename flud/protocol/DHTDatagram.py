@@ -0,0 +1,428 @@
+"""
+DHTDatagram.py (c) 2003-2006 Alen Peacock.  This program is distributed under
+the terms of the GNU General Public License (the GPL), version 3.
+
+A UDP transport for the small kademlia RPCs (ID, kFINDNODE, kFINDVALUE, and
+kSTORE), which otherwise each cost an HTTP request carrying the requester's
+whole public key.  Nodes listen for datagrams on the same port number as
+their HTTP server.
+
+Every datagram starts with a fixed header:
+
+    'FD' ver type txid nodeid port
+
+where type says which message follows, txid (four bytes) is chosen by the
+requester and echoed in the answer, nodeid (32 bytes) is the sender's ID, and
+port (two bytes) is the sender's HTTP port.  The payloads are:
+
+    PING       the sender's public key (WireCodec key message)
+    PONG       the responder's public key
+    FINDNODE   key (32 bytes), padded to MINREQUEST bytes
+    NODES      WireCodec nodes message
+    FINDVALUE  key (32 bytes), padded to MINREQUEST bytes
+    VALUE      kind (a one-byte length and that many bytes), fencoded value
+    STORE      cache ttl (four bytes, 0 to store), key (32 bytes), fencoded
+               value
+    STORED     (empty)
+    ERROR      a message saying why the request was refused
+    TOOBIG     (empty) the answer wouldn't fit in a datagram
+    UNVERIFIED (empty) the responder won't take a STORE from the sender's
+               address until it has answered one of the responder's own
+               datagrams
+
+Requests that go unanswered are sent again, with the wait doubling each time.
+A request that doesn't fit in MAXDATAGRAM bytes, or whose answer wouldn't,
+fails with DatagramTooBig, and one that is never answered fails with a
+TimeoutError; the client primitives then send it over HTTP instead.  Nodes
+that never answer datagrams are remembered for a while, so requests to them
+go straight to HTTP.
+
+Since a datagram's source address can be forged, a node only believes that a
+node is at the address a datagram came from once that address has answered a
+request of its own (txids are random, so only a node really at the address
+sees them).  Until then it takes no routing updates or STOREs from there --
+it PINGs the address instead -- and won't send more than AMPLIFICATION times
+as many bytes back as it was sent, so that it can't be used to flood someone
+else's address; answers that don't fit come back TOOBIG, and go over HTTP.
+
+>>> msg = encodeMessage(FINDNODE, 7, 2**255, 8080, _packKey(5))
+>>> t, txid, id, port, payload = decodeMessage(msg)
+>>> t == FINDNODE, txid, id == 2**255, port, _unpackKey(payload)
+(True, 7, True, 8080, 5L)
+>>> len(encodeMessage(FINDNODE, 7, 2**255, 8080, _pad(_packKey(5))))
+512
+>>> decodeMessage(msg[:10])
+Traceback (most recent call last):
+    ...
+ValueError: truncated datagram
+"""
+
+import struct, time, random, logging
+from twisted.internet import reactor, defer, error
+from twisted.internet.protocol import DatagramProtocol
+from twisted.python import failure
+
+from flud.FludCrypto import FludRSA
+from flud.FludCache import TTLCache
+from flud.fencode import fencode, fdecode
+
+import WireCodec
+from ServerDHTPrimitives import closestNodes, localValue, valueCache, \
+        DatagramStoreVal, CACHE_MAXTTL
+from FludCommUtil import *
+
+logger = logging.getLogger("flud.comm.dgram")
+
+VERSION = 1
+MAXDATAGRAM = 8192      # largest datagram we send or accept (bytes)
+RETRIES = (0.5, 1, 2)   # seconds to wait for an answer before each resend
+NOUDP_TTL = 3600        # how long to use http for nodes that didn't answer
+RESOLVE_TTL = 600       # how long to trust a host name -> IP lookup
+VERIFIED_TTL = 3600     # how long to trust an address that answered us
+CHALLENGE_TTL = 600     # how long to wait before PINGing an address again
+MINREQUEST = 512        # find requests are padded to this size (bytes)
+AMPLIFICATION = 4       # most bytes to send per byte from unverified address
+
+PING, PONG, FINDNODE, NODES, FINDVALUE, VALUE, STORE, STORED, ERROR, \
+        TOOBIG, UNVERIFIED = range(1, 12)
+REQUESTS = (PING, FINDNODE, FINDVALUE, STORE)
+
+HEADER = struct.Struct(">2sBBI32sH")  # magic, ver, type, txid, nodeid, port
+_ttl = struct.Struct(">I")
+
+def _packKey(key):
+    return ("%064x" % key).decode('hex')
+
+def _unpackKey(data):
+    if len(data) != WireCodec.IDLEN:
+        raise ValueError("bad key length")
+    return long(data.encode('hex'), 16)
+
+def _pad(payload):
+    return payload+'\0'*(MINREQUEST-HEADER.size-len(payload))
+
+def encodeMessage(type, txid, nodeID, port, payload=''):
+    """
+    nodeID is a long.
+    """
+    return HEADER.pack('FD', VERSION, type, txid, _packKey(nodeID),
+            port)+payload
+
+def decodeMessage(msg):
+    """
+    Returns (type, txid, nodeID, port, payload).
+    """
+    if len(msg) < HEADER.size:
+        raise ValueError("truncated datagram")
+    magic, version, type, txid, nodeID, port = HEADER.unpack_from(msg)
+    if magic != 'FD' or version != VERSION:
+        raise ValueError("not a version %d DHT datagram" % VERSION)
+    return type, txid, long(nodeID.encode('hex'), 16), port, \
+            msg[HEADER.size:]
+
+
+class DHTProtocol(DatagramProtocol):
+    """
+    Both ends of the DHT datagram transport: the client methods (ping,
+    findNode, findValue, store) return deferreds, and datagramReceived
+    answers other nodes' requests.
+    """
+    def __init__(self, node):
+        self.node = node
+        self.config = node.config
+        self.nodeID = long(self.config.nodeID, 16)
+        self.pending = {}    # txid -> [deferred, (ip, port), msg, tries, call]
+        self.noUDP = {}      # (host, port) -> when it last failed to answer
+        self.addrs = TTLCache(1024, RESOLVE_TTL)  # host -> IP address
+        # (ip, port) -> ID of the node that answered us from there
+        self.verified = TTLCache(4096, VERIFIED_TTL)
+        self.challenged = TTLCache(1024, CHALLENGE_TTL)  # (ip, port) pinged
+        self.pingSize = HEADER.size+len(WireCodec.encodeKu(
+            self.config.Ku.exportPublicKey()))
+        self.sent = 0
+        self.retries = 0
+
+    def reachable(self, host, port):
+        """
+        True unless host:port recently failed to answer a datagram.
+        """
+        failed = self.noUDP.get((host, port))
+        if failed is None:
+            return True
+        if time.time()-failed > NOUDP_TTL:
+            del self.noUDP[(host, port)]
+            return True
+        return False
+
+    def ping(self, host, port):
+        """
+        Asks host:port for its public key (an ID request).  Fires with the key
+        as a FludRSA.
+        """
+        Ku = WireCodec.encodeKu(self.config.Ku.exportPublicKey())
+        d = self._request(host, port, PING, Ku)
+        d.addCallback(self._gotPong)
+        return d
+
+    def findNode(self, host, port, key):
+        """
+        Fires with the {'id': hexid, 'k': [nodes]} answer to a kFINDNODE.
+        """
+        d = self._request(host, port, FINDNODE, _pad(_packKey(key)))
+        d.addCallback(self._gotNodes)
+        return d
+
+    def findValue(self, host, port, key):
+        """
+        Fires with a kFINDNODE-style answer, or with (kind, value, hexid) if
+        host:port has the value.
+        """
+        d = self._request(host, port, FINDVALUE, _pad(_packKey(key)))
+        d.addCallback(self._gotValue)
+        return d
+
+    def store(self, host, port, key, val, cachettl=None):
+        """
+        Stores val (already fencoded) under key at host:port, or just caches
+        it there for cachettl seconds.
+        """
+        payload = _ttl.pack(cachettl or 0)+_packKey(key)+val
+        d = self._request(host, port, STORE, payload)
+        d.addCallback(self._gotStored)
+        return d
+
+    def _request(self, host, port, type, payload):
+        if HEADER.size+len(payload) > MAXDATAGRAM:
+            return defer.fail(DatagramTooBig("%d byte request" 
+                % (HEADER.size+len(payload))))
+        d = self._resolve(host)
+        d.addCallback(self._send, host, port, type, payload)
+        return d
+
+    def _resolve(self, host):
+        ip = self.addrs.get(host)
+        if ip:
+            return defer.succeed(ip)
+        d = reactor.resolve(host)
+        d.addCallback(self._resolved, host)
+        return d
+
+    def _resolved(self, ip, host):
+        self.addrs.put(host, ip)
+        return ip
+
+    def _send(self, ip, host, port, type, payload):
+        txid = random.getrandbits(32)
+        while self.pending.has_key(txid):
+            txid = random.getrandbits(32)
+        msg = encodeMessage(type, txid, self.nodeID, self.config.port, payload)
+        d = defer.Deferred()
+        self.pending[txid] = [d, (ip, port), msg, 0, None]
+        self._transmit(txid)
+        d.addErrback(self._failed, host, port)
+        return d
+
+    def _transmit(self, txid):
+        entry = self.pending[txid]
+        d, addr, msg, tries, call = entry
+        if tries >= len(RETRIES):
+            del self.pending[txid]
+            d.errback(error.TimeoutError("no answer to DHT datagram from"
+                " %s:%d" % addr))
+            return
+        if tries:
+            self.retries += 1
+        self.sent += 1
+        self.transport.write(msg, addr)
+        entry[3] = tries+1
+        entry[4] = reactor.callLater(RETRIES[tries], self._transmit, txid)
+
+    def _failed(self, err, host, port):
+        if err.check(error.TimeoutError):
+            logger.info("%s:%d doesn't answer DHT datagrams" % (host, port))
+            self.noUDP[(host, port)] = time.time()
+        return err
+
+    def datagramReceived(self, data, addr):
+        try:
+            type, txid, nodeID, port, payload = decodeMessage(data)
+        except ValueError, inst:
+            logger.debug("ignoring datagram from %s:%d: %s"
+                    % (addr[0], addr[1], inst))
+            return
+        if type in REQUESTS:
+            if self.verified.get(addr) == nodeID:
+                limit = MAXDATAGRAM
+            else:
+                limit = len(data)*AMPLIFICATION
+            try:
+                self._answer(type, txid, nodeID, port, payload, addr, limit)
+            except Exception, inst:
+                logger.info("bad DHT datagram from %s:%d: %s"
+                        % (addr[0], addr[1], inst))
+                self._reply(ERROR, txid, addr, str(inst), limit)
+            return
+        entry = self.pending.get(txid)
+        if entry is None or entry[1] != addr:
+            # a late answer to a request we resent (or someone's noise)
+            return
+        del self.pending[txid]
+        if entry[4].active():
+            entry[4].cancel()
+        self.verified.put(addr, nodeID)
+        d = entry[0]
+        if type == ERROR:
+            d.errback(DatagramRefused(payload))
+        elif type == TOOBIG:
+            d.errback(DatagramTooBig("answer from %s:%d" % addr))
+        elif type == UNVERIFIED:
+            d.errback(DatagramUnverified("%s:%d hasn't heard from us"
+                % addr))
+        else:
+            d.callback((type, nodeID, payload))
+
+    def _gotPong(self, response):
+        type, nodeID, payload = response
+        if type != PONG:
+            raise ValueError("expected PONG, got %d" % type)
+        nKu = FludRSA.importPublicKey(WireCodec.decodeKu(payload))
+        if long(nKu.id(), 16) != nodeID:
+            raise ImposterException("PONG key doesn't match sender's ID")
+        return nKu
+
+    def _gotNodes(self, response):
+        type, nodeID, payload = response
+        if type != NODES:
+            raise ValueError("expected NODES, got %d" % type)
+        return WireCodec.decodeNodes(payload)
+
+    def _gotValue(self, response):
+        type, nodeID, payload = response
+        if type == NODES:
+            return WireCodec.decodeNodes(payload)
+        if type != VALUE or not payload:
+            raise ValueError("expected VALUE or NODES, got %d" % type)
+        l = ord(payload[0])
+        return (payload[1:1+l], payload[1+l:], "%064x" % nodeID)
+
+    def _gotStored(self, response):
+        type, nodeID, payload = response
+        if type != STORED:
+            raise ValueError("expected STORED, got %d" % type)
+        return ""
+
+    """
+    Server side
+    """
+    def _reply(self, type, txid, addr, payload, limit):
+        """
+        Answers addr, or tells it the answer is too big if it's more than
+        limit bytes.
+        """
+        msg = encodeMessage(type, txid, self.nodeID, self.config.port, payload)
+        if len(msg) > min(limit, MAXDATAGRAM):
+            msg = encodeMessage(TOOBIG, txid, self.nodeID, self.config.port)
+        self.transport.write(msg, addr)
+
+    def _answer(self, type, txid, nodeID, port, payload, addr, limit):
+        self.node.DHTtstamp = time.time()
+        host = getCanonicalIP(addr[0])
+        reqID = "%064x" % nodeID
+        verified = self.verified.get(addr) == nodeID
+        if type == PING:
+            logger.info("received ID datagram from %s..." % reqID[:10])
+            reqKu = FludRSA.importPublicKey(WireCodec.decodeKu(payload))
+            if reqKu.id() != reqID:
+                raise ValueError("requesting node's ID and public key do"
+                        " not match")
+            if verified:
+                updateNode(self.node.client, self.config, host, port, reqKu,
+                        reqID)
+            else:
+                limit -= self._challenge(host, port, addr, limit)
+            self._reply(PONG, txid, addr,
+                    WireCodec.encodeKu(self.config.Ku.exportPublicKey()),
+                    limit)
+            return
+        if verified:
+            updateNode(self.node.client, self.config, host, port, None, reqID)
+        else:
+            limit -= self._challenge(host, port, addr, limit)
+        if type == FINDNODE:
+            key = _unpackKey(payload[:WireCodec.IDLEN])
+            logger.info("received kFINDNODE datagram from %s..."
+                    % reqID[:10])
+            self._replyNodes(txid, addr, closestNodes(self.config, key),
+                    limit)
+        elif type == FINDVALUE:
+            key = _unpackKey(payload[:WireCodec.IDLEN])
+            logger.info("received kFINDVALUE datagram from %s..."
+                    % reqID[:10])
+            found = localValue(self.config, fencode(key), reqID)
+            if found:
+                kind, val = found
+                self._reply(VALUE, txid, addr, chr(len(kind))+kind+val,
+                        limit)
+            else:
+                self._replyNodes(txid, addr,
+                        self.config.routing.findNode(key), limit)
+        elif type == STORE:
+            logger.info("received kSTORE datagram from %s..." % reqID[:10])
+            if not verified:
+                # the owner checks trust reqID, which anyone could forge
+                self._reply(UNVERIFIED, txid, addr, '', limit)
+                return
+            msg = self._store(payload, reqID)
+            if msg:
+                self._reply(ERROR, txid, addr, msg, limit)
+            else:
+                self._reply(STORED, txid, addr, '', limit)
+
+    def _challenge(self, host, port, addr, limit):
+        """
+        PINGs a node that sent us a datagram from an address that hasn't
+        answered one of ours yet, if that leaves at least as much of limit
+        for the answer; if the address answers, the node goes into the
+        routing table.  Returns how many bytes were sent.
+        """
+        cost = self.pingSize*len(RETRIES)  # (if it's never answered)
+        if self.challenged.has_key(addr) or cost*2 > limit:
+            return 0
+        self.challenged.put(addr, True)
+        d = self.ping(addr[0], addr[1])
+        d.addCallback(self._verified, host, port)
+        d.addErrback(lambda err: None)
+        return cost
+
+    def _verified(self, nKu, host, port):
+        updateNode(self.node.client, self.config, host, port, nKu, nKu.id())
+
+    def _replyNodes(self, txid, addr, nodes, limit):
+        msg = WireCodec.encodeNodes(self.config.nodeID, nodes)
+        if len(msg)+HEADER.size > min(limit, MAXDATAGRAM):
+            # leave out the keys; the requester asks for those it needs
+            msg = WireCodec.encodeNodes(self.config.nodeID,
+                    [n[:3] for n in nodes])
+        self._reply(NODES, txid, addr, msg, limit)
+
+    def _store(self, payload, reqID):
+        (cachettl,) = _ttl.unpack_from(payload)
+        key = _unpackKey(payload[_ttl.size:_ttl.size+WireCodec.IDLEN])
+        val = payload[_ttl.size+WireCodec.IDLEN:]
+        key = fencode(key)
+        md = fdecode(val)
+        storer = DatagramStoreVal(self.node, self.config)
+        if not cachettl:
+            return storer.storeVal(key, md, reqID)
+        if not storer.cacheAllowed(key, md):
+            return "malformed cache data"
+        logger.info("caching dht data for %s for %ds" % (key, cachettl))
+        valueCache.put(key, val, min(cachettl, CACHE_MAXTTL))
+        return None
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
@@ -6,22 +6,81 @@ flud client ops.
 """
 
 from twisted.web import client
-from twisted.internet import error
-import os, stat, httplib, sys, logging
+from twisted.internet import error, defer
+import os, stat, httplib, sys, logging, socket, shutil, time
 
+from flud.FludCache import TTLCache
 from ClientPrimitives import *
 from ClientDHTPrimitives import *
+from Coalescer import Coalescer
 import FludCommUtil
 
 logger = logging.getLogger('flud.client')
 
+NODECACHESIZE = 4096   # kFindNode results (mostly nodeID -> contact) to keep
+NODECACHE_TTL = 600    # how long to trust them (seconds)
+VALUECACHESIZE = 1024  # kFindValue results to keep
+VALUECACHE_TTL = 120   # how long to trust them (seconds)
+
+# failures that say a contact is no longer good
+CONTACTERRORS = (error.ConnectionRefusedError, error.TimeoutError, 
+        error.ConnectionLost, error.NoRouteError, error.DNSLookupError,
+        defer.TimeoutError, socket.error, PeerUnavailable)
+
 class FludClient(object):
     """
     This class contains methods which create request objects
     """
     def __init__(self, node):
         self.node = node
-        self.currentStorOps = {}
+        # identical requests made while one is in flight share it
+        self.inflight = Coalescer()
+        self.links = 0
+        # results of recent DHT lookups, so that batches of file ops that
+        # keep asking about the same nodes and keys don't redo them
+        self.nodeCache = TTLCache(NODECACHESIZE, NODECACHE_TTL)
+        # nodeID -> when its contact last failed.  Cached lookups (under any
+        # key) made before then don't hand that contact out again.
+        self.failed = TTLCache(NODECACHESIZE, NODECACHE_TTL)
+        self.valueCache = TTLCache(VALUECACHESIZE, VALUECACHE_TTL)
+
+    def contactFailed(self, nodeID):
+        """
+        Forgets cached lookups for nodeID (a long), so the next one goes out
+        to the DHT, and keeps its contact out of any other cached lookups
+        that list it.
+        """
+        if self.nodeCache.has_key(nodeID):
+            logger.debug("dropping cached contact for %x" % nodeID)
+        self.nodeCache.remove(nodeID)
+        self.failed.put(nodeID, time.time())
+        self.node.config.contacts.remove(nodeID)
+
+    def _checkContact(self, err, nKu):
+        if nKu and err.check(*CONTACTERRORS):
+            self.contactFailed(long(nKu.id(), 16))
+        return err
+
+    def _linkFiles(self, files):
+        """
+        Gives another waiter on a shared retrieve its own hard links to the
+        retrieved files, so that each waiter can remove its files when done
+        with them; the data goes away with the last link.  (Links are given
+        a prefix, since the files are found by their suffixes.)
+        """
+        self.links += 1
+        result = []
+        for f in files:
+            dir, name = os.path.split(f)
+            link = os.path.join(dir, "%d-%s" % (self.links, name))
+            if os.path.exists(link):
+                os.remove(link)
+            try:
+                os.link(f, link)
+            except (OSError, AttributeError):
+                shutil.copyfile(f, link)
+            result.append(link)
+        return result
     
     """
     Data storage primitives
@@ -36,38 +95,26 @@ class FludClient(object):
             return f
 
     def sendGetID(self, host, port):
-        #return SENDGETID(self.node, host, port).deferred
-        d = SENDGETID(self.node, host, port).deferred
-        #d.addErrback(self.redoTO, self.node, host, port)
-        return d
+        # (updateNode can ask for the same node's ID many times at once)
+        return self.inflight.call('ID', host, port, None, 
+                lambda: SENDGETID(self.node, host, port).deferred, copier=None)
 
     # XXX: we should cache nKu so that we don't do the GETID for all of these
     # ops every single time
     def sendStore(self, filename, metadata, host, port, nKu=None):
-        # XXX: need to keep a map of 'filename' to deferreds, in case we are
-        # asked to store the same chunk more than once concurrently (happens
-        # for 0-byte files or from identical copies of the same file, for
-        # example).  both SENDSTORE and AggregateStore will choke on this.
-        # if we find a store req in said map, just return that deferred instead
-        # of redoing the op. [note, could mess up node choice... should also do
-        # this on whole-file level in FileOps]
-
-        # XXX: need to remove from currentStorOps on success or failure
-        key = "%s:%d:%s" % (host, port, filename)
-
-        if self.currentStorOps.has_key(key):
-            logger.debug("returning saved deferred for %s in sendStore" 
-                    % filename)
-            return self.currentStorOps[key]
+        # the same block can be asked to be stored more than once at a time
+        # (happens for 0-byte files or from identical copies of the same
+        # file, for example), and both SENDSTORE and AggregateStore would
+        # choke on that.  So it is only stored once.  [note, could mess up
+        # node choice... should also do this on whole-file level in FileOps]
+        return self.inflight.call('STORE', host, port, filename,
+                lambda: self._sendStore(filename, metadata, host, port, nKu))
 
+    def _sendStore(self, filename, metadata, host, port, nKu):
         def sendStoreWithnKu(nKu, host, port, filename, metadata):
             return SENDSTORE(nKu, self.node, host, port, filename, 
                     metadata).deferred
 
-        def removeKey(r, key):
-            self.currentStorOps.pop(key)
-            return r
-
         if not nKu:
             # XXX: doesn't do AggregateStore if file is small.  Can fix by
             #      moving this AggStore v. SENDSTORE choice into SENDSTORE 
@@ -78,7 +125,6 @@ class FludClient(object):
                     " of missing nKu"
             d = self.sendGetID(host, port)
             d.addCallback(sendStoreWithnKu, host, port, filename, metadata)
-            self.currentStorOps[key] = d
             return d
 
         fsize = os.stat(filename)[stat.ST_SIZE];
@@ -92,14 +138,23 @@ class FludClient(object):
             logger.debug("SENDSTORE")
             d = SENDSTORE(nKu, self.node, host, port, filename, 
                     metadata).deferred
-        self.currentStorOps[key] = d
-        d.addBoth(removeKey, key)
+        d.addErrback(self._checkContact, nKu)
         return d
     
     # XXX: need a version that takes a metakey, too
     def sendRetrieve(self, filekey, host, port, nKu=None, metakey=True):
+        # concurrent retrieves of the same block (e.g., by file retrieves
+        # that share blocks) share one download, and each gets its own links
+        # to the files
+        return self.inflight.call('RETRIEVE', host, port, (filekey, metakey),
+                lambda: self._sendRetrieve(filekey, host, port, nKu, metakey),
+                copier=self._linkFiles)
+
+    def _sendRetrieve(self, filekey, host, port, nKu, metakey):
+        # retrieves are batched per node by AggregateRetrieve, so that many
+        # blocks from the same node come back in a single response
         def sendRetrieveWithNKu(nKu, host, port, filekey, metakey=True):
-            return SENDRETRIEVE(nKu, self.node, host, port, filekey, 
+            return AggregateRetrieve(nKu, self.node, host, port, filekey, 
                     metakey).deferred
 
         if not nKu:
@@ -107,8 +162,10 @@ class FludClient(object):
             d.addCallback(sendRetrieveWithNKu, host, port, filekey, metakey)
             return d
         else:
-            return SENDRETRIEVE(nKu, self.node, host, port, filekey,
+            d = AggregateRetrieve(nKu, self.node, host, port, filekey,
                     metakey).deferred
+            d.addErrback(self._checkContact, nKu)
+            return d
     
     def sendVerify(self, filekey, offset, length, host, port, nKu=None, 
             meta=None):
@@ -125,6 +182,7 @@ class FludClient(object):
         else:
             s = SENDVERIFY(nKu, self.node, host, port, filekey, offset, length,
                     meta)
+            s.deferred.addErrback(self._checkContact, nKu)
             return s.deferred
     
     def sendDelete(self, filekey, metakey, host, port, nKu=None):
@@ -137,8 +195,10 @@ class FludClient(object):
             d.addCallback(sendDeleteWithNKu, host, port, filekey, metakey)
             return d
         else:
-            return SENDDELETE(nKu, self.node, host, port, filekey,
+            d = SENDDELETE(nKu, self.node, host, port, filekey,
                     metakey).deferred
+            d.addErrback(self._checkContact, nKu)
+            return d
     
     """
     DHT single primitives (single call to single peer).  These should probably
@@ -147,23 +207,82 @@ class FludClient(object):
     recursive primitives for doing DHT ops.
     """
     def sendkFindNode(self, host, port, key):
-        return SENDkFINDNODE(self.node, host, port, key).deferred
+        return self.inflight.call('nodes', host, port, key,
+                lambda: SENDkFINDNODE(self.node, host, port, key).deferred)
 
     def sendkStore(self, host, port, key, val):
         return SENDkSTORE(self.node, host, port, key, val).deferred
 
     def sendkFindValue(self, host, port, key):
-        return SENDkFINDVALUE(self.node, host, port, key).deferred
+        return self.inflight.call('meta', host, port, key,
+                lambda: SENDkFINDVALUE(self.node, host, port, key).deferred)
     
     """
     DHT recursive primitives (recursive calls to muliple peers)
     """
     def kFindNode(self, key):
-        return kFindNode(self.node, key).deferred
+        cached = self.nodeCache.get(key)
+        if cached:
+            when, nodes = cached
+            nodes = [n for n in nodes if self.failed.get(n[2], 0) < when]
+            if nodes:
+                logger.debug("kFindNode(%x) answered from cache" % key)
+                return defer.succeed({'k': nodes})
+        return self.inflight.call('kFindNode', None, None, key,
+                lambda: kFindNode(self.node, key).deferred.addCallback(
+                    self._cacheNodes, key))
+
+    def _cacheNodes(self, result, key):
+        if isinstance(result, dict) and result.get('k'):
+            self.nodeCache.put(key, (time.time(), result['k'][:]))
+        return result
+
+    def locate(self, nodeID, lookup=False):
+        """
+        Returns a deferred that fires with the (host, port, nodeID, Ku n)
+        contact for nodeID (a long).  The routing table and the contact cache
+        are tried first, and the DHT only if neither has it (or if lookup is
+        True, e.g., because the address they had didn't answer).  Fails with
+        LookupError if the DHT doesn't know the node either.
+        """
+        if not lookup:
+            node = self.node.config.routing.getNode(nodeID)
+            if not node or len(node) < 4:
+                node = self.node.config.contacts.get(nodeID)
+            if node:
+                return defer.succeed(node)
+            logger.debug("no contact for %x, looking it up" % nodeID)
+        d = self.kFindNode(nodeID)
+        d.addCallback(self._located, nodeID)
+        return d
+
+    def _located(self, kdata, nodeID):
+        if not kdata['k'] or kdata['k'][0][2] != nodeID:
+            raise LookupError("couldn't find node %x" % nodeID)
+        return kdata['k'][0]
     
     def kStore(self, key, val):
-        return kStore(self.node, key, val).deferred
+        self.valueCache.remove(key)
+        d = kStore(self.node, key, val).deferred
+        def invalidate(r):
+            # (the value found by a lookup that overlapped the store is stale)
+            self.valueCache.remove(key)
+            return r
+        d.addBoth(invalidate)
+        return d
     
     def kFindValue(self, key):
-        return kFindValue(self.node, key).deferred
+        cached = self.valueCache.get(key)
+        if cached != None:
+            logger.debug("kFindValue(%x) answered from cache" % key)
+            return defer.succeed(cached)
+        return self.inflight.call('kFindValue', None, None, key,
+                lambda: kFindValue(self.node, key).deferred.addCallback(
+                    self._cacheValue, key), copier=None)
+
+    def _cacheValue(self, result, key):
+        # only found values are cached; a miss may be filled in any time
+        if isinstance(result, str):
+            self.valueCache.put(key, result)
+        return result
     
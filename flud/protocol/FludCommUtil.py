@@ -5,28 +5,41 @@ the terms of the GNU General Public License (the GPL), version 3.
 Communications routines used by both client and server code.
 """
 from twisted.web import client
-from twisted.internet import reactor, defer
+from twisted.internet import reactor, defer, threads
+from twisted.python.threadpool import ThreadPool
 from twisted.python import failure
-import binascii, httplib, logging, os, stat, random, socket
+import binascii, httplib, logging, os, stat, random, socket, time
 import inspect
 
 from flud.FludExceptions import FludException
 from flud.FludCrypto import FludRSA, generateRandom
+from flud.FludCache import TTLCache
 from flud.HTTPMultipartDownloader import HTTPMultipartDownloader
+from ConnectionPool import httpPool, uploadPool
+from PeerStats import peers, backoff, PeerUnavailable
 
 """
 Some constants used by the Flud Protocol classes
 """
 PROTOCOL_VERSION = '0.2'
-# XXX: when things timeout, bad news.  Unintuitive exceptions spewed.  Make this
-#      small and fix all issues.
+# requests get timeouts from what PeerStats has measured of their peers (see
+# REQUEST._timeout); these are what's left for things that aren't requests
 primitive_to = 3800 # default timeout for primitives
 kprimitive_to = primitive_to/2  # default timeout for kademlia primitives
-#kprimitive_to = 10 # default timeout for kademlia primitives
 transfer_to = 3600 # 10-hr limit on file transfers
 MAXTIMEOUTS = 5  # number of times to retry after connection timeout failure
 CONNECT_TO = 60
 CONNECT_TO_VAR = 5
+MAXBATCHKEYS = 64  # max number of blocks fetched by a single batch RETRIEVE
+BATCHNOTFOUND = "Not found: none of the blocks"  # batch RETRIEVE 404 message
+MAXKSTORESIZE = 1024*1024  # max size of a kSTORE value (request body)
+NODEUPDATE_TO = 30  # min seconds between routing table updates for a node
+MAXSIGHTINGS = 8192 # prune node sightings when there are more than this
+CANONICAL_TTL = 3600    # how long to trust a name lookup (seconds)
+CANONICAL_NEGTTL = 300  # ... or a failed one
+CANONICAL_MAXAGE = 24*3600  # how long a stale lookup stands in for a new one
+MAXCANONICAL = 4096     # name lookups to keep
+RESOLVERTHREADS = 4     # threads doing name lookups
 
 logger = logging.getLogger('flud.comm')
 
@@ -36,9 +49,25 @@ class BadCASKeyException(failure.DefaultException):
 class NotFoundException(failure.DefaultException):
     pass
 
+class BatchNotFoundException(NotFoundException):
+    # a node that handles batch RETRIEVEs has none of the blocks asked for
+    pass
+
 class BadRequestException(failure.DefaultException):
     pass
 
+class DatagramRefused(failure.DefaultException):
+    # the node answered a DHT datagram with an error (don't retry over http)
+    pass
+
+class DatagramTooBig(failure.DefaultException):
+    # the request or its answer doesn't fit in a DHT datagram
+    pass
+
+class DatagramUnverified(failure.DefaultException):
+    # the node won't take the request until our address has answered it
+    pass
+
 
 i = 0
 """
@@ -53,24 +82,76 @@ def updateNodes(client, config, nodes):
         host = i[0]
         port = i[1]
         nID = i[2]
-        nKu = FludRSA.importPublicKey(i[3])
-        updateNode(client, config, host, port, nKu, nID)
+        nKu = None
+        if len(i) > 3:
+            nKu = FludRSA.importPublicKey(i[3])
+        # (these are other nodes' word for it, not sightings)
+        updateNode(client, config, host, port, nKu, nID, heard=False)
+
+nodeSightings = {}  # nodeID -> [last updated, host, port, last heard from]
+
+def lastSeen(nID):
+    """
+    Returns when we last heard from nID (a hex string), or None.
+    """
+    sighting = nodeSightings.get(nID)
+    if sighting:
+        return sighting[3]
+    return None
+
+def _debounced(nID, host, port, heard=True):
+    # notes the sighting (if we heard from the node itself), and says
+    # whether the node's records were updated (from the same address)
+    # recently enough to skip doing it again
+    sighting = nodeSightings.get(nID)
+    if sighting and sighting[1] == host and sighting[2] == port:
+        now = time.time()
+        if heard:
+            sighting[3] = now
+        return now-sighting[0] < NODEUPDATE_TO
+    return False
+
+def _updated(nID, host, port, heard=True):
+    now = time.time()
+    if len(nodeSightings) >= MAXSIGHTINGS:
+        for i in [i for i in nodeSightings 
+                if now-max(nodeSightings[i][0], nodeSightings[i][3]) 
+                    > NODEUPDATE_TO]:
+            del nodeSightings[i]
+    seen = 0
+    if heard:
+        seen = now
+    elif nodeSightings.has_key(nID) and nodeSightings[nID][1:3] == [host, port]:
+        seen = nodeSightings[nID][3]
+    nodeSightings[nID] = [now, host, port, seen]
 
 updateNodePendingGETID = {}
-def updateNode(client, config, host, port, nKu=None, nID=None):
+def updateNode(client, config, host, port, nKu=None, nID=None, heard=True):
     """
     Updates this node's view of the given node.  This includes updating
-    the known-nodes record, trust, and routing table information
+    the known-nodes record, trust, and routing table information.  Since
+    this is called for every request, it is debounced: a node that was
+    updated (from the same host:port) less than NODEUPDATE_TO seconds ago
+    only has its last-seen time noted.  heard is False for nodes that other
+    nodes told us about, which don't count as having been seen (by
+    lastSeen(), or for the contact cache).
     """
     def updateNodeFail(failure, host, port):
         logging.getLogger('flud').log(logging.INFO,
                 "couldn't get nodeID from %s:%d: %s" % (host, port, failure))
 
     def callUpdateNode(nKu, client, config, host, port, nID):
+        # (it answered the GETID itself)
         return updateNode(client, config, host, port, nKu, nID)
 
     if isinstance(nID, long):
         nID = "%064x" % nID
+    elif nID is None and isinstance(nKu, FludRSA):
+        # (most responses come with only the key; id() is memoized)
+        nID = nKu.id()
+
+    if nID is not None and _debounced(nID, host, port, heard):
+        return
 
     if nKu is None:
         #print "updateNode, no nKu"
@@ -82,7 +163,8 @@ def updateNode(client, config, host, port, nKu=None, nID=None):
             #print "updateNode, no nKu but got a nID"
             if config.nodes.has_key(nID):
                 return updateNode(client, config, host, port, 
-                        FludRSA.importPublicKey(config.nodes[nID]['Ku']), nID)
+                        FludRSA.importPublicKey(config.nodes[nID]['Ku']), nID,
+                        heard)
             elif updateNodePendingGETID.has_key(nID):
                 pass
             else:
@@ -108,13 +190,15 @@ def updateNode(client, config, host, port, nKu=None, nID=None):
         # routing
         node = (host, port, long(nID, 16), nKu.exportPublicKey()['n'])
         replacee = config.routing.updateNode(node)
+        if heard:
+            config.contacts.put(node)
+        _updated(nID, host, port, heard)
         #logger.info("knownnodes now: %s" % config.routing.knownNodes())
         #print "knownnodes now: %s" % config.routing.knownNodes()
-        if replacee != None:
-            logging.getLogger('flud').info(
-                    "determining if replacement in ktable is needed")
-            s = SENDGETID(replacee[0], replacee[1])
-            s.addErrback(replaceNode, config.routing, replacee, node)
+        if replacee != None and getattr(client.node, 'prober', None):
+            # node's bucket is full, and node went to the replacement cache.
+            # if the bucket's oldest node is dead, node will take its place.
+            client.node.prober.probe(replacee)
     else:
         #print "updateNode nKu=%s, type=%s" % (nKu, type(nKu))
         logging.getLogger('flud').warn( 
@@ -132,9 +216,6 @@ def updateNode(client, config, host, port, nKu=None, nID=None):
             % (type(nKu), type(nID)))
         # XXX: should really make it impossible to call without one of these...
 
-def replaceNode(error, routing, replacee, replacer):
-    routing.replaceNode(replacee, replacer) 
-    print "replaced node in ktable"
 
 def requireParams(request, paramNames):
     # Looks for the named parameters in request.  If found, returns
@@ -148,14 +229,95 @@ def requireParams(request, paramNames):
             raise Exception, "missing parameter '"+i+"'" #XXX: use cust Exc
     return params
 
+# host name -> [IP, time after which it's looked up again]
+canonicalIPs = TTLCache(MAXCANONICAL, CANONICAL_MAXAGE)
+resolving = {}    # host -> deferred, for lookups underway
+localName = None  # the canonical name for this host
+resolverPool = None
+
+def _isAddress(host):
+    if ':' in host:
+        return True  # (IPv6)
+    if host.count('.') != 3:
+        return False
+    try:
+        socket.inet_aton(host)
+    except socket.error:
+        return False
+    return True
+
 def getCanonicalIP(IP):
-    # if IP is 'localhost' or '127.0.0.1', use the canonical local hostname.
-    # (this is mostly useful when multiple clients run on the same host)
-    # XXX: could use gethostbyname to get IP addy instead.
+    """
+    Returns the address that IP (an address or host name) goes by in the
+    routing table, peer stats, connection pool, and so on, from a cache, so
+    it never blocks on DNS.  Addresses are their own canonical form, and this
+    host's loopback addresses go by its own name's address.  A name that
+    hasn't been looked up yet is looked up in the background, and goes by
+    itself meanwhile (warmCanonicalIPs looks up the names a node starts out
+    with, so that they don't); once it has been, it keeps its last address
+    while that is refreshed.
+    """
     if IP == '127.0.0.1' or IP == 'localhost':
-        return socket.getfqdn()
-    else:
-        return socket.getfqdn(IP)
+        # (this is mostly useful when multiple clients run on the same host)
+        IP = localName or 'localhost'
+    if _isAddress(IP):
+        return IP
+    entry = canonicalIPs.get(IP)
+    if entry is None:
+        resolveCanonicalIP(IP)
+        return IP
+    if time.time() > entry[1]:
+        resolveCanonicalIP(IP)
+    return entry[0]
+
+def resolveCanonicalIP(host):
+    """
+    Looks up the address for host in a thread (of resolverPool, so that
+    lookups don't wait behind uploads in the reactor's), and caches it.
+    Returns a deferred that fires with the address (or with host, if the
+    lookup failed).
+    """
+    global resolverPool
+    if resolving.has_key(host):
+        return resolving[host]
+    if resolverPool is None:
+        resolverPool = ThreadPool(0, RESOLVERTHREADS, 'flud-resolver')
+        resolverPool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', resolverPool.stop)
+    d = threads.deferToThreadPool(reactor, resolverPool, socket.gethostbyname,
+            host)
+    d.addCallback(_resolvedCanonicalIP, host)
+    d.addErrback(_resolveCanonicalIPFailed, host)
+    resolving[host] = d
+    return d
+
+def _resolvedCanonicalIP(IP, host):
+    del resolving[host]
+    canonicalIPs.put(host, [IP, time.time()+CANONICAL_TTL])
+    return IP
+
+def _resolveCanonicalIPFailed(err, host):
+    del resolving[host]
+    logger.info("couldn't look up %s: %s" % (host, err.getErrorMessage()))
+    # (a name that did resolve before keeps its last address)
+    entry = canonicalIPs.get(host) or [host, 0]
+    entry[1] = time.time()+CANONICAL_NEGTTL
+    canonicalIPs.put(host, entry)
+    return entry[0]
+
+def warmCanonicalIPs(config, hosts=()):
+    """
+    Looks up this host's name (from the routing table, where FludConfig
+    already put it), the hosts of the nodes in the routing table, and hosts
+    (gateways and the like) at startup, so that they go by their addresses
+    from their first requests on.  Returns a DeferredList.
+    """
+    global localName
+    localName = config.routing.node[0]
+    names = set([localName]+list(hosts)
+            +[n[0] for n in config.routing.knownExternalNodes()])
+    return defer.DeferredList([resolveCanonicalIP(h) for h in names
+        if not _isAddress(h)])
 
 def getPageFactory(url, contextFactory=None, *args, **kwargs):
 
@@ -178,31 +340,29 @@ def getPageFactory(url, contextFactory=None, *args, **kwargs):
     scheme, host, port, path = client._parse(url)
     factory = client.HTTPClientFactory(url, *args, **kwargs)
     factory.deferred.addErrback(failedConnect, factory)
-    to = CONNECT_TO+random.randrange(2+CONNECT_TO_VAR)-CONNECT_TO_VAR
     if scheme == 'https':
         from twisted.internet import ssl
         if contextFactory is None:
             contextFactory = ssl.ClientContextFactory()
         reactor.connectSSL(host, port, factory, contextFactory)
     else:
-        reactor.connectTCP(host, port, factory, timeout=to)
+        # plain http goes over a pooled, kept-alive connection to the node
+        httpPool.request(factory)
     return factory
 
 def _dlPageFactory(url, target, factoryClass, contextFactory=None, timeout=None,
         *args, **kwargs):
     scheme, host, port, path = client._parse(url)
-    if timeout != None:
-        # XXX: do something like http://twistedmatrix.com/pipermail/twisted-python/2003-August/005504.html
-        pass
     factory = factoryClass(url, target, *args, **kwargs)
-    to = CONNECT_TO+random.randrange(2+CONNECT_TO_VAR)-CONNECT_TO_VAR
     if scheme == 'https':
         from twisted.internet import ssl
         if contextFactory is None:
             contextFactory = ssl.ClientContextFactory()
         reactor.connectSSL(host, port, factory, contextFactory)
     else:
-        reactor.connectTCP(host, port, factory, timeout=to)
+        # the pool enforces factory.timeout per request
+        factory.timeout = timeout
+        httpPool.request(factory)
     return factory
 
 def downloadPageFactory(url, file, contextFactory=None, timeout=None, 
@@ -215,7 +375,8 @@ def multipartDownloadPageFactory(url, dir, contextFactory=None, timeout=None,
     return _dlPageFactory(url, dir, HTTPMultipartDownloader, contextFactory, 
             timeout, *args, **kwargs)
 
-def fileUpload(host, port, selector, files, form=(), headers={}):
+def fileUpload(host, port, selector, files, form=(), headers={},
+        timeout=None):
     """
     Performs a file upload via http.
     host - webserver hostname
@@ -229,9 +390,11 @@ def fileUpload(host, port, selector, files, form=(), headers={}):
         "application/octet-stream"
     form (optional) - a list of pairs of additional name/value form elements 
         (param/values).
+    timeout (optional) - seconds any one send or receive may block for.
+    Connections come from (and should be handed back to) uploadPool: once the
+    response has been read, call uploadPool.release(host, port, h, response).
     [hopefully, this method goes away in twisted-web2]
     """
-    # XXX: set timeout (based on filesize?)
     port = int(port)
 
     rand_bound = binascii.hexlify(generateRandom(13))
@@ -284,26 +447,40 @@ def fileUpload(host, port, selector, files, form=(), headers={}):
     trailer = CRLF.join(T)
     content_length = content_length + len(trailer)
         
-    h = httplib.HTTPConnection(host, port) # XXX: blocking
-    h.putrequest('POST', selector)
-    for pageheader in headers:
-        h.putheader(pageheader, headers[pageheader])
-    h.putheader('Content-Type', content_type)
-    h.putheader('Content-Length', content_length)
-    h.endheaders()
-
-    h.send(form_data)
-
-    for fheader, file, flen in fuploads:
+    for i in range(len(fuploads)):
+        fheader, file, flen = fuploads[i]
         if 'read' not in dir(file):
-            file = open(file, 'r')
-        h.send(fheader)
-        h.send(file.read(flen)+CRLF) # XXX: blocking
-        file.close()
-
-    h.send(trailer)
-
-    return h
+            fuploads[i] = (fheader, open(file, 'r'), flen)
+    try:
+        while True:
+            h, reused = uploadPool.get(host, port, timeout) # XXX: blocking
+            try:
+                h.putrequest('POST', selector)
+                for pageheader in headers:
+                    h.putheader(pageheader, headers[pageheader])
+                h.putheader('Content-Type', content_type)
+                h.putheader('Content-Length', content_length)
+                h.endheaders()
+
+                h.send(form_data)
+
+                for fheader, file, flen in fuploads:
+                    file.seek(0)
+                    h.send(fheader)
+                    h.send(file.read(flen)+CRLF) # XXX: blocking
+
+                h.send(trailer)
+                return h
+            except (socket.error, httplib.HTTPException):
+                h.close()
+                if not reused:
+                    raise
+                # the node closed our idle connection; try a fresh one
+                logger.debug("pooled upload connection to %s:%d went stale"
+                        % (host, port))
+    finally:
+        for fheader, file, flen in fuploads:
+            file.close()
 
 class ImposterException(FludException):
     pass
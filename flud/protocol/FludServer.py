@@ -19,6 +19,7 @@ from ServerPrimitives import *
 from ServerDHTPrimitives import *
 from LocalPrimitives import *
 from FludCommUtil import *
+import DHTDatagram
 
 threadable.init()
 
@@ -36,11 +37,18 @@ class FludServer(threading.Thread):
         self.root.putChild('ID', ID(self))     # GET (node identity)
         self.root.putChild('file', FILE(self)) # POST, GET, and DELETE (files)
         self.root.putChild('hash', HASH(self)) # GET (verify op)
+        self.root.putChild('blocks', BLOCKS(self)) # GET (batch retrieve)
         self.root.putChild('proxy', PROXY(self)) # currently noop
         self.root.putChild('nodes', NODES(self))
         self.root.putChild('meta', META(self))
+        self.root.putChild('metas', METAS(self)) # PUT (batch kSTORE)
         self.site = server.Site(self.root)
         reactor.listenTCP(self.port, self.site)
+        self.datagram = None
+        if node.config.udp:
+            # small DHT requests can also come in as datagrams
+            self.datagram = DHTDatagram.DHTProtocol(node)
+            reactor.listenUDP(self.port, self.datagram)
         reactor.listenTCP(self.clientport, LocalFactory(node), 
                 interface="127.0.0.1")
         #print "FludServer will listen on port %d, local client on %d"\
@@ -108,6 +108,18 @@ class LocalClient(LineReceiver):
                 d = self.factory.pending['BKTS'].pop('')
                 d.callback(result)
                 return
+            if subcommand == "QUEU":
+                logger.debug("DIAG QUEU")
+                pending, waiting, classes = fdecode(data)
+                result = "%d requests outstanding, %d waiting\n" \
+                        % (pending, waiting)
+                for name, depth, dests, avgwait, maxwait in classes:
+                    result += "  %-12s %5d waiting for %d nodes, wait avg"\
+                            " %dms max %dms\n" \
+                            % (name, depth, dests, avgwait, maxwait)
+                d = self.factory.pending['QUEU'].pop('')
+                d.callback(result)
+                return
             elif status == ':':
                 response, data = data.split(status, 1)
                 logger.debug("DIAG %s: success" % subcommand)
@@ -155,7 +167,7 @@ class LocalClientFactory(ClientFactory):
         self.pending = {'PUTF': {}, 'CRED': {}, 'GETI': {}, 'GETF': {}, 
                 'FNDN': {}, 'STOR': {}, 'RTRV': {}, 'VRFY': {}, 'FNDV': {}, 
                 'CRED': {}, 'LIST': {}, 'GETM': {}, 'PUTM': {}, 'NODE': {}, 
-                'BKTS': {}}
+                'BKTS': {}, 'QUEU': {}}
 
     def clientConnectionFailed(self, connector, reason):
         #print "connection failed: %s" % reason
@@ -328,6 +340,16 @@ class LocalClientFactory(ClientFactory):
         else:
             return self.pending['BKTS']['']
 
+    def sendDIAGQUEU(self):
+        logger.debug("sendDIAGQUEU")
+        if not self.pending['QUEU'].has_key(''):
+            d = defer.Deferred()
+            self.pending['QUEU'][''] = d
+            self._sendMessage("DIAG?QUEU")
+            return d
+        else:
+            return self.pending['QUEU']['']
+
     def sendDIAGSTOR(self, command):
         logger.debug("sendDIAGSTOR")
         if not self.pending['STOR'].has_key(command):
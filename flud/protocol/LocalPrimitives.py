@@ -26,6 +26,7 @@ from flud.fencode import fencode, fdecode
 import flud.FludFileOperations as FileOps
 
 import flud.protocol.ServerPrimitives as ServerPrimitives
+import flud.protocol.ConnectionQueue as ConnectionQueue
 
 logger = logging.getLogger("flud.local.server")
 
@@ -251,6 +252,17 @@ class LocalProtocol(basic.LineReceiver):
                 logger.debug("DIAG BKTS")
                 bucks = eval("%s" % self.factory.config.routing.kBuckets)
                 self.transport.write("DIAG:BKTS%s\r\n" % fencode(bucks))
+            elif data == "QUEU":
+                logger.debug("DIAG QUEU")
+                stats = ConnectionQueue.stats()
+                classes = []
+                for p in ConnectionQueue.PRIORITIES:
+                    name = ConnectionQueue.PRIORITYNAMES[p]
+                    c = stats['classes'][name]
+                    classes.append((name, c['depth'], c['destinations'],
+                        int(c['avgwait']*1000), int(c['maxwait']*1000)))
+                self.transport.write("DIAG:QUEU%s\r\n" % fencode(
+                    (stats['pending'], stats['waiting'], classes)))
             else:
                 dcommand = data[:4]
                 ddata = data[5:]
@@ -0,0 +1,331 @@
+"""
+PeerStats.py (c) 2003-2006 Alen Peacock.  This program is distributed under
+the terms of the GNU General Public License (the GPL), version 3.
+
+What we've measured about talking to other nodes, and the timeouts that
+follow from it.
+
+Each peer (host, port) gets a smoothed round-trip time and its variance, kept
+the way TCP keeps them (Jacobson/Karels, RFC 2988), and a smoothed throughput
+from responses of RATESAMPLEMIN bytes or more, and the fraction of requests to
+it that have recently been answered.  A request to the peer is given
+srtt+4*rttvar to be answered (INITIALTIMEOUT while we know nothing about it),
+plus, for a transfer of a known size, RATESLACK times as long as that many
+bytes should take at its measured rate.  Retries double the timeout, and wait
+backoff(attempt) seconds before going out.
+
+A peer that fails BREAKERFAILURES requests in a row (timeouts, refused or
+dropped connections) trips its breaker: requests to it fail right away with
+PeerUnavailable for BREAKER_TO seconds (doubling each time it trips again),
+after which a single request is let through to see if it's back.
+
+Nodes also advertise how much space they have free for storing blocks (the
+'Fludfree' response header), which is kept here as well, for placing blocks.
+
+>>> now = [1000.0]
+>>> p = PeerStats(clock=lambda: now[0])
+>>> p.timeout('host', 80) == INITIALTIMEOUT
+True
+>>> for rtt in (0.2, 0.25, 0.2, 0.3):
+...     p.sample('host', 80, rtt)
+>>> p.timeout('host', 80)
+2
+>>> p.timeout('host', 80, attempt=2)
+8
+>>> p.sample('host', 80, 10.25, 2*1024*1024)
+>>> int(p.rate('host', 80)/1024)
+204
+>>> int(p.timeout('host', 80, 4*1024*1024))
+82
+>>> for i in range(BREAKERFAILURES):
+...     p.failed('host', 80)
+>>> p.available('host', 80)
+False
+>>> now[0] += BREAKER_TO
+>>> p.available('host', 80), p.available('host', 80)
+(True, False)
+>>> p.failed('host', 80)
+>>> now[0] += BREAKER_TO
+>>> p.available('host', 80)
+False
+>>> now[0] += BREAKER_TO
+>>> p.available('host', 80)
+True
+>>> p.sample('host', 80, 0.2)
+>>> p.available('host', 80), p.available('host', 80)
+(True, True)
+>>> for i in range(BREAKERFAILURES):
+...     p.failed('host', 80)
+>>> now[0] += BREAKER_TO
+>>> p.available('host', 80), p.available('host', 80)
+(True, False)
+>>> p.abandoned('host', 80)
+>>> p.available('host', 80), p.tripped('host', 80)
+(True, True)
+>>> p.available('host', 80)
+False
+>>> now[0] += MAXTRANSFERTIMEOUT    # no one said how the trial went
+>>> p.available('host', 80)
+True
+>>> p.sample('host', 80, 0.2)
+>>> 0.5 <= backoff(1) <= 1 and 4 <= backoff(4) <= 8
+True
+>>> p.advertised('host', 80, '1048576'); p.advertised('host', 80, 'lots')
+>>> p.free('host', 80), p.free('other', 80)
+(1048576, None)
+>>> '%.2f %.2f' % (p.expected('host', 80, 1024*1024), 
+...         p.expected('other', 80, 1024*1024))
+'5.23 64.50'
+>>> p.failed('host', 80)
+>>> '%.3f %.2f' % (p.answered('host', 80), p.cost('host', 80))
+'0.313 0.68'
+"""
+
+import logging, random, time
+
+logger = logging.getLogger('flud.comm.peers')
+
+ALPHA = 1/8.             # gain for the smoothed rtt
+BETA = 1/4.              # gain for its mean deviation
+GAMMA = 1/4.             # gain for the smoothed throughput
+DELTA = 1/8.             # gain for the fraction of requests answered
+INITIALTIMEOUT = 30      # timeout for requests to a peer we haven't measured
+DEFAULTRTT = 0.5         # rtt assumed for peers we haven't measured
+MINTIMEOUT = 2           # never time out sooner than this
+MAXTIMEOUT = 300         # ... or, for requests without a size, later than this
+MAXTRANSFERTIMEOUT = 3600  # ... or, for transfers, later than this
+DEFAULTRATE = 16*1024    # bytes/sec assumed for peers we haven't measured
+RATESAMPLEMIN = 64*1024  # smaller responses are rtt samples, not rate samples
+RATESLACK = 4            # transfers get this many times their expected time
+BACKOFF = 1              # seconds before the first retry
+MAXBACKOFF = 60          # max seconds between retries
+BREAKERFAILURES = 5      # consecutive failures that trip a peer's breaker
+BREAKER_TO = 30          # seconds a tripped breaker stays open, at first
+MAXBREAKER_TO = 3600     # ... at most
+MINANSWERED = 1/16.      # floor on the fraction answered, for cost()
+MAXPEERS = 4096          # forget the least recently used peers beyond this
+
+class PeerUnavailable(Exception):
+    # the peer's breaker is open: it failed too much to be worth trying now
+    pass
+
+def backoff(attempt):
+    """
+    Returns the number of seconds to wait before retry number attempt (1 for
+    the first): exponential, with jitter so that retries to a peer that has
+    just come back don't all land at once.
+    """
+    delay = min(BACKOFF*2**(attempt-1), MAXBACKOFF)
+    return random.uniform(delay/2., delay)
+
+class Peer:
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rate = None
+        self.failures = 0
+        self.trips = 0
+        self.openuntil = 0
+        self.trying = 0      # when the trial request went out, if one has
+        self.used = 0
+        self.free = None
+        self.answered = 1.0
+
+class PeerStats:
+    """
+    RTT/throughput estimators and breakers, for all peers.
+    """
+    def __init__(self, clock=time.time, maxpeers=MAXPEERS):
+        self.clock = clock
+        self.maxpeers = maxpeers
+        self.peers = {}  # (host, port) -> Peer
+
+    def __len__(self):
+        return len(self.peers)
+
+    def _peer(self, host, port):
+        key = (host, int(port))
+        peer = self.peers.get(key)
+        if peer is None:
+            if len(self.peers) >= self.maxpeers:
+                self._prune()
+            peer = Peer()
+            self.peers[key] = peer
+        peer.used = self.clock()
+        return peer
+
+    def _prune(self):
+        byuse = [(p.used, k) for k, p in self.peers.items()]
+        byuse.sort()
+        for used, key in byuse[:len(byuse)/2]:
+            del self.peers[key]
+
+    def sample(self, host, port, elapsed, nbytes=0):
+        """
+        Records a response from host:port that took elapsed seconds and
+        carried nbytes of body.
+        """
+        peer = self._peer(host, port)
+        if peer.failures >= BREAKERFAILURES:
+            logger.info("%s:%s is answering again" % (host, port))
+        peer.failures = 0
+        peer.trips = 0
+        peer.trying = 0
+        peer.answered += DELTA*(1-peer.answered)
+        if nbytes >= RATESAMPLEMIN:
+            # most of this was spent moving bytes: a throughput sample
+            xfer = elapsed-(peer.srtt or 0)
+            if xfer <= 0:
+                return
+            rate = nbytes/xfer
+            if peer.rate is None:
+                peer.rate = rate
+            else:
+                peer.rate += GAMMA*(rate-peer.rate)
+        elif peer.srtt is None:
+            peer.srtt = elapsed
+            peer.rttvar = elapsed/2
+        else:
+            peer.rttvar += BETA*(abs(peer.srtt-elapsed)-peer.rttvar)
+            peer.srtt += ALPHA*(elapsed-peer.srtt)
+
+    def failed(self, host, port):
+        """
+        Records a request to host:port that timed out or lost its connection.
+        """
+        peer = self._peer(host, port)
+        peer.failures += 1
+        peer.trying = 0
+        peer.answered -= DELTA*peer.answered
+        if peer.failures >= BREAKERFAILURES:
+            wait = min(BREAKER_TO*2**peer.trips, MAXBREAKER_TO)
+            peer.trips += 1
+            peer.openuntil = self.clock()+wait
+            logger.info("%s:%s failed %d times in a row, not trying it for"
+                    " %d seconds" % (host, port, peer.failures, wait))
+
+    def available(self, host, port):
+        """
+        Returns False if requests to host:port should fail without being
+        tried.  Once its breaker has been open long enough, the first caller
+        gets True (and should send its request); others get False until that
+        request has succeeded, failed, or been abandoned (or, in case no one
+        said which, MAXTRANSFERTIMEOUT has passed).
+        """
+        peer = self.peers.get((host, int(port)))
+        if peer is None or peer.failures < BREAKERFAILURES:
+            return True
+        if self._trying(peer) or self.clock() < peer.openuntil:
+            return False
+        peer.trying = self.clock()
+        return True
+
+    def _trying(self, peer):
+        return peer.trying and self.clock()-peer.trying < MAXTRANSFERTIMEOUT
+
+    def abandoned(self, host, port):
+        """
+        Records that a request to host:port was given up on before it
+        succeeded or failed.  It says nothing about the peer, but if it was
+        the trial request for an open breaker, the next request gets to be
+        the trial instead.
+        """
+        peer = self.peers.get((host, int(port)))
+        if peer is not None:
+            peer.trying = 0
+
+    def advertised(self, host, port, free):
+        """
+        Records the free space host:port says it has (free is the header's
+        value, which may be None or junk).
+        """
+        try:
+            free = int(free)
+        except (TypeError, ValueError):
+            return
+        self._peer(host, port).free = free
+
+    def free(self, host, port):
+        """
+        Returns the free space host:port last advertised, or None.
+        """
+        peer = self.peers.get((host, int(port)))
+        if peer is None:
+            return None
+        return peer.free
+
+    def tripped(self, host, port):
+        """
+        Returns True if host:port's breaker is open (without, unlike
+        available(), letting a trial request through).
+        """
+        peer = self.peers.get((host, int(port)))
+        return peer is not None and peer.failures >= BREAKERFAILURES \
+                and (self._trying(peer) or self.clock() < peer.openuntil)
+
+    def rate(self, host, port):
+        peer = self.peers.get((host, int(port)))
+        if peer is None or peer.rate is None:
+            return DEFAULTRATE
+        return peer.rate
+
+    def expected(self, host, port, size=0):
+        """
+        Returns how many seconds a request to host:port that moves size bytes
+        should take, on average.
+        """
+        peer = self.peers.get((host, int(port)))
+        if peer is None or peer.srtt is None:
+            rtt = DEFAULTRTT
+        else:
+            rtt = peer.srtt
+        return rtt+float(size)/self.rate(host, port)
+
+    def answered(self, host, port):
+        """
+        Returns the (smoothed) fraction of requests to host:port that have
+        been answered, 1.0 for peers we haven't heard from.
+        """
+        peer = self.peers.get((host, int(port)))
+        if peer is None:
+            return 1.0
+        return peer.answered
+
+    def cost(self, host, port, size=0):
+        """
+        Like expected(), but counting the retries needed for the requests
+        host:port doesn't answer.
+        """
+        return self.expected(host, port, size) \
+                / max(self.answered(host, port), MINANSWERED)
+
+    def timeout(self, host, port, size=0, attempt=0):
+        """
+        Returns the number of seconds to allow a request to host:port, which
+        moves size bytes (0 if it's small), on its attempt'th retry.
+        """
+        peer = self.peers.get((host, int(port)))
+        if peer is None or peer.srtt is None:
+            timeout = INITIALTIMEOUT
+        else:
+            timeout = max(peer.srtt+4*peer.rttvar, MINTIMEOUT)
+        if size:
+            timeout += RATESLACK*float(size)/self.rate(host, port)
+            limit = MAXTRANSFERTIMEOUT
+        else:
+            limit = MAXTIMEOUT
+        return min(timeout*2**attempt, limit)
+
+    def stats(self):
+        tripped = len([p for p in self.peers.values()
+            if p.failures >= BREAKERFAILURES])
+        return {'peers': len(self.peers), 'tripped': tripped}
+
+peers = PeerStats()
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
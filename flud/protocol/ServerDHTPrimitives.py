@@ -15,16 +15,11 @@ from flud.FludCrypto import FludRSA
 from flud.fencode import fencode, fdecode
 
 from ServerPrimitives import ROOT
+import WireCodec
 from FludCommUtil import *
 
 logger = logging.getLogger("flud.server.dht")
 
-# XXX: move kRouting.insertNode code out of FludConfig.  Add a 'addNode' method
-#      to FludProtocol module which calls config.addNode, calls
-#      kRouting.insertNode and if it gets a return value, calls sendGetID with
-#      the callback doing nothing (unless the header comes back in error) and
-#      the errback calling kRouting.replaceNode.  Anywhere that we are
-#      currently called config.addNode, call this new method instead. 
 # FUTURE: check flud protocol version for backwards compatibility
 # XXX: need to make sure we have appropriate timeouts for all comms.
 # FUTURE: DOS attacks.  For now, assume that network hardware can filter these 
@@ -39,6 +34,95 @@ logger = logging.getLogger("flud.server.dht")
 #      consider Zooko's links in the parent to this post)
 
 
+VALUE_TTL = 24*3600         # values not stored again within this expire
+CACHE_MAXTTL = 3600         # longest we'll hold a path-cached value
+MAXCACHEDVALUES = 1024      # bound on the number of path-cached values
+MAXCACHEDBYTES = 4*1024*1024  # bound on the total size of path-cached values
+
+class ValueCache:
+    """
+    Values that lookups passing through this node asked it to cache (kademlia
+    path caching).  These are kept apart from the values this node is
+    responsible for, are bounded in number and size, and expire.
+
+    >>> c = ValueCache(maxvalues=2)
+    >>> c.put('a', 'aval', 10)
+    >>> c.put('b', 'bval', 20)
+    >>> c.put('c', 'cval', 30)   # evicts 'a', the soonest to expire
+    >>> c.get('a'), c.get('b'), c.get('c')
+    (None, 'bval', 'cval')
+    >>> c.put('b', 'bval', -1)
+    >>> c.get('b'), len(c.values)
+    (None, 1)
+    """
+    def __init__(self, maxvalues=MAXCACHEDVALUES, maxbytes=MAXCACHEDBYTES):
+        self.maxvalues = maxvalues
+        self.maxbytes = maxbytes
+        self.values = {}  # key -> (expires, val)
+        self.size = 0
+
+    def put(self, key, val, ttl):
+        self._remove(key)
+        if ttl <= 0 or len(val) > self.maxbytes:
+            return
+        if len(self.values) >= self.maxvalues \
+                or self.size+len(val) > self.maxbytes:
+            self.expire()
+        while self.values and (len(self.values) >= self.maxvalues 
+                or self.size+len(val) > self.maxbytes):
+            self._remove(min(self.values, key=lambda k: self.values[k][0]))
+        self.values[key] = (time.time()+ttl, val)
+        self.size += len(val)
+
+    def get(self, key):
+        if not self.values.has_key(key):
+            return None
+        expires, val = self.values[key]
+        if expires < time.time():
+            self._remove(key)
+            return None
+        return val
+
+    def expire(self):
+        now = time.time()
+        for key in [k for k in self.values if self.values[k][0] < now]:
+            self._remove(key)
+
+    def _remove(self, key):
+        if self.values.has_key(key):
+            self.size -= len(self.values.pop(key)[1])
+
+valueCache = ValueCache()
+
+def closestNodes(config, key):
+    """
+    The k closest nodes to key (a long) from our routing table, plus a random
+    one from further away (for diversity), to answer a kFINDNODE.
+    """
+    kclosest = config.routing.findNode(key)
+    notclose = list(set(config.routing.knownExternalNodes()) - set(kclosest))
+    if len(notclose) > 0 and len(kclosest) > 1:
+        kclosest.append(random.choice(notclose))
+    return kclosest
+
+def localValue(config, key, nodeID):
+    """
+    Looks for the value stored under key (fencoded) here, to answer a
+    kFINDVALUE from nodeID.  Returns (kind, value) where kind is
+    'authoritative', 'pernode' (filtered for nodeID, so not to be cached), or
+    'cached', and value is fencoded; or None if we don't have it.
+    """
+    val = config.kstore.get(key)
+    if val != None:
+        d = fdecode(val)
+        if isinstance(d, dict) and d.has_key(nodeID):
+            return ('pernode', fencode({'b': d['b'], nodeID: d[nodeID]}))
+        return ('authoritative', fencode(d))
+    val = valueCache.get(key)
+    if val != None:
+        return ('cached', val)
+    return None
+
 """
 The children of ROOT beginning with 'k' are kademlia protocol based.
 """
@@ -62,11 +146,28 @@ class META(ROOT):
 
     def render_PUT(self, request):
         logger.debug("META put (storeval)")
-        if len(request.prepath) != 3:
+        if len(request.prepath) == 2:
+            # the value is the request body
+            length = request.getHeader('content-length')
+            try:
+                length = int(length)
+            except (TypeError, ValueError):
+                request.setResponseCode(http.LENGTH_REQUIRED, 
+                        "Length Required")
+                return "kSTORE requires a Content-Length"
+            if length > MAXKSTORESIZE:
+                request.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE,
+                        "Request Entity Too Large")
+                return "kSTORE values are limited to %d bytes" % MAXKSTORESIZE
+            request.content.seek(0)
+            val = request.content.read()
+        elif len(request.prepath) == 3:
+            # older nodes send the value in the URL
+            val = request.prepath[2]
+        else:
             request.setResponseCode(http.BAD_REQUEST, "expected key/val")
             return "expected key/val, got %s" % '/'.join(request.prepath)
         key = request.prepath[1]
-        val = request.prepath[2]
         self.setHeaders(request)
         return kStoreVal(self.node, self.config, request, key, val).deferred
 
@@ -79,6 +180,16 @@ class META(ROOT):
         self.setHeaders(request)
         return kFindVal(self.node, self.config, request, key).deferred
 
+class METAS(ROOT):
+    """ batch kSTORE, used for republishing """
+    def getChild(self, name, request):
+        return self
+
+    def render_PUT(self, request):
+        logger.debug("METAS put (storevals)")
+        self.setHeaders(request)
+        return kStoreVals(self.node, self.config, request).deferred
+
 class kFindNode(object):
     def __init__(self, node, config, request, key):
         self.node = node
@@ -109,19 +220,13 @@ class kFindNode(object):
                 request.setResponseCode(http.BAD_REQUEST, "Bad Identity")
                 return "requesting node's ID and public key do not match"
             host = getCanonicalIP(request.getClientIP())
-            #return "{'id': '%s', 'k': %s}"\
-            #       % (self.config.nodeID,\
-            #       self.config.routing.findNode(fdecode(params['key'])))
-            kclosest = self.config.routing.findNode(fdecode(key))
-            notclose = list(set(self.config.routing.knownExternalNodes()) 
-                    - set(kclosest))
-            if len(notclose) > 0 and len(kclosest) > 1:
-                r = random.choice(notclose)
-                #logger.info("**** got some notclose: %s:%d ****" % (r[0],r[1]))
-                kclosest.append(r)
+            kclosest = closestNodes(self.config, fdecode(key))
             #logger.info("returning kFINDNODE response: %s" % kclosest)
             updateNode(self.node.client, self.config, host, 
                     int(params['port']), reqKu, params['nodeID'])
+            if WireCodec.wantsBinary(request):
+                request.setHeader('Content-Type', WireCodec.NODES_TYPE)
+                return WireCodec.encodeNodes(self.config.nodeID, kclosest)
             return "{'id': '%s', 'k': %s}" % (self.config.nodeID, kclosest)
         
 class kSTORE_true(ROOT):
@@ -151,11 +256,8 @@ class kSTORE_true(ROOT):
             host = getCanonicalIP(request.getClientIP())
             updateNode(self.node.client, self.config, host,
                     int(params['port']), reqKu, params['nodeID'])
-            fname = self.config.kstoredir+'/'+params['key']
-            logger.info("storing dht data to %s" % fname)
-            f = open(fname, "wb")
-            f.write(params['val'])
-            f.close()
+            logger.info("storing dht data for %s" % params['key'])
+            self.config.kstore.put(params['key'], params['val'], VALUE_TTL)
             return "" 
 
 
@@ -215,32 +317,71 @@ class kStoreVal(ROOT):
             host = getCanonicalIP(request.getClientIP())
             updateNode(self.node.client, self.config, host,
                     int(params['port']), reqKu, params['nodeID'])
-            fname = os.path.join(self.config.kstoredir,key)
             md = fdecode(val)
-            if not self.dataAllowed(key, md, params['nodeID']):
-                msg = "malformed store data"
-                logger.info("bad data was: %s" % md)
+            if request.args.has_key('cache'):
+                return self.cacheVal(request, key, val, md, 
+                        request.args['cache'][0])
+            msg = self.storeVal(key, md, params['nodeID'])
+            if msg:
                 request.setResponseCode(http.BAD_REQUEST, msg)
                 return msg
-            # XXX: see if there isn't already a 'val' for 'key' present
-            #      - if so, compare to val.  Metadata can differ.  Blocks
-            #        shouldn't.  However, if blocks do differ, just add the
-            #        new values in, up to N (3?) records per key.  Flag these
-            #        (all N) as ones we want to verify (to storer and storee).
-            #        Expunge any blocks that fail verify, and punish storer's 
-            #        trust.
-            logger.info("storing dht data to %s" % fname)
-            if os.path.exists(fname) and isinstance(md, dict):
-                f = open(fname, "rb")
-                edata = f.read()
-                f.close()
-                md = self.mergeMetadata(md, fdecode(edata))
-            f = open(fname, "wb")
-            f.write(fencode(md))
-            f.close()
             return ""  # XXX: return a VERIFY reverse request: segname, offset
 
-    def dataAllowed(self, key, data, nodeID):
+    def storeVal(self, key, md, nodeID):
+        """
+        Checks md and stores it (merged with any value already held) under
+        key.  Returns an error message if md isn't allowed, else None.  Values
+        republished by other holders go through the same checks as the
+        sender's own kSTOREs, so master CAS records are only ever taken from
+        their owner.
+        """
+        if not self.dataAllowed(key, md, nodeID):
+            logger.info("bad data was: %s" % md)
+            return "malformed store data"
+        # XXX: see if there isn't already a 'val' for 'key' present
+        #      - if so, compare to val.  Metadata can differ.  Blocks
+        #        shouldn't.  However, if blocks do differ, just add the
+        #        new values in, up to N (3?) records per key.  Flag these
+        #        (all N) as ones we want to verify (to storer and storee).
+        #        Expunge any blocks that fail verify, and punish storer's 
+        #        trust.
+        logger.info("storing dht data for %s" % key)
+        def merge(edata):
+            if edata != None and isinstance(md, dict):
+                return fencode(self.mergeMetadata(md, fdecode(edata)))
+            return fencode(md)
+        # values expire unless stored again (by their owner, or republished
+        # by another holder) within VALUE_TTL
+        self.config.kstore.update(key, merge, VALUE_TTL)
+        return None
+
+    def cacheVal(self, request, key, val, md, ttl):
+        """
+        Path caching: hold on to someone else's value for a while, without
+        taking responsibility for it.
+        """
+        try:
+            ttl = min(int(ttl), CACHE_MAXTTL)
+        except:
+            request.setResponseCode(http.BAD_REQUEST, "Bad Request")
+            return "bad cache request"
+        if not self.cacheAllowed(key, md):
+            msg = "malformed cache data"
+            request.setResponseCode(http.BAD_REQUEST, msg)
+            return msg
+        logger.info("caching dht data for %s for %ds" % (key, ttl))
+        valueCache.put(key, val, ttl)
+        return ""
+
+    def cacheAllowed(self, key, data):
+        """
+        Only metadata is path cached.  A master CAS record can only be
+        checked against the node that sends it, and the node caching it
+        along a lookup's path isn't its owner.
+        """
+        return self.dataAllowed(key, data, None, masterCAS=False)
+
+    def dataAllowed(self, key, data, nodeID, masterCAS=True):
         # ensures that 'data' is in [one of] the right format[s] (helps prevent
         # DHT abuse)
 
@@ -309,7 +450,7 @@ class kStoreVal(ROOT):
             return True
 
         return (validMetadata(data, nodeID) 
-                or validMasterCAS(key, data, nodeID))
+                or (masterCAS and validMasterCAS(key, data, nodeID)))
     
     def mergeMetadata(self, m1, m2):
         # merges the data from m1 into m2. After calling, both m1 and m2 
@@ -365,6 +506,72 @@ class kStoreVal(ROOT):
         return m1
 
 
+class kStoreVals(kStoreVal):
+    """
+    Stores a batch of values republished by another holder.  The request body
+    is an fencoded dict of key (a long) -> value.
+    """
+    def __init__(self, node, config, request):
+        self.node = node
+        self.config = config
+        self.deferred = self.kstoreVals(request)
+
+    def kstoreVals(self, request):
+        try:
+            required = ('nodeID', 'Ku_e', 'Ku_n', 'port')
+            params = requireParams(request, required)
+            length = int(request.getHeader('content-length'))
+        except Exception, inst:
+            msg = "%s in request received by kSTORE (batch)" % inst.args[0]
+            logger.info(msg)
+            request.setResponseCode(http.BAD_REQUEST, "Bad Request")
+            return msg 
+        if length > MAXKSTORESIZE:
+            request.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE,
+                    "Request Entity Too Large")
+            return "kSTORE batches are limited to %d bytes" % MAXKSTORESIZE
+        reqKu = {}
+        reqKu['e'] = long(params['Ku_e'])
+        reqKu['n'] = long(params['Ku_n'])
+        reqKu = FludRSA.importPublicKey(reqKu)
+        if reqKu.id() != params['nodeID']:
+            request.setResponseCode(http.BAD_REQUEST, "Bad Identity")
+            return "requesting node's ID and public key do not match"
+        host = getCanonicalIP(request.getClientIP())
+        updateNode(self.node.client, self.config, host,
+                int(params['port']), reqKu, params['nodeID'])
+        request.content.seek(0)
+        try:
+            vals = fdecode(request.content.read())
+            if not isinstance(vals, dict):
+                raise ValueError("not a dict")
+        except Exception, inst:
+            request.setResponseCode(http.BAD_REQUEST, "Bad Request")
+            return "malformed kSTORE batch: %s" % inst
+        logger.info("received kSTORE batch of %d values from %s..."
+                % (len(vals), params['nodeID'][:10]))
+        failed = {}
+        for key in vals:
+            try:
+                msg = self.storeVal(fencode(key), vals[key], params['nodeID'])
+            except Exception, inst:
+                msg = str(inst)
+            if msg:
+                failed[key] = msg
+        # which values weren't stored, and why
+        return fencode(failed)
+
+
+class DatagramStoreVal(kStoreVal):
+    """
+    kStoreVal's checks and storage, for kSTOREs that arrive as datagrams
+    (see DHTDatagram) rather than as http requests.
+    """
+    def __init__(self, node, config):
+        self.node = node
+        self.config = config
+
+
 class kFindVal(object):
     def __init__(self, node, config, request, key):
         self.node = node
@@ -398,29 +605,21 @@ class kFindVal(object):
             host = getCanonicalIP(request.getClientIP())
             updateNode(self.node.client, self.config, host,
                     int(params['port']), reqKu, params['nodeID'])
-            fname = os.path.join(self.config.kstoredir,key)
-            if os.path.isfile(fname):
-                f = open(fname, "rb")
-                logger.info("returning data from kFINDVAL") 
+            found = localValue(self.config, key, params['nodeID'])
+            if found:
+                kind, val = found
+                logger.info("returning %s data from kFINDVAL" % kind) 
                 request.setHeader('nodeID',str(self.config.nodeID))
                 request.setHeader('Content-Type','application/x-flud-data')
-                d = fdecode(f.read())
-                if isinstance(d, dict) and d.has_key(params['nodeID']):
-                    #print d
-                    resp = {'b': d['b'], params['nodeID']: d[params['nodeID']]}
-                    #resp = {'b': d['b']}
-                    #if d.has_key(params['nodeID']):
-                    #   resp[params['nodeID']] = d[params['nodeID']]
-                else:
-                    resp = d
-                request.write(fencode(resp))
-                f.close()
-                return ""
+                request.setHeader('Fludvalue', kind)
+                return val
             else:
                 # return the following if it isn't there.
                 logger.info("returning nodes from kFINDVAL for %s" % key)
+                kclosest = self.config.routing.findNode(fdecode(key))
+                if WireCodec.wantsBinary(request):
+                    request.setHeader('Content-Type', WireCodec.NODES_TYPE)
+                    return WireCodec.encodeNodes(self.config.nodeID, kclosest)
                 request.setHeader('Content-Type','application/x-flud-nodes')
-                return "{'id': '%s', 'k': %s}"\
-                        % (self.config.nodeID,\
-                        self.config.routing.findNode(fdecode(key)))
+                return "{'id': '%s', 'k': %s}" % (self.config.nodeID, kclosest)
         
@@ -19,6 +19,8 @@ import flud.TarfileUtils as TarfileUtils
 from flud.fencode import fencode, fdecode
 
 import BlockFile
+import SessionAuth
+import WireCodec
 from FludCommUtil import *
 
 logger = logging.getLogger("flud.server.op")
@@ -29,6 +31,26 @@ loggervrfy = logging.getLogger("flud.server.op.vrfy")
 loggerdele = logging.getLogger("flud.server.op.dele")
 loggerauth = logging.getLogger("flud.server.op.auth")
 
+FREESPACE_TTL = 60  # seconds between looks at how much space is free
+
+freeSpaces = {}  # dir -> (when we looked, bytes free)
+
+def freeSpace(dir):
+    """
+    Returns the number of bytes free for storing blocks in dir (as of at most
+    FREESPACE_TTL seconds ago), or None if there's no telling.
+    """
+    now = time.time()
+    when, free = freeSpaces.get(dir, (0, None))
+    if now-when > FREESPACE_TTL:
+        try:
+            s = os.statvfs(dir)
+            free = s.f_bavail*s.f_frsize
+        except (AttributeError, OSError):
+            free = None
+        freeSpaces[dir] = (now, free)
+    return free
+
 """
 These classes represent http requests received by this node, and the actions
 taken to respond.
@@ -107,6 +129,11 @@ class ROOT(Resource):
     This state expires after a short time, and implies that client must make
     requests to individual servers serially.
 
+    Clients that send a 'Fludsession' header also receive a session secret
+    inside the encrypted challenge.  Once the challenge is answered, the
+    client can authenticate its requests for the next few minutes with an HMAC
+    made from that secret instead of a new challenge (see SessionAuth.py).
+
     A node's groupIDu is the same globally for each peer, so exposing it to one
     adversarial node means exposing it to all.  At first glance, this seems
     bad, but groupIDu is useless by itself -- in order to use it, a node must
@@ -140,6 +167,10 @@ class ROOT(Resource):
     def setHeaders(self, request):
         request.setHeader('Server','FludServer 0.1')
         request.setHeader('FludProtocol', PROTOCOL_VERSION)
+        # (clients place blocks by it; see FludPlacement)
+        free = freeSpace(self.config.storedir)
+        if free is not None:
+            request.setHeader('Fludfree', str(free))
 
 
 class ID(ROOT):
@@ -180,6 +211,9 @@ class ID(ROOT):
             host = getCanonicalIP(request.getClientIP())
             updateNode(self.node.client, self.config, host,
                     int(params['port']), reqKu, params['nodeID'])
+            if WireCodec.wantsBinary(request):
+                request.setHeader('Content-Type', WireCodec.KEY_TYPE)
+                return WireCodec.encodeKu(self.config.Ku.exportPublicKey())
             return str(self.config.Ku.exportPublicKey())
             #except:
             #   msg = "can't return ID"
@@ -296,6 +330,29 @@ class HASH(ROOT):
         self.setHeaders(request)
         return VerifyFile(self.node, self.config, request, filekey).deferred
 
+class BLOCKS(ROOT):
+    """ batch retrieval of many blocks in a single multipart response """
+    def getChild(self, name, request):
+        return self
+
+    def render_GET(self, request):
+        """
+        A request to retrieve several blocks at once.  The blocks are named by
+        the comma-separated 'keys' parameter, e.g.
+        GET http://server:port/blocks?keys=a35cd13397,66ef209657a7b&...
+        Each block found (and the requestor's metadata for it) is returned as
+        a part of a single Multipart/Related response, exactly as RETRIEVE
+        would have returned it.  Blocks not stored here are simply left out.
+        Response codes: 200- OK (default)
+                        400- Bad Request (missing params, too many keys)
+                        401- Unauthorized (ID hash, CHALLENGE, or
+                             GROUPCHALLENGE failed)
+                        404- Not Found (none of the blocks are stored here)
+        """
+        loggerretr.debug("blocks GET, %s", request.prepath)
+        self.setHeaders(request)
+        return RetrieveBlocks(self.node, self.config, request).deferred
+
 class StoreFile(object):
     def __init__(self, node, config, request, filekey):
         self.node = node
@@ -699,6 +756,200 @@ class RetrieveFile(object):
         request.finish()
 
 
+class RetrieveBlocks(RetrieveFile):
+    """
+    Batch version of RetrieveFile.  All the requested blocks are written into
+    one multipart response, so that a client restoring many blocks from this
+    node pays for one connection and one authentication instead of one per
+    block.
+    """
+    def __init__(self, node, config, request):
+        self.node = node
+        self.config = config
+        self.deferred = self.retrieveBlocks(request)
+
+    def retrieveBlocks(self, request):
+        try:
+            required = ('Ku_e', 'Ku_n', 'port', 'keys')
+            params = requireParams(request, required)
+        except Exception, inst:
+            msg = inst.args[0] + " in request received by RETRIEVE"
+            loggerretr.log(logging.INFO, msg)
+            request.setResponseCode(http.BAD_REQUEST, "Bad Request")
+            return msg
+        filekeys = [k for k in params['keys'].split(',') if k]
+        if not filekeys or len(filekeys) > MAXBATCHKEYS:
+            msg = "Bad request: must request between 1 and %d blocks" \
+                    % MAXBATCHKEYS
+            loggerretr.debug(msg)
+            request.setResponseCode(http.BAD_REQUEST, msg)
+            return msg
+        for filekey in filekeys:
+            if filekey.find(os.path.sep) >= 0:
+                msg = "Bad request:"\
+                        " filekey contains illegal path seperator tokens."
+                loggerretr.debug(msg)
+                request.setResponseCode(http.BAD_REQUEST, msg)
+                return msg
+        host = getCanonicalIP(request.getClientIP())
+        port = int(params['port'])
+        loggerretr.info("received RETRIEVE request for %d blocks from %s:%s",
+                len(filekeys), host, port)
+        reqKu = {}
+        reqKu['e'] = long(params['Ku_e'])
+        reqKu['n'] = long(params['Ku_n'])
+        reqKu = FludRSA.importPublicKey(reqKu)
+
+        return authenticate(request, reqKu, host, port,
+                self.node.client, self.config,
+                self._sendBlocks, request, filekeys, reqKu)
+
+    def _sendBlocks(self, request, filekeys, reqKu):
+        # tarballs for the originator are opened at most once per batch
+        tarballbase = os.path.join(self.config.storedir, reqKu.id()+".tar")
+        tars = []
+        if os.path.exists(tarballbase+'.gz'):
+            tars.append((tarballbase+'.gz', 'r:gz'))
+        if os.path.exists(tarballbase):
+            tars.append((tarballbase, 'r'))
+        tars = [(t, tarfile.open(t, mode)) for t, mode in tars]
+        parts = []
+        found = 0
+        try:
+            for filekey in filekeys:
+                blockparts = self._findBlock(filekey, reqKu, tars)
+                if blockparts:
+                    parts.extend(blockparts)
+                    found += 1
+                else:
+                    loggerretr.debug("%s not found for batch RETRIEVE"
+                            % filekey)
+        except:
+            for t, tar in tars:
+                tar.close()
+            raise
+        if not found:
+            for t, tar in tars:
+                tar.close()
+            msg = "%s (%d blocks)" % (BATCHNOTFOUND, len(filekeys))
+            request.setResponseCode(http.NOT_FOUND, msg)
+            return msg
+        loggerretr.info("sending RETRIEVE for %d of %d blocks"
+                % (found, len(filekeys)))
+        bound = binascii.hexlify(generateRandom(13))
+        request.setHeader('Content-type', 'Multipart/Related')
+        request.setHeader('boundary', bound)
+        length = len("--%s--\r\n" % bound)
+        for contentID, size, source in parts:
+            length += len(self._partHeader(bound, contentID, size))+size+2
+        request.setHeader('Content-Length', str(length))
+        PartsProducer(request, self._parts(parts, bound, tars))
+        return server.NOT_DONE_YET
+
+    def _findBlock(self, filekey, reqKu, tars):
+        """
+        Returns the (Content-ID, size, source) of each part to send for
+        filekey (metadata first, then data), or [] if filekey isn't stored
+        here.  A source is either the part's data or an (opener, args) pair
+        that opens it for reading.
+        """
+        fname = os.path.join(self.config.storedir, filekey)
+        if os.path.exists(fname):
+            f = BlockFile.open(fname, "rb")
+            meta = f.meta(int(reqKu.id(),16))
+            parts = []
+            if meta:
+                for m in meta:
+                    parts.append(("%s.%s.meta" % (filekey, m), len(meta[m]),
+                        meta[m]))
+            parts.append((filekey, f.size(), (BlockFile.open, (fname, "rb"))))
+            f.close()
+            return parts
+        for tarball, tar in tars:
+            try:
+                tinfo = tar.getmember(filekey)
+            except KeyError:
+                continue
+            parts = []
+            metas = [m for m in tar.getnames()
+                    if m[:len(filekey)] == filekey and m[-4:] == 'meta']
+            for m in metas:
+                minfo = tar.getmember(m)
+                parts.append((m, minfo.size, (tar.extractfile, (minfo,))))
+            parts.append((filekey, tinfo.size, (tar.extractfile, (tinfo,))))
+            return parts
+        return []
+
+    def _partHeader(self, bound, contentID, size):
+        H = []
+        H.append("--%s" % bound)
+        H.append("Content-Type: Application/octet-stream")
+        H.append("Content-ID: %s" % contentID)
+        H.append("Content-Length: %d" % size)
+        H.append("")
+        H.append("")
+        return '\r\n'.join(H)
+
+    def _parts(self, parts, bound, tars):
+        """
+        Yields the response body a piece at a time, reading each part only
+        when the one before it has been sent.  The tarballs are closed once
+        the body is done (or abandoned).
+        """
+        try:
+            for contentID, size, source in parts:
+                yield self._partHeader(bound, contentID, size)
+                if isinstance(source, str):
+                    yield source
+                else:
+                    opener, args = source
+                    f = opener(*args)
+                    try:
+                        while 1:
+                            buf = f.read(65536)
+                            if buf == "":
+                                break
+                            yield buf
+                    finally:
+                        f.close()
+                yield '\r\n'
+            yield "--%s--\r\n" % bound
+        finally:
+            for t, tar in tars:
+                tar.close()
+
+
+class PartsProducer(object):
+    """
+    A pull producer that writes the pieces of a response (from the iterator
+    'pieces') to request one at a time, as its connection has room for them,
+    and finishes the request after the last one.  A response that can't be
+    completed is cut off, so that the requestor doesn't take what it got as
+    the whole thing.
+    """
+    def __init__(self, request, pieces):
+        self.request = request
+        self.pieces = pieces
+        request.registerProducer(self, False)
+
+    def resumeProducing(self):
+        try:
+            piece = self.pieces.next()
+        except StopIteration:
+            self.request.unregisterProducer()
+            self.request.finish()
+            return
+        except Exception, inst:
+            loggerretr.warn("couldn't finish response: %s" % inst)
+            self.request.unregisterProducer()
+            self.request.transport.loseConnection()
+            return
+        self.request.write(piece)
+
+    def stopProducing(self):
+        self.pieces.close()
+
+
 class VerifyFile(object):
     def __init__(self, node, config, request, filekey):
         self.node = node
@@ -1016,19 +1267,33 @@ def authenticate(request, reqKu, host, port, client, config, callable,
         *callargs):
     # 1- make sure that reqKu hashes to reqID
     # 2- send a challenge/groupchallenge to reqID (encrypt with reqKu)
+    # 3- or, if the requestor already holds a session, check its MAC instead
     challengeResponse = request.getUser()
     groupResponse = request.getPassword()
+    session = request.getHeader('Fludsession')
 
     if not challengeResponse or not groupResponse:
+        if session and session != 'new':
+            if SessionAuth.serverSessions.verify(session, reqKu.id(),
+                    request.getHeader('Fludsessionseq'),
+                    request.getHeader('Fludsessionmac'),
+                    request.method, request.uri):
+                updateNode(client, config, host, port, reqKu, reqKu.id())
+                return callable(*callargs)
+            loggerauth.info("session auth failed for request from %s:%d"
+                    % (host, port))
         loggerauth.info("returning challenge for request from %s:%d" \
                 % (host, port))
-        return sendChallenge(request, reqKu, config.nodeID)
+        return sendChallenge(request, reqKu, config.nodeID, session != None)
     else:
-        if getChallenge(challengeResponse):
+        secret = getChallenge(challengeResponse)
+        if secret:
             expireChallenge(challengeResponse)
             if groupResponse == hashstring(
                     str(reqKu.exportPublicKey())
                     +str(config.groupIDr)): 
+                if isinstance(secret, str):
+                    SessionAuth.serverSessions.open(secret, reqKu.id())
                 updateNode(client, config, host, port, reqKu, reqKu.id())
                 return callable(*callargs)
             else:
@@ -1048,15 +1313,22 @@ def authenticate(request, reqKu, host, port, client, config, callable,
             return err
 
 
-def sendChallenge(request, reqKu, id):
+def sendChallenge(request, reqKu, id, withSession=False):
     challenge = generateRandom(challengelength) 
     while challenge[0] == '\x00':
         # make sure we have at least challengelength bytes
         challenge = generateRandom(challengelength)
-    addChallenge(challenge)
     loggerauth.debug("unencrypted challenge is %s" 
             % fencode(binascii.unhexlify(id)+challenge))
-    echallenge = reqKu.encrypt(binascii.unhexlify(id)+challenge)[0]
+    if withSession:
+        # the requestor can do sessions: piggyback a session secret, which
+        # becomes usable once this challenge is answered
+        secret = generateRandom(SessionAuth.SESSIONSECRETLENGTH)
+        addChallenge(challenge, secret)
+        echallenge = reqKu.encrypt(binascii.unhexlify(id)+challenge+secret)[0]
+    else:
+        addChallenge(challenge)
+        echallenge = reqKu.encrypt(binascii.unhexlify(id)+challenge)[0]
     echallenge = fencode(echallenge)
     loggerauth.debug("echallenge = %s" % echallenge)
     # since challenges will result in a new req/resp pair being generated,
@@ -1066,7 +1338,7 @@ def sendChallenge(request, reqKu, id):
     resp = 'challenge = %s' % echallenge
     loggerauth.debug("resp = %s" % resp)
     request.setResponseCode(http.UNAUTHORIZED, echallenge)
-    request.setHeader('Connection', 'close')
+    # the connection is kept open: the client answers on the same one
     request.setHeader('WWW-Authenticate', 'Basic realm="%s"' % 'default')
     request.setHeader('Content-Length', str(len(resp)))
     request.setHeader('Content-Type', 'text/html')
@@ -1074,8 +1346,8 @@ def sendChallenge(request, reqKu, id):
     return resp
 
 outstandingChallenges = {}
-def addChallenge(challenge):
-    outstandingChallenges[challenge] = True
+def addChallenge(challenge, secret=True):
+    outstandingChallenges[challenge] = secret
     loggerauth.debug("added challenge %s" % fencode(challenge))
 
 def expireChallenge(challenge, expired=False):
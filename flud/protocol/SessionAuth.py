@@ -0,0 +1,188 @@
+"""
+SessionAuth.py (c) 2003-2006 Alen Peacock.  This program is distributed under
+the terms of the GNU General Public License (the GPL), version 3.
+
+Short-lived symmetric sessions between peers, so that only the first request
+to a peer pays for the RSA challenge/response.
+
+A client that can do sessions sends a 'Fludsession' header.  When the server
+challenges such a request, it appends a random session secret to the
+RSA-encrypted challenge.  Only the holder of Kr can recover the secret, and the
+client never sends it back: the challenge response goes out as before, and once
+the server has accepted it the secret is good for SESSION_LIFETIME seconds.
+Later requests carry the session ID, a sequence number, and an HMAC of the
+request line made with the secret ('Fludsession', 'Fludsessionseq' and
+'Fludsessionmac' headers).  Anything the server doesn't like (unknown or
+expired session, bad MAC, replayed sequence number) gets an ordinary
+challenge, which the client answers, opening a fresh session.
+
+The MAC covers the method and request URI, not the request body (the basic
+auth challenge doesn't cover bodies either; stored data is self-certifying
+through its CAS key).
+"""
+
+import time, logging
+
+from flud.FludCrypto import hashstring, hmacstring
+
+logger = logging.getLogger('flud.auth.session')
+
+SESSION_LIFETIME = 600   # seconds a session is valid on the server
+SESSION_MARGIN = 30      # clients stop using sessions this long before expiry
+SESSIONSECRETLENGTH = 32 # bytes of session secret appended to challenges
+MAXSESSIONS = 4096       # server-side bound on concurrently open sessions
+REPLAYWINDOW = 1024      # seqs older than (highest seen - this) are rejected
+
+def sessionID(secret):
+    return hashstring(secret)[:32]
+
+def requestMAC(secret, sid, seq, method, uri):
+    return hmacstring(secret, "%s %s %s %s" % (sid, seq, method, uri))
+
+class Session:
+    def __init__(self, secret, peerID, expires):
+        self.secret = secret
+        self.id = sessionID(secret)
+        self.peerID = peerID
+        self.expires = expires
+        self.seq = 0          # last seq sent (client side)
+        self.maxseq = 0       # highest seq seen (server side)
+        self.seen = {}        # seqs seen within the replay window (server side)
+
+class ClientSessions:
+    """
+    Sessions we hold with servers, keyed by the server's nodeID.
+
+    >>> c = ClientSessions()
+    >>> s = ServerSessions()
+    >>> sid = s.open('k'*32, 'client')
+    >>> c.open('server', 'k'*32)
+    >>> h = {}
+    >>> c.sign(h, 'server', 'GET', '/file/abc?port=80')
+    True
+    >>> h['Fludsession'] == sid, h['Fludsessionseq']
+    (True, '1')
+    >>> s.verify(h['Fludsession'], 'client', h['Fludsessionseq'],
+    ...         h['Fludsessionmac'], 'GET', '/file/abc?port=80')
+    True
+    >>> s.verify(h['Fludsession'], 'client', h['Fludsessionseq'],
+    ...         h['Fludsessionmac'], 'GET', '/file/abc?port=80')  # replay
+    False
+    >>> c.sign(h, 'server', 'DELETE', '/file/abc')
+    True
+    >>> s.verify(h['Fludsession'], 'client', h['Fludsessionseq'],
+    ...         h['Fludsessionmac'], 'DELETE', '/file/xyz')  # wrong uri
+    False
+    >>> s.verify(h['Fludsession'], 'someoneelse', h['Fludsessionseq'],
+    ...         h['Fludsessionmac'], 'DELETE', '/file/abc')  # wrong peer
+    False
+    >>> c.drop('server')
+    >>> h = {}
+    >>> c.sign(h, 'server', 'GET', '/file/abc')
+    False
+    >>> h
+    {'Fludsession': 'new'}
+    """
+    def __init__(self):
+        self.sessions = {}
+
+    def open(self, serverID, secret):
+        self.sessions[serverID] = Session(secret, serverID,
+                time.time()+SESSION_LIFETIME-SESSION_MARGIN)
+        logger.debug("opened session with %s" % serverID)
+
+    def drop(self, serverID):
+        if self.sessions.has_key(serverID):
+            del self.sessions[serverID]
+            logger.debug("dropped session with %s" % serverID)
+
+    def sign(self, headers, serverID, method, uri):
+        """
+        Adds session credentials for serverID to headers.  Returns False if
+        there is no usable session, in which case headers just ask the server
+        for one.  Requests that already carry a challenge response are left
+        for basic auth.
+        """
+        for h in ('Fludsessionseq', 'Fludsessionmac'):
+            if headers.has_key(h):
+                del headers[h]
+        if headers.has_key('Authorization'):
+            return False
+        session = self.sessions.get(serverID)
+        if session and session.expires < time.time():
+            self.drop(serverID)
+            session = None
+        if not session:
+            headers['Fludsession'] = 'new'
+            return False
+        session.seq += 1
+        headers['Fludsession'] = session.id
+        headers['Fludsessionseq'] = str(session.seq)
+        headers['Fludsessionmac'] = requestMAC(session.secret, session.id,
+                session.seq, method, uri)
+        return True
+
+class ServerSessions:
+    """
+    Sessions granted to clients, keyed by session ID.
+    """
+    def __init__(self):
+        self.sessions = {}
+
+    def open(self, secret, clientID):
+        if len(self.sessions) >= MAXSESSIONS:
+            self.expire()
+        if len(self.sessions) >= MAXSESSIONS:
+            oldest = min(self.sessions.values(), key=lambda s: s.expires)
+            del self.sessions[oldest.id]
+        session = Session(secret, clientID, time.time()+SESSION_LIFETIME)
+        self.sessions[session.id] = session
+        logger.debug("granted session %s to %s" % (session.id, clientID))
+        return session.id
+
+    def expire(self):
+        now = time.time()
+        for sid in [s.id for s in self.sessions.values() if s.expires < now]:
+            del self.sessions[sid]
+
+    def verify(self, sid, clientID, seq, mac, method, uri):
+        session = self.sessions.get(sid)
+        if not session:
+            logger.debug("unknown session %s" % sid)
+            return False
+        if session.expires < time.time():
+            logger.debug("session %s expired" % sid)
+            del self.sessions[sid]
+            return False
+        if session.peerID != clientID:
+            logger.info("session %s presented by %s, but belongs to %s"
+                    % (sid, clientID, session.peerID))
+            return False
+        try:
+            seq = int(seq)
+        except (TypeError, ValueError):
+            return False
+        if seq <= session.maxseq-REPLAYWINDOW or session.seen.has_key(seq):
+            logger.info("replayed seq %d in session %s" % (seq, sid))
+            return False
+        if mac != requestMAC(session.secret, sid, seq, method, uri):
+            logger.info("bad MAC in session %s" % sid)
+            return False
+        session.seen[seq] = True
+        if seq > session.maxseq:
+            session.maxseq = seq
+            if len(session.seen) > REPLAYWINDOW:
+                floor = seq-REPLAYWINDOW
+                for s in [s for s in session.seen if s <= floor]:
+                    del session.seen[s]
+        return True
+
+clientSessions = ClientSessions()
+serverSessions = ServerSessions()
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
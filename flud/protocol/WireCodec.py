@@ -0,0 +1,181 @@
+"""
+WireCodec.py (c) 2003-2006 Alen Peacock.  This program is distributed under
+the terms of the GNU General Public License (the GPL), version 3.
+
+A compact binary encoding for the responses that carry node contacts and
+public keys (kFINDNODE, kFINDVALUE when it returns nodes, and ID).  These used
+to be python reprs, which had to be eval()ed by the receiver.
+
+Every message starts with a two-byte type, and a version byte.  Numbers are
+unsigned and big-endian; large ones (RSA moduli, exponents) are prefixed with
+a two-byte length, node IDs are a fixed 32 bytes.
+
+    nodes:  'FN' ver id count (host port nodeid Ku_n)*
+    key:    'FK' ver Ku_e Ku_n
+
+where host is a one-byte length and that many bytes, and port is two bytes.
+
+A request advertises that it can read this encoding by sending the WIREHEADER
+header; servers only answer in it when asked, and set the response's
+Content-Type so the client knows which it got.
+
+>>> nodes = [('1.2.3.4', 80, 2**255+1, 2**2047+3), ('host', 8080, 5, 7)]
+>>> msg = encodeNodes('%064x' % 12345, nodes)
+>>> r = decodeNodes(msg)
+>>> r['id'] == '%064x' % 12345, r['k'] == nodes
+(True, True)
+>>> decodeKu(encodeKu({'e': 65537L, 'n': 2**2047+3})) == {'e': 65537, 'n': 2**2047+3}
+True
+>>> decodeNodes(msg[:-1])
+Traceback (most recent call last):
+    ...
+ValueError: truncated nodes message
+>>> parseResponse("{'id': 'ab', 'k': [('1.2.3.4', 80, 5L, 7L)]}", None)['k']
+[('1.2.3.4', 80, 5L, 7L)]
+"""
+
+import struct
+from ast import literal_eval
+
+VERSION = 1
+WIREHEADER = 'Fludwire'
+NODES_TYPE = 'application/x-flud-nodes-bin'
+KEY_TYPE = 'application/x-flud-key-bin'
+
+IDLEN = 32  # bytes in a node ID (sha-256)
+
+_short = struct.Struct(">H")
+_hdr = struct.Struct(">2sB")
+_nodeshdr = struct.Struct(">2sB32sH")
+
+def _packLong(n):
+    h = "%x" % n
+    if len(h) % 2:
+        h = '0'+h
+    b = h.decode('hex')
+    if len(b) > 65535:
+        raise ValueError("number too large to encode")
+    return _short.pack(len(b))+b
+
+def _unpackLong(msg, offset):
+    (l,) = _short.unpack_from(msg, offset)
+    offset += 2
+    if offset+l > len(msg):
+        raise IndexError
+    return long(msg[offset:offset+l].encode('hex') or '0', 16), offset+l
+
+def _packID(n):
+    b = ("%064x" % n).decode('hex')
+    if len(b) != IDLEN:
+        raise ValueError("node ID out of range")
+    return b
+
+def encodeNodes(nodeID, nodes):
+    """
+    Encodes a kFINDNODE-style response: nodeID is the responder's ID (a hex
+    string), nodes a list of (host, port, id[, Ku_n]) tuples.
+    """
+    parts = [_nodeshdr.pack('FN', VERSION, _packID(long(nodeID, 16)),
+        len(nodes))]
+    for n in nodes:
+        host = str(n[0])
+        if len(host) > 255:
+            raise ValueError("host name too long to encode")
+        parts.append(chr(len(host)))
+        parts.append(host)
+        parts.append(_short.pack(n[1]))
+        parts.append(_packID(n[2]))
+        if len(n) > 3:
+            parts.append(_packLong(n[3]))
+        else:
+            parts.append(_short.pack(0))
+    return ''.join(parts)
+
+def decodeNodes(msg):
+    """
+    Decodes an encodeNodes() message into {'id': hexid, 'k': [nodes]}, the
+    same shape as the old repr responses.
+    """
+    try:
+        magic, version, id, count = _nodeshdr.unpack_from(msg, 0)
+        if magic != 'FN' or version != VERSION:
+            raise ValueError("not a version %d nodes message" % VERSION)
+        offset = _nodeshdr.size
+        nodes = []
+        for i in xrange(count):
+            l = ord(msg[offset])
+            host = msg[offset+1:offset+1+l]
+            offset += 1+l
+            (port,) = _short.unpack_from(msg, offset)
+            offset += 2
+            nid = msg[offset:offset+IDLEN]
+            if len(nid) != IDLEN:
+                raise IndexError
+            nid = long(nid.encode('hex'), 16)
+            offset += IDLEN
+            (kl,) = _short.unpack_from(msg, offset)
+            if kl:
+                Ku_n, offset = _unpackLong(msg, offset)
+                nodes.append((host, port, nid, Ku_n))
+            else:
+                offset += 2
+                nodes.append((host, port, nid))
+    except (IndexError, struct.error):
+        raise ValueError("truncated nodes message")
+    if offset != len(msg):
+        raise ValueError("trailing data in nodes message")
+    return {'id': id.encode('hex'), 'k': nodes}
+
+def encodeKu(Ku):
+    """
+    Encodes an ID response: Ku is a public key as exported by FludRSA, i.e.
+    {'e': e, 'n': n}.
+    """
+    return _hdr.pack('FK', VERSION)+_packLong(Ku['e'])+_packLong(Ku['n'])
+
+def decodeKu(msg):
+    try:
+        magic, version = _hdr.unpack_from(msg, 0)
+        if magic != 'FK' or version != VERSION:
+            raise ValueError("not a version %d key message" % VERSION)
+        e, offset = _unpackLong(msg, _hdr.size)
+        n, offset = _unpackLong(msg, offset)
+    except (IndexError, struct.error):
+        raise ValueError("truncated key message")
+    if offset != len(msg):
+        raise ValueError("trailing data in key message")
+    return {'e': e, 'n': n}
+
+def wantsBinary(request):
+    """
+    True if the (server side) request said it can read binary responses.
+    """
+    return request.getHeader(WIREHEADER) == str(VERSION)
+
+def parseResponse(response, contentType):
+    """
+    Decodes a nodes or key response from a peer, binary or (from nodes that
+    predate the binary encoding) repr.  The latter is parsed as a literal,
+    never evaluated.
+    """
+    if contentType == NODES_TYPE:
+        return decodeNodes(response)
+    elif contentType == KEY_TYPE:
+        return decodeKu(response)
+    return literal_eval(response)
+
+def responseType(factory):
+    """
+    Returns the Content-Type of the response a client factory received.
+    """
+    ct = getattr(factory, 'response_headers', {}).get('content-type')
+    if ct:
+        return ct[0]
+    return None
+
+def _test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == '__main__':
+    _test()
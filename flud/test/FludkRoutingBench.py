@@ -0,0 +1,263 @@
+#!/usr/bin/python
+
+"""
+Benchmarks the trie-based FludkRouting.kRouting against the list-of-buckets
+implementation it replaced (embedded below as ListRouting), by inserting
+contacts and then running findNode/getNode queries on both.
+
+usage: FludkRoutingBench.py [numcontacts [numqueries]]
+"""
+
+import sys, os, random, time
+from bisect import *
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+import flud.FludkRouting as FludkRouting
+from flud.FludkRouting import kRouting, kBucket, NodeCache, \
+        BucketFullException, k, idspace, logger
+
+class ListRouting:
+    """
+    The list-of-buckets routing table that kRouting replaced.
+    """
+    def __init__(self, node, bits=idspace, depth=k):
+        """
+        @param node a (ip, port, id) triple, where id is an int (this is 
+        needed to know when to split a bucket).
+        """
+        self.k = depth
+        self.replacementCache = NodeCache(300)
+        self.kBuckets = [kBucket(0, 2**bits, depth),]
+        #self.kBuckets = [kBucket(0, 1, depth),]
+        #for i in xrange(1,bits):
+        #   self.kBuckets.append(kBucket(2**i, 2**(i+1)-1, depth))
+        self.insertNode(node)
+        self.node = node
+    
+    def insertNode(self, node):
+        """
+        Inserts a node into the appropriate kBucket.  If the node already
+        exists in the appropriate kBucket, it is moved to the tail of the list.
+        If the bucket is full, this method returns the oldest node, which the
+        caller should then ping.  If the oldest node is alive, the caller
+        does nothing.  Otherwise, the caller should call replaceNode.
+        @param node a (ip, port, id) triple, where id is a long.
+        """
+        if len(node) < 3:
+            raise ValueError("node must be a triple (ip, port, id)")
+        id = node[2]
+        bucket = self._findBucket(id)
+        try:
+            # XXX: need to transfer key/vals that belong to new node?
+            bucket.updateNode(node)
+            self.replacementCache.removeNode(node)
+        except BucketFullException, e:
+            if (bucket.begin <= self.node[2] < bucket.end):
+                # bucket is full /and/ the local node is in this bucket, 
+                # split and try adding it again.
+                self._splitBucket(bucket)
+                self.insertNode(node)
+                logger.debug("split and added %x" % node[2])
+                return
+            # XXX: need to also split for some other cases, see sections 2.4 
+            # and 4.2.
+            else:
+                # bucket is full but we won't split.  Return the oldest node
+                # so that the caller can determine if it should be expunged.
+                # If the old node is not reachable, caller should call 
+                # replaceNode()
+                logger.debug("didn't add %x" % node[2])
+                return bucket.contents[0]
+            logger.debug("didn't add %x" % node[2])
+            return bucket.contents[0]
+
+    def removeNode(self, node):
+        """
+        Invalidates a node.
+        """
+        bucket = self._findBucket(node[2])
+        bucket.delNode(node)
+        
+    def replaceNode(self, replacee, replacer):
+        """
+        Expunges replacee from its bucket, making room to add replacer 
+        """
+        # XXX: constraint checks: replacee & replacer belong to the same bucket,
+        #      bucket is currently full, adding replacer doesn't overfill, etc.
+        self.removeNode(replacee)
+        self.insertNode(replacer)
+
+    def findNode(self, nodeID):
+        """
+        Returns k closest node triples with which the caller may make
+        additional queries.  If nodeID is found, it will be the first result.
+        @param nodeID an int
+        """
+        nodes = []
+        bucket = self._findBucket(nodeID)
+        #n = bucket.findNode(nodeID)
+        #if n != None: 
+        #   nodes.append(n)
+
+        nodes += bucket.contents
+        if len(nodes) < self.k:
+            nextbucket = self._nextbucket(bucket)
+            prevbucket = self._prevbucket(bucket)
+            while len(nodes) < self.k \
+                    and (nextbucket != None or prevbucket != None):
+                if nextbucket != None:
+                    nodes += nextbucket.contents
+                if prevbucket != None: 
+                    nodes += prevbucket.contents
+                nextbucket = self._nextbucket(nextbucket)
+                prevbucket = self._prevbucket(prevbucket)
+            
+        nodes.sort(lambda a, b, n=nodeID: cmp(n ^ a[2], n ^ b[2]))
+        return nodes[:self.k]
+
+    def getNode(self, nodeID):
+        """
+        Attempts to get the given node, returning a <ip, port, id> triple.  
+        If the node is not found locally, returns None 
+        @param nodeID an int
+        """
+        bucket = self._findBucket(nodeID)
+        n = bucket.findNode(nodeID)
+        if not n:
+            n = self.replacementCache.getNode(nodeID)
+        if n != None: 
+            return n
+        return None
+
+
+    def updateNode(self, node):
+        """
+        Call to update a node, i.e., whenever the node has been recently seen
+        @param node a (ip, port, id) triple, where id is an int.
+        """
+        self.insertNode(node)
+
+    def knownExternalNodes(self):
+        result = []
+        for i in self.kBuckets:
+            for j in i.contents:
+                if j[2] != self.node[2]:
+                    result.append(j)
+        result += self.replacementCache.nodes()
+        return result
+
+    def knownNodes(self):
+        result = []
+        for i in self.kBuckets:
+            for j in i.contents:
+                result.append(j)
+        result += self.replacementCache.nodes()
+        return result
+
+    def _nextbucket(self, bucket):
+        if bucket == None:
+            return bucket
+        i = self.kBuckets.index(bucket)+1
+        if i >= len(self.kBuckets):
+            return None
+        return self.kBuckets[i]
+
+    def _prevbucket(self, bucket):
+        if bucket == None:
+            return bucket
+        i = self.kBuckets.index(bucket)-1
+        if i < 0:
+            return None
+        return self.kBuckets[i]
+
+    def _findBucket(self, i):
+        """
+        returns the bucket which would contain i.
+        @param i an int
+        """
+        #print "kBuckets = %s" % str(self.kBuckets)
+        bl = bisect_left(self.kBuckets, i)
+        if bl >= len(self.kBuckets):
+            raise Exception(
+                    "tried to find an ID that is larger than ID space: %s" % i) 
+        return self.kBuckets[bisect_left(self.kBuckets, i)]
+    
+    def _splitBucket(self, bucket):
+        """
+        This is called for the special case when the bucket is full and this 
+        node is a member of the bucket.  When this occurs, the bucket should
+        be split into two new buckets.
+        """
+        halfpoint = (bucket.end - bucket.begin) / 2
+        newbucket = kBucket(bucket.end - halfpoint + 1, bucket.end, self.k)
+        self.kBuckets.insert(self.kBuckets.index(bucket.begin) + 1, newbucket)
+        bucket.end -= halfpoint
+
+        for node in bucket.contents[:]:
+            if node[2] > bucket.end:
+                bucket.delNode(node)
+                newbucket.addNode(node)
+
+
+def timeit(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time()-start, result
+
+def insertAll(table, contacts):
+    for c in contacts:
+        table.insertNode(c)
+
+def findAll(table, keys):
+    return [table.findNode(key) for key in keys]
+
+def getAll(table, ids):
+    for id in ids:
+        table.getNode(id)
+
+def exactness(table, keys, results):
+    """
+    fraction of findNode results that are the true k closest nodes known to
+    the table
+    """
+    known = table.knownNodes()
+    exact = 0
+    for key, result in zip(keys, results):
+        best = sorted(known, key=lambda n: n[2] ^ key)[:table.k]
+        if [n[2] for n in best] == [n[2] for n in result]:
+            exact += 1
+    return float(exact)/len(keys)
+
+def main():
+    numcontacts = 100000
+    numqueries = 10000
+    if len(sys.argv) > 1:
+        numcontacts = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        numqueries = int(sys.argv[2])
+    random.seed(0)
+    me = ('127.0.0.1', 8080, random.getrandbits(idspace))
+    contacts = [('10.0.%d.%d' % (i/256%256, i%256), 8080, 
+        random.getrandbits(idspace)) for i in xrange(numcontacts)]
+    # half the queries are for IDs near our own (where most buckets are)
+    keys = [random.getrandbits(idspace) for i in xrange(numqueries/2)] \
+            + [me[2] ^ random.getrandbits(random.randrange(1, idspace)) 
+                    for i in xrange(numqueries-numqueries/2)]
+    ids = [c[2] for c in random.sample(contacts, min(numqueries, 
+        numcontacts))]
+
+    print "%d contacts, %d queries, k=%d" % (numcontacts, numqueries, k)
+    print "%-12s %10s %10s %10s %8s %8s" % ("table", "insert(s)",
+            "findNode(s)", "getNode(s)", "buckets", "exact")
+    for name, cls in (("list", ListRouting), ("trie", kRouting)):
+        table = cls(me)
+        tins, r = timeit(insertAll, table, contacts)
+        tfind, results = timeit(findAll, table, keys)
+        tget, r = timeit(getAll, table, ids)
+        e = exactness(table, keys[:1000], results[:1000])
+        print "%-12s %10.3f %10.3f %10.3f %8d %8.3f" % (name, tins, tfind, 
+                tget, len(table.kBuckets), e)
+
+if __name__ == '__main__':
+    main()
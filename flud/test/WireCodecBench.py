@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+"""
+Compares the binary encoding of kFINDNODE and ID responses (WireCodec) with
+the python repr responses it replaced, which were decoded with eval() (and
+now, from older nodes, with ast.literal_eval()).
+
+usage: WireCodecBench.py [iterations]
+"""
+
+import sys, os, random, time
+from ast import literal_eval
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+from flud.protocol.WireCodec import encodeNodes, decodeNodes, encodeKu, \
+        decodeKu
+
+def timeit(n, f, *args):
+    start = time.time()
+    for i in xrange(n):
+        result = f(*args)
+    return (time.time()-start)/n, result
+
+def report(name, n, encode, decode, data):
+    tenc, msg = timeit(n, encode, *data)
+    tdec, result = timeit(n, decode, msg)
+    print "%-16s %8d %12.1f %12.1f" % (name, len(msg), tenc*1e6, tdec*1e6)
+    return result
+
+def main():
+    n = 2000
+    if len(sys.argv) > 1:
+        n = int(sys.argv[1])
+    random.seed(0)
+    nodeID = "%064x" % random.getrandbits(256)
+    # a kFINDNODE response: k=12 closest, plus one random extra
+    nodes = [('192.168.%d.%d' % (random.randrange(256), random.randrange(256)),
+        random.randrange(1024, 65536), random.getrandbits(256), 
+        random.getrandbits(2048) | 2**2047) for i in range(13)]
+    Ku = {'e': 65537L, 'n': random.getrandbits(2048) | 2**2047}
+
+    print "%d iterations" % n
+    print "%-16s %8s %12s %12s" % ("format", "bytes", "encode(us)", 
+            "decode(us)")
+    reprNodes = lambda id, k: "{'id': '%s', 'k': %s}" % (id, k)
+    r1 = report("nodes/eval", n, reprNodes, eval, (nodeID, nodes))
+    r2 = report("nodes/literal", n, reprNodes, literal_eval, (nodeID, nodes))
+    r3 = report("nodes/binary", n, encodeNodes, decodeNodes, (nodeID, nodes))
+    assert r1 == r2 == r3 == {'id': nodeID, 'k': nodes}
+    r1 = report("key/eval", n, str, eval, (Ku,))
+    r2 = report("key/literal", n, str, literal_eval, (Ku,))
+    r3 = report("key/binary", n, encodeKu, decodeKu, (Ku,))
+    assert r1 == r2 == r3 == Ku
+
+if __name__ == '__main__':
+    main()